@@ -0,0 +1,111 @@
+"""
+Microbenchmarks of IMAP response parsing helpers.
+
+Compares bytes-native parsers from `pmea.mailer.utils` with previous str-decoding versions.
+Run with: `uv run python benchmarks/bench_fetch_parser.py`
+"""
+from itertools import batched
+import re
+import timeit
+from pmea.mailer.utils import iter_fetch_responses, uid_from_fetch_line, uidnext_from_select_response
+
+MSG_COUNT = 50
+BODY_SIZE = 16 * 1024
+
+# Previous implementations, kept here as a baseline.
+LEGACY_RE_UID_RX_LINE = re.compile(r"^\d+\s+FETCH\s+\(UID\s+(\d+)")
+LEGACY_RE_UIDNEXT_RX_LINE = re.compile(r"^OK \[UIDNEXT (\d+)\]")
+LEGACY_RE_FETCH_FLAGS_LINE = re.compile(r"^[\d]+ FETCH \(UID [\d]+ FLAGS")
+
+
+def legacy_uid_from_fetch_line(line: bytes) -> int | None:
+    match = LEGACY_RE_UID_RX_LINE.match(line.decode("utf-8", errors="replace"))
+    return int(match.group(1)) if match else None
+
+
+def legacy_uidnext_from_select_response(lines: list[bytes]) -> int | None:
+    for line in lines:
+        if not line.startswith(b"OK"):
+            continue
+        match = LEGACY_RE_UIDNEXT_RX_LINE.match(line.decode("utf-8", errors="replace"))
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def legacy_cut_fetch_flags_suffix(lines: list[bytes]) -> list[bytes]:
+    skip_count = 0
+    for line in reversed(lines):
+        if isinstance(line, bytearray):
+            break
+        if LEGACY_RE_FETCH_FLAGS_LINE.match(line.decode("utf-8", errors="replace")):
+            skip_count += 1
+            continue
+        break
+    return lines if not skip_count else lines[:-skip_count]
+
+
+def legacy_iter_messages(lines: list[bytes]):
+    """Framing part of the previous `iter_messages`, without parsing messages."""
+    lines = legacy_cut_fetch_flags_suffix(lines[:-1])
+    for header, body, _ in batched(lines, 3):
+        yield legacy_uid_from_fetch_line(header), body
+
+
+def make_fetch_response() -> list[bytes]:
+    """Builds Gmail-style response: literals followed by FLAGS updates of the same messages."""
+    lines: list[bytes] = []
+    for i in range(1, MSG_COUNT + 1):
+        lines += [f"{i} FETCH (UID {1000 + i} BODY[1] {{{BODY_SIZE}}}".encode(), bytearray(BODY_SIZE), b")"]
+    lines += [f"{i} FETCH (UID {1000 + i} FLAGS (\\Seen))".encode() for i in range(1, MSG_COUNT + 1)]
+    return lines + [b"Success"]
+
+
+def bench(name: str, fn, number: int) -> float:
+    elapsed = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"{name:<40} {elapsed * 1e6:>10.2f} us")
+    return elapsed
+
+
+def main():
+    fetch_rsp = make_fetch_response()
+    uid_lines = [f"{i} FETCH (UID {1000 + i})".encode() for i in range(1, 1001)]
+    select_rsp = [
+        b"FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)",
+        b"OK [PERMANENTFLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen \\*)] Flags permitted.",
+        b"OK [UIDVALIDITY 1] UIDs valid.",
+        b"1500 EXISTS",
+        b"0 RECENT",
+        b"OK [UIDNEXT 1501] Predicted next UID.",
+        b"Success",
+    ]
+
+    print(f"FETCH response: {MSG_COUNT} messages x {BODY_SIZE} bytes")
+    results = [
+        (
+            "iter_messages (legacy)",
+            "iter_fetch_responses",
+            bench("iter_messages (legacy)", lambda: list(legacy_iter_messages(fetch_rsp)), 200),
+            bench("iter_fetch_responses", lambda: list(iter_fetch_responses(fetch_rsp)), 200),
+        ),
+        (
+            "uid_from_fetch_line x1000 (legacy)",
+            "uid_from_fetch_line x1000",
+            bench("uid_from_fetch_line x1000 (legacy)", lambda: [legacy_uid_from_fetch_line(l) for l in uid_lines], 200),
+            bench("uid_from_fetch_line x1000", lambda: [uid_from_fetch_line(l) for l in uid_lines], 200),
+        ),
+        (
+            "uidnext_from_select_response (legacy)",
+            "uidnext_from_select_response",
+            bench("uidnext_from_select_response (legacy)", lambda: legacy_uidnext_from_select_response(select_rsp), 20000),
+            bench("uidnext_from_select_response", lambda: uidnext_from_select_response(select_rsp), 20000),
+        ),
+    ]
+
+    print()
+    for legacy_name, name, legacy_time, new_time in results:
+        print(f"{name}: {legacy_time / new_time:.2f}x vs {legacy_name}")
+
+
+if __name__ == "__main__":
+    main()
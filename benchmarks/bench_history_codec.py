@@ -0,0 +1,78 @@
+"""
+Size and decoding time of chat history entries.
+
+Compares `pmea.repository.history.HistoryCodec` frames with JSON documents
+stored by `langchain_redis.RedisChatMessageHistory` (one document per message).
+Run with: `uv run python benchmarks/bench_history_codec.py`
+"""
+import json
+import timeit
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage, messages_from_dict
+from pmea.repository.history import HistoryCodec
+
+TURN_COUNT = 20
+
+
+def make_history() -> list[BaseMessage]:
+    """Email thread with a property lookup on each turn."""
+    messages: list[BaseMessage] = []
+    for i in range(TURN_COUNT):
+        messages += [
+            HumanMessage(
+                f"Email from: John Doe <john.doe@example.com>\nThread ID: 7f1c\nSubject: Leaking faucet #{i}\n\n"
+                + "Hello, the faucet in the kitchen of my apartment is leaking since yesterday evening. " * 8
+            ),
+            AIMessage("", tool_calls=[{"name": "find_properties", "args": {"tenant_email": "john.doe@example.com"}, "id": f"call-{i}"}]),
+            ToolMessage(json.dumps([{"property_id": 100, "address": "1 Main St", "apartment": "4B"}] * 3), tool_call_id=f"call-{i}"),
+            AIMessage("Dear John, thank you for reporting the issue. A maintenance ticket was created. " * 3),
+        ]
+    return messages
+
+
+def legacy_document(m: BaseMessage, i: int) -> bytes:
+    """Same fields as `RedisChatMessageHistory.add_message` stores with JSON.SET."""
+    doc = {
+        "type": m.type,
+        "message_id": f"01J{i:023d}",
+        "data": {"content": m.content, "additional_kwargs": m.additional_kwargs, "type": m.type},
+        "session_id": "7f1c0000_0000_4000_8000_000000000000",
+        "timestamp": 1750000000.123456 + i,
+    }
+    if isinstance(m, ToolMessage):
+        doc["data"]["tool_call_id"] = m.tool_call_id
+        doc["data"]["status"] = m.status
+    return json.dumps(doc).encode()
+
+
+def legacy_decode(raw: bytes) -> BaseMessage:
+    doc = json.loads(raw)
+    return messages_from_dict([{"type": doc["type"], "data": doc["data"]}])[0]
+
+
+def bench(name: str, fn, number: int) -> float:
+    elapsed = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"{name:<30} {elapsed * 1e6:>10.2f} us")
+    return elapsed
+
+
+def main():
+    messages = make_history()
+    legacy = [legacy_document(m, i) for i, m in enumerate(messages)]
+    plain, zstd = HistoryCodec(), HistoryCodec("zstd")
+    plain_frames = [plain.encode(m) for m in messages]
+    zstd_frames = [zstd.encode(m) for m in messages]
+
+    print(f"History: {len(messages)} messages")
+    legacy_size = sum(len(d) for d in legacy)
+    for name, frames in [("legacy JSON", legacy), ("compact", plain_frames), ("compact+zstd", zstd_frames)]:
+        size = sum(len(f) for f in frames)
+        print(f"{name:<30} {size:>10} bytes ({size / legacy_size:.0%})")
+    print("Legacy storage also keeps a key and a search index entry per message.\n")
+
+    bench("decode legacy JSON", lambda: [legacy_decode(d) for d in legacy], 50)
+    bench("decode compact", lambda: [plain.decode(f) for f in plain_frames], 50)
+    bench("decode compact+zstd", lambda: [zstd.decode(f) for f in zstd_frames], 50)
+
+
+if __name__ == "__main__":
+    main()
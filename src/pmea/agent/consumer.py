@@ -20,6 +20,7 @@ MSG_OUTPUT_KEY = "output"
 @dataclass
 class ConsumerConfig:
     get_chat_model: Callable[[], BaseChatModel]
+    # Chains are run with `ainvoke`, so only async methods of returned history are used.
     get_history: Callable[[str], BaseChatMessageHistory]
     system_prompt_extra: str | None
 
@@ -50,23 +51,26 @@ class LLMMailConsumer(ThreadConsumer):
             result = await self._run_inference(thread_id, m)
             self._logger.info("Msg: %s:%s; inference done", thread_id, m.uid)
         except Exception as e:
-            await self._handle_error(e, thread_id, m)
+            # User is notified once retries are exhausted, see `reject_thread_message`.
+            self._logger.error(
+                "error during AI inference: %s (thread_id=%s; msg_id=%s)",
+                e,
+                thread_id,
+                m.headers.msg_id,
+            )
             raise e
 
         output = output_from_inference_result(result)
         if output:
             await self._deps.replyer.reply_in_thread(thread_id, m, output)
 
+    async def reject_thread_message(self, thread_id: str, m: Message, err: Exception) -> None:
+        await self._handle_error(err, thread_id, m)
+
     async def _handle_error(self, err: Exception, thread_id: str, m: Message) -> str:
         try:
             # Notify user about the error.
             # TODO: reroute message to stakeholders.
-            self._logger.error(
-                "error during AI inference: %s (thread_id=%s; msg_id=%s)",
-                err,
-                thread_id,
-                m.headers.msg_id,
-            )
             await self._deps.replyer.reply_in_thread(
                 thread_id, m, build_error_response(thread_id, err)
             )
@@ -118,4 +122,5 @@ class LLMMailConsumer(ThreadConsumer):
         }
 
         # TODO: filter out AI thoughts (`<think>...</think>`) from the response.
+        # Must stay async: histories share the application's asyncio Redis client.
         return await chain.ainvoke(input=input_msg, config=session_cfg)
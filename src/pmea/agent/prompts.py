@@ -38,6 +38,7 @@ When you receive a message, check if contains a property address.
   * Use `forward_to_stakeholder` tool to forward a mail to a property manager (stakeholder) if you can't handle the request.
   * In order to use `forward_to_stakeholder`, you need to find a property first.
   * Make sure to include conversation summary of a user in additional comments.
+  * Set `urgent` only for emergencies which need immediate attention (e.g. flooding, fire, gas leak).
   * Otherwise, you should notify user that you can't handle the request.
 
 **How to create a maintenance ticket:**
@@ -16,6 +16,10 @@ class ForwardToStakeholderInputModel(BaseModel):
     additional_comments: str | None = Field(
         description="Optional additional comments to include in the email (string or null)",
     )
+    urgent: bool = Field(
+        default=False,
+        description="Whether the issue needs immediate attention (e.g. flooding, fire, gas leak, no heating in winter)",
+    )
 
 
 logger = logging.getLogger(__name__)
@@ -52,6 +56,7 @@ class ForwardToStakeholderTool(BaseAsyncTool):
         self,
         property_id: int,
         additional_comments: str | None = None,
+        urgent: bool = False,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
         ctx_key = (
@@ -68,15 +73,17 @@ class ForwardToStakeholderTool(BaseAsyncTool):
 
         try:
             logger.info(
-                "%s tool called: property_id=%s; msg=%s",
+                "%s tool called: property_id=%s; urgent=%s; msg=%s",
                 self.name,
                 property_id,
+                urgent,
                 ctx_key,
             )
             await self._replyer.forward_message(
                 parent_msg=self._context.original_message,
                 dst_email=property.stakeholder_email,
                 body=additional_comments,
+                urgent=urgent,
             )
             return json.dumps({"success": True})
         except Exception as e:
@@ -15,9 +15,9 @@ class MailReplyer(Protocol):
         """Sends a mail reply to the given thread."""
 
     async def forward_message(
-        self, parent_msg: Message, dst_email: str, body: str | None
+        self, parent_msg: Message, dst_email: str, body: str | None, urgent: bool = False
     ) -> None:
-        """Forwards a mail to the given email address."""
+        """Forwards a mail to the given email address. Non-urgent mails may be sent later in a digest."""
 
 
 class PropertiesStore(Protocol):
@@ -1,4 +1,5 @@
 from .server import ServerApplication
 from .chat import ChatApplication
+from .migrate import memory_report, migrate_history, rebucket_threads
 
-__all__ = ["ServerApplication", "ChatApplication"]
\ No newline at end of file
+__all__ = ["ServerApplication", "ChatApplication", "migrate_history", "memory_report", "rebucket_threads"]
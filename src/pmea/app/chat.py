@@ -4,6 +4,7 @@ from email.utils import make_msgid
 from pathlib import Path
 from typing import Optional
 import uuid
+import redis.asyncio as aioredis
 import typer
 
 from ..agent import CallToolsDependencies, MailReplyer
@@ -11,7 +12,7 @@ from ..repository.properties import PropertiesRepository
 from ..repository.tickets import TicketRepository
 from ..agent import LLMMailConsumer
 from ..config import Config
-from .utils import make_consumer_config
+from .utils import close_redis_client, make_consumer_config, make_redis_client
 from ..mailer.sender import make_forward_message
 from ..mailer import (
     Contact,
@@ -41,8 +42,14 @@ class ChatApplication:
         asyncio.run(self._arun())
 
     async def _arun(self):
+        redis_client, redis_pool = await make_redis_client(self._config.redis)
+        try:
+            await self._chat(_build_llm_consumer(self._config, redis_client))
+        finally:
+            await close_redis_client(redis_client, redis_pool)
+
+    async def _chat(self, llm_consumer: LLMMailConsumer):
         thread_id = str(uuid.uuid4())
-        llm_consumer = _build_llm_consumer(self._config)
         chat_contact = Contact(name="Agent", email="agent@example.com")
         seq_id = 0
 
@@ -63,7 +70,11 @@ class ChatApplication:
                     msg_id=make_msgid(), in_reply_to=None, references=None
                 ),
             )
-            await llm_consumer.consume_thread_message(thread_id, msg)
+            try:
+                await llm_consumer.consume_thread_message(thread_id, msg)
+            except Exception as e:
+                await llm_consumer.reject_thread_message(thread_id, msg, e)
+                raise
 
 
 class ChatReplyer(MailReplyer):
@@ -83,9 +94,9 @@ class ChatReplyer(MailReplyer):
             print(f"==> {line}")
 
     async def forward_message(
-        self, parent_msg: Message, dst_email: str, body: str | None
+        self, parent_msg: Message, dst_email: str, body: str | None, urgent: bool = False
     ) -> None:
-        print(f"[!] Forwarded message to {dst_email}")
+        print(f"[!] Forwarded {'urgent ' if urgent else ''}message to {dst_email}")
         msg_id = make_msgid()
         msg = make_forward_message(
             parent_msg=parent_msg,
@@ -100,8 +111,8 @@ class ChatReplyer(MailReplyer):
         self._writer.save(msg)
 
 
-def _build_llm_consumer(config: Config) -> LLMMailConsumer:
-    consumer_config = make_consumer_config(config)
+def _build_llm_consumer(config: Config, redis_client: aioredis.Redis) -> LLMMailConsumer:
+    consumer_config = make_consumer_config(config, redis_client)
     tickets_repo = TicketRepository(config.storage.tickets_dir)
     props_repo = PropertiesRepository(config.storage.properties)
     replyer = ChatReplyer(config.storage.forwarded_messages_dir)
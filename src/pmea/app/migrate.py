@@ -0,0 +1,92 @@
+"""One-off maintenance commands for data stored in Redis."""
+from collections import Counter
+from dataclasses import dataclass, field
+import logging
+from typing import Optional
+from ..config import Config
+from ..repository.history import migrate_legacy_history
+from ..repository.threads import ThreadsRepository
+from .utils import close_redis_client, make_history_codec, make_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_history(config: Config):
+    """Moves chat histories of `langchain_redis` into compact lists. Should run before upgraded servers start."""
+    redis_client, redis_pool = await make_redis_client(config.redis)
+    try:
+        sessions, messages = await migrate_legacy_history(
+            redis_client, make_history_codec(config.chats), ttl=config.chats.ttl,
+        )
+        logger.info(f"chat history migration done: {messages} messages of {sessions} chats")
+    finally:
+        await close_redis_client(redis_client, redis_pool)
+
+
+async def rebucket_threads(config: Config):
+    """Moves message-to-thread mappings into `threads.bucket_count` buckets. Servers must be stopped."""
+    redis_client, redis_pool = await make_redis_client(config.redis)
+    try:
+        hash_tag = config.redis.hash_tag if config.redis.cluster else None
+        repo = ThreadsRepository(redis_client, bucket_count=config.threads.bucket_count, hash_tag=hash_tag)
+        moved = await repo.rebucket()
+        logger.info(f"moved {moved} message-to-thread mappings into {config.threads.bucket_count} buckets")
+    finally:
+        await close_redis_client(redis_client, redis_pool)
+
+
+@dataclass
+class KeyGroupUsage:
+    """Memory used by keys sharing a prefix (text before the first colon)."""
+    prefix: str
+    keys: int = 0
+    bytes: int = 0
+    encodings: Counter = field(default_factory=Counter)
+
+    def __str__(self) -> str:
+        encodings = ", ".join(f"{e}={n}" for e, n in self.encodings.most_common())
+        per_key = self.bytes / self.keys if self.keys else 0
+        return f"{self.prefix:<20} {self.keys:>10} keys {self.bytes:>14} B {per_key:>10.0f} B/key  {encodings}"
+
+
+async def memory_report(config: Config, max_keys: Optional[int] = None, batch_size: int = 500) -> list[KeyGroupUsage]:
+    """
+    Measures Redis memory usage and encodings of keys grouped by prefix, largest groups first.
+    Scans up to `max_keys` keys (all if None) with `MEMORY USAGE` and `OBJECT ENCODING`.
+    """
+    redis_client, redis_pool = await make_redis_client(config.redis)
+    groups: dict[str, KeyGroupUsage] = {}
+    try:
+        keys: list[bytes] = []
+        scanned = 0
+        async for key in redis_client.scan_iter(count=batch_size):
+            keys.append(key)
+            scanned += 1
+            if len(keys) >= batch_size:
+                await _measure_keys(redis_client, keys, groups)
+                keys = []
+            if max_keys is not None and scanned >= max_keys:
+                break
+        if keys:
+            await _measure_keys(redis_client, keys, groups)
+    finally:
+        await close_redis_client(redis_client, redis_pool)
+    return sorted(groups.values(), key=lambda g: g.bytes, reverse=True)
+
+
+async def _measure_keys(redis_client, keys: list[bytes], groups: dict[str, KeyGroupUsage]):
+    async with redis_client.pipeline(transaction=False) as p:
+        for key in keys:
+            p.memory_usage(key)
+            p.object("ENCODING", key)
+        values = await p.execute(raise_on_error=False)
+    for i, key in enumerate(keys):
+        usage, encoding = values[2 * i], values[2 * i + 1]
+        if isinstance(usage, Exception) or usage is None:
+            # Key expired or was deleted after the scan.
+            continue
+        prefix = key.decode(errors="replace").split(":", 1)[0]
+        group = groups.setdefault(prefix, KeyGroupUsage(prefix))
+        group.keys += 1
+        group.bytes += usage
+        group.encodings[encoding.decode() if isinstance(encoding, bytes) else str(encoding)] += 1
@@ -0,0 +1,97 @@
+"""Redis connection pool shared by all Redis consumers of an application."""
+import asyncio
+from dataclasses import dataclass
+import logging
+import time
+import redis.asyncio as aioredis
+from ..config import RedisConfig
+from ..repository.thread_cache import ThreadCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolStats:
+    max_connections: int
+    in_use: int
+    idle: int
+    waits: int
+    wait_total: float
+    wait_max: float
+
+    @property
+    def utilization(self) -> float:
+        return self.in_use / self.max_connections if self.max_connections else 0.0
+
+    @property
+    def wait_mean(self) -> float:
+        return self.wait_total / self.waits if self.waits else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"in_use={self.in_use}/{self.max_connections} ({self.utilization:.0%}) idle={self.idle} "
+            f"wait_mean={self.wait_mean * 1000:.1f}ms wait_max={self.wait_max * 1000:.1f}ms"
+        )
+
+
+class InstrumentedConnectionPool(aioredis.BlockingConnectionPool):
+    """Blocking connection pool which measures how long callers wait for a free connection."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def get_connection(self, command_name=None, *keys, **options):
+        started_at = time.monotonic()
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        finally:
+            wait = time.monotonic() - started_at
+            self._waits += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+    def stats(self) -> PoolStats:
+        return PoolStats(
+            max_connections=self.max_connections,
+            in_use=len(self._in_use_connections),
+            idle=len(self._available_connections),
+            waits=self._waits,
+            wait_total=self._wait_total,
+            wait_max=self._wait_max,
+        )
+
+
+def make_redis_pool(cfg: RedisConfig) -> InstrumentedConnectionPool:
+    return InstrumentedConnectionPool.from_url(cfg.dsn, **_pool_options(cfg))
+
+
+def make_redis_cluster(cfg: RedisConfig) -> aioredis.RedisCluster:
+    """Cluster client keeps a pool per node, so it isn't instrumented."""
+    options = _pool_options(cfg)
+    del options["timeout"]
+    return aioredis.RedisCluster.from_url(cfg.dsn, **options)
+
+
+async def report_pool_stats(
+    pool: InstrumentedConnectionPool | None, interval: float, thread_cache: ThreadCache | None = None,
+):
+    """Logs pool utilization and thread cache hit rate periodically."""
+    while True:
+        await asyncio.sleep(interval)
+        if pool:
+            logger.info(f"redis pool: {pool.stats()}")
+        if thread_cache:
+            logger.info(f"thread cache: {thread_cache.stats}")
+
+
+def _pool_options(cfg: RedisConfig) -> dict:
+    return dict(
+        max_connections=cfg.max_connections,
+        timeout=cfg.pool_timeout,
+        socket_timeout=cfg.socket_timeout,
+        socket_connect_timeout=cfg.socket_connect_timeout,
+        health_check_interval=cfg.health_check_interval,
+    )
@@ -1,30 +1,54 @@
 import asyncio
 import logging
+import os
+import socket
 
 from ..agent.consumer import ConsumerConfig
 from ..agent.tools.tools import CallToolsDependencies
+from ..mailer.digest import ForwardDigest, RedisDigestBuffer
 from ..mailer.sender import MailSender
+from ..repository.keys import hash_tagged
 from ..repository.properties import PropertiesRepository
-from ..repository.threads import ThreadsRepository
+from ..repository.thread_cache import ThreadCache
+from ..repository.threads import REDIS_KEY_PREFIX_MSG_BUCKET, REDIS_KEY_PREFIX_MSG_ID, ThreadsRepository
 from ..repository.tickets import TicketRepository
 from ..agent import LLMMailConsumer
 from ..config import Config
-from .utils import make_consumer_config, make_redis_client
+from .redis_pool import report_pool_stats
+from .utils import close_redis_client, make_consumer_config, make_redis_client
 from ..mailer import (
     ThreadMailConsumer,
     IncomingMailListener,
     ListenerConfig,
     MailFileWriter,
+    MailWorkers,
+    MessageQueue,
+    RedisStreamQueue,
 )
+from ..mailer.watermark import LastUIDStore
+from ..mailer.leader import Fence, FencedUIDStore, LeaderElection
+from ..mailer.retry import DelayQueue, RedisDelayQueue, RetryDispatcher
+from ..config import RetryPolicy
 
 logger = logging.getLogger(__name__)
 
 class ServerApplication:
-    listener: IncomingMailListener
+    listener: IncomingMailListener | None = None
+    workers: MailWorkers
     _config: Config
+    _listen: bool
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, listen: bool = True):
+        """
+        If `listen` is disabled - only workers are started to process messages
+        from a shared Redis stream queue.
+        """
+        if not listen and config.queue.backend != "redis":
+            raise Exception("standalone workers require 'redis' queue backend")
+        if config.leader.enabled and config.queue.backend != "redis":
+            raise Exception("leader election requires 'redis' queue backend")
         self._config = config
+        self._listen = listen
 
     def run(self):
         logger.info(f"starting service...")
@@ -35,27 +59,156 @@ class ServerApplication:
             return
 
     async def _arun(self):
-        redis_client = await make_redis_client(self._config.redis)
+        # All Redis consumers, including chat histories, share one pool (one per node on Redis Cluster).
+        redis_client, redis_pool = await make_redis_client(self._config.redis)
+        # Keys updated together by scripts share a cluster slot.
+        hash_tag = self._config.redis.hash_tag if self._config.redis.cluster else None
 
         # If enabled - forward "@example.com" mails to file writer.
         file_writer: MailFileWriter | None = None
         if self._config.storage.forwarded_messages_dir:
             file_writer = MailFileWriter(self._config.storage.forwarded_messages_dir)
 
-        threads_repo = ThreadsRepository(redis_client)
-        mail_sender = MailSender(self._config.email, threads_repo, file_writer)
-        consumer_config = make_consumer_config(self._config)
+        thread_cache: ThreadCache | None = None
+        if self._config.redis.thread_cache_size:
+            thread_cache = ThreadCache(self._config.redis.thread_cache_size)
+        threads_repo = ThreadsRepository(
+            redis_client, thread_cache, bucket_count=self._config.threads.bucket_count, hash_tag=hash_tag,
+        )
+        await threads_repo.check_bucket_count()
+        delay_queue = RedisDelayQueue(redis_client, hash_tag=hash_tag)
+        # Outgoing messages are delivered by a separate pool, so workers don't wait for SMTP.
+        outbox = self._make_retry_dispatcher(delay_queue, "send", self._config.retry.send)
+        digest: ForwardDigest | None = None
+        if self._config.digest.enabled:
+            digest = ForwardDigest(
+                RedisDigestBuffer(redis_client, hash_tag=hash_tag),
+                window=self._config.digest.window,
+                lease=self._config.digest.lease,
+                poll_interval=self._config.digest.poll_interval,
+            )
+        mail_sender = MailSender(self._config.email, threads_repo, file_writer, outbox=outbox, digest=digest)
+        consumer_config = make_consumer_config(self._config, redis_client)
 
         tickets_repo = TicketRepository(self._config.storage.tickets_dir)
         props_repo = PropertiesRepository(self._config.storage.properties)
         tool_deps = CallToolsDependencies(mail_sender, props_repo, tickets_repo)
         llm_consumer = LLMMailConsumer(consumer_config, tool_deps)
-        listener_config = ListenerConfig(self._config.email, self._config.listener)
-        self.listener = IncomingMailListener(
-            config=listener_config,
+        msg_queue: MessageQueue | None = None
+        if self._config.queue.backend == "redis":
+            msg_queue = RedisStreamQueue(
+                redis_client,
+                stream_key=hash_tagged(self._config.queue.stream_key, hash_tag),
+                group=self._config.queue.group,
+                consumer_name=f"{socket.gethostname()}-{os.getpid()}",
+                claim_idle=self._config.queue.claim_idle,
+                read_count=self._config.queue.read_batch_size,
+                dead_letters=delay_queue,
+            )
+            await msg_queue.ensure_group()
+
+        election: LeaderElection | None = None
+        if self._listen and self._config.leader.enabled:
+            # Listener is created on each leadership term, workers run all the time.
+            election = LeaderElection(
+                redis_client,
+                lease_key=hash_tagged(self._config.leader.lease_key, hash_tag),
+                ttl=self._config.leader.ttl,
+                renew_interval=self._config.leader.renew_interval,
+            )
+        elif self._listen:
+            self.listener = self._make_listener(threads_repo, msg_queue, delay_queue)
+            msg_queue = self.listener.queue
+
+        self.workers = MailWorkers(
+            queue=msg_queue,
             consumer=ThreadMailConsumer(llm_consumer, threads_repo),
-            last_uid_store=threads_repo,
+            worker_count=self._config.listener.worker_count,
+            shard_size=self._config.listener.msg_queue_size,
+            retries=self._make_retry_dispatcher(delay_queue, "consume", self._config.retry.consume),
+            stats_interval=self._config.listener.stats_interval,
+        )
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                if election:
+                    tg.create_task(election.run(
+                        lambda fence: self._run_leader_listener(threads_repo, msg_queue, delay_queue, fence)
+                    ))
+                elif self.listener:
+                    tg.create_task(self.listener.start())
+                tg.create_task(self.workers.run())
+                if isinstance(msg_queue, RedisStreamQueue):
+                    tg.create_task(msg_queue.keep_claimed())
+                tg.create_task(outbox.run(mail_sender.deliver, concurrency=self._config.email.smtp_pool_size))
+                tg.create_task(mail_sender.close_idle_connections())
+                if digest:
+                    tg.create_task(digest.run(mail_sender.send_digest))
+                # Cluster client has no pub/sub, cache keeps only found mappings there.
+                if thread_cache and redis_pool:
+                    tg.create_task(thread_cache.track_invalidations(
+                        redis_client, [REDIS_KEY_PREFIX_MSG_BUCKET, REDIS_KEY_PREFIX_MSG_ID],
+                    ))
+                tg.create_task(self._maintain_threads(threads_repo))
+                if (redis_pool or thread_cache) and self._config.redis.pool_stats_interval:
+                    tg.create_task(report_pool_stats(
+                        redis_pool, self._config.redis.pool_stats_interval, thread_cache,
+                    ))
+        finally:
+            mail_sender.close()
+            await close_redis_client(redis_client, redis_pool)
+
+    def _make_listener(
+        self, last_uid_store: LastUIDStore, msg_queue: MessageQueue | None, dead_letters: DelayQueue,
+    ) -> IncomingMailListener:
+        return IncomingMailListener(
+            config=ListenerConfig(self._config.email, self._config.listener),
+            last_uid_store=last_uid_store,
+            msg_queue=msg_queue,
+            dead_letters=dead_letters,
         )
 
-        async with asyncio.TaskGroup() as tg:
-            tg.create_task(self.listener.start())
+    async def _run_leader_listener(
+        self, threads_repo: ThreadsRepository, msg_queue: RedisStreamQueue, dead_letters: DelayQueue, fence: Fence,
+    ):
+        # Writes of a previous leader are rejected, new one resumes from the last saved UID.
+        # Last UID is advanced with each queued message, so messages aren't queued twice after a takeover.
+        last_uid_key = threads_repo.last_uid_key(self._config.email.username)
+        self.listener = self._make_listener(
+            FencedUIDStore(threads_repo, fence), msg_queue.with_fence(fence, last_uid_key), dead_letters,
+        )
+        try:
+            await self.listener.start()
+        finally:
+            self.listener = None
+
+    async def _maintain_threads(self, threads_repo: ThreadsRepository):
+        """Moves mappings stored in the previous layout, then periodically forgets inactive threads."""
+        opts = self._config.threads
+        try:
+            moved = await threads_repo.migrate_legacy_keys(opts.migrate_batch_size)
+            if moved:
+                logger.info(f"moved {moved} message-to-thread mappings into buckets")
+        except Exception as e:
+            logger.error(f"failed to migrate message-to-thread mappings: {e}", exc_info=True)
+
+        if not opts.retention:
+            return
+        while True:
+            try:
+                removed = await threads_repo.expire_inactive_threads(opts.retention)
+                if removed:
+                    logger.info(f"removed {removed} inactive threads")
+            except Exception as e:
+                logger.error(f"failed to remove inactive threads: {e}", exc_info=True)
+            await asyncio.sleep(opts.sweep_interval)
+
+    def _make_retry_dispatcher(self, delay_queue: DelayQueue, stage: str, policy: RetryPolicy) -> RetryDispatcher:
+        return RetryDispatcher(
+            delay_queue,
+            stage=stage,
+            policy=policy,
+            lease=self._config.retry.lease,
+            poll_interval=self._config.retry.poll_interval,
+            claim_count=self._config.retry.claim_batch_size,
+        )
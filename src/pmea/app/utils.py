@@ -1,29 +1,45 @@
 import redis.asyncio as aioredis
-from langchain_redis import RedisChatMessageHistory
 from ..agent import ConsumerConfig, sanitize_session_id
-from ..config import RedisConfig, Config
+from ..config import ChatsConfig, Config, RedisConfig
+from ..repository.history import HistoryCodec, RedisChatHistory
+from .redis_pool import InstrumentedConnectionPool, make_redis_cluster, make_redis_pool
 
 
-async def make_redis_client(cfg: RedisConfig) -> aioredis.Redis:
-    redis_client = aioredis.from_url(cfg.dsn)
+async def make_redis_client(cfg: RedisConfig) -> tuple[aioredis.Redis, InstrumentedConnectionPool | None]:
+    """Returns a connected client and its shared pool. Cluster client keeps a pool per node, so no pool is returned."""
+    pool: InstrumentedConnectionPool | None = None
+    if cfg.cluster:
+        redis_client = make_redis_cluster(cfg)
+    else:
+        pool = make_redis_pool(cfg)
+        redis_client = aioredis.Redis(connection_pool=pool)
     try:
         await redis_client.ping()
-        return redis_client
+        return redis_client, pool
     except Exception as e:
+        await close_redis_client(redis_client, pool)
         raise Exception(f"failed to connect to Redis: {e}")
 
 
-def make_consumer_config(config: Config) -> ConsumerConfig:
+async def close_redis_client(redis_client: aioredis.Redis, pool: InstrumentedConnectionPool | None):
+    if pool:
+        await pool.disconnect()
+    else:
+        await redis_client.aclose()
+
+
+def make_history_codec(cfg: ChatsConfig) -> HistoryCodec:
+    return HistoryCodec(cfg.compression, level=cfg.compression_level, min_size=cfg.compression_min_size)
+
+
+def make_consumer_config(config: Config, redis_client: aioredis.Redis) -> ConsumerConfig:
+    codec = make_history_codec(config.chats)
     return ConsumerConfig(
         get_chat_model=config.llm.get_model_provider(),
         system_prompt_extra=config.llm.get_system_prompt_extra(),
         get_history=(
             lambda thread_id:
-            # TODO: use connection pool for Redis.
-            RedisChatMessageHistory(
-                session_id=sanitize_session_id(thread_id),
-                redis_url=config.redis.dsn,
-                ttl=config.chats.ttl,
-            )
+            # Session ID is sanitized to keep keys of histories migrated from LangChain's storage.
+            RedisChatHistory(redis_client, sanitize_session_id(thread_id), codec, ttl=config.chats.ttl)
         ),
     )
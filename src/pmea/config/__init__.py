@@ -3,10 +3,17 @@ from .llm import *
 
 __all__ = [
     "ListenerOptions",
+    "QueueOptions",
+    "RetryPolicy",
+    "RetryOptions",
+    "LeaderOptions",
+    "DigestOptions",
+    "ThreadStorageOptions",
     "StorageConfig",
     "RedisConfig",
     "ChatsConfig",
     "EmailConfig",
+    "SendRateLimit",
     "LLMConfig",
     "LoggerConfig",
     "OllamaOptions",
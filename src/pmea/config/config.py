@@ -2,7 +2,7 @@ import os
 import logging
 import yaml
 from pydantic import Field
-from typing import Optional, Self
+from typing import Literal, Optional, Self
 from pathlib import Path
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from .llm import LLMConfig
@@ -14,14 +14,109 @@ class ListenerOptions(BaseSettings):
     """Mail listener configuration"""
 
     model_config = SettingsConfigDict(extra="ignore", env_prefix="")
-    worker_count: int = Field(1, description="Number of workers to handle messages")
+    worker_count: int = Field(
+        1, description="Number of workers to handle messages. Each mail thread is handled by a single worker"
+    )
     msg_fetch_batch_size: int = Field(
         10, description="Number of messages to fetch per IMAP request"
     )
-    msg_queue_size: int = Field(10, description="Messages queue size")
+    msg_queue_size: int = Field(10, description="Messages queue size (per each worker and incoming)")
+    msg_queue_max_bytes: int | None = Field(
+        None,
+        description="Memory budget of incoming messages queue in bytes, overflow is spilled to disk (None - bound by msg_queue_size)",
+    )
+    msg_queue_spill_dir: str | None = Field(
+        None, description="Directory for spilled queue segments (default: system temp directory)"
+    )
+    msg_queue_max_spill_bytes: int | None = Field(
+        None, description="Maximum size of spilled messages on disk, listener waits when it's reached (None - unlimited)"
+    )
+    fetch_pipeline_depth: int = Field(
+        0,
+        description="Number of downloaded chunks to buffer ahead of processing (0 - disabled)",
+    )
+    parser_pool_size: int = Field(
+        0, description="Number of processes to parse messages (0 - parse in event loop)"
+    )
+    uid_flush_batch_size: int = Field(
+        20, description="Number of processed messages after which last UID is saved"
+    )
+    uid_flush_interval: float = Field(
+        5, description="Interval in seconds to save last processed UID"
+    )
     ignore_addresses: set[str] = Field(
         default_factory=set, description="Addresses to ignore"
     )
+    uid_page_size: int = Field(
+        1000, description="Number of new messages which are downloaded and queued per page"
+    )
+    initial_sync_days: int | None = Field(
+        None, description="On the first run, process only messages received within this number of days (None - all)"
+    )
+    initial_sync_max_count: int | None = Field(
+        None, description="On the first run, process at most this number of latest messages (None - all)"
+    )
+    initial_sync_skip_history: bool = Field(
+        False, description="On the first run, mark all existing messages as processed without processing them"
+    )
+    stats_interval: float = Field(
+        300, description="Interval in seconds of worker and incoming queue reports in logs (0 - disabled)"
+    )
+
+
+class QueueOptions(BaseSettings):
+    """Incoming messages queue configuration"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    backend: Literal["memory", "redis"] = Field(
+        "memory", description="Queue backend. Redis stream allows to run workers in separate processes"
+    )
+    stream_key: str = Field("pmea:incoming", description="Redis stream key")
+    group: str = Field("pmea-workers", description="Redis stream consumer group")
+    claim_idle: float = Field(
+        300, description="Time in seconds after which unacknowledged message is reclaimed by another worker"
+    )
+    read_batch_size: int = Field(10, description="Number of messages to read from the stream at once")
+
+
+class LeaderOptions(BaseSettings):
+    """Leader election configuration"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    enabled: bool = Field(
+        False, description="Whether only elected instance should listen for incoming mail"
+    )
+    lease_key: str = Field("leader:listener", description="Redis key of leader lease")
+    ttl: float = Field(10, description="Lease TTL in seconds. Standby takes over after it expires")
+    renew_interval: float = Field(
+        3, description="Interval in seconds to renew the lease or to check whether it's expired"
+    )
+
+
+class RetryPolicy(BaseSettings):
+    """Retry policy of a processing stage"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    max_attempts: int = Field(5, description="Maximum number of attempts, including the first one")
+    base_delay: float = Field(30, description="Delay in seconds before the first retry")
+    max_delay: float = Field(3600, description="Maximum delay in seconds between retries")
+
+
+class RetryOptions(BaseSettings):
+    """Retries and dead letter queue configuration"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    poll_interval: float = Field(1, description="Interval in seconds to check for due retries")
+    lease: float = Field(
+        600, description="Time in seconds after which unfinished retry is attempted again"
+    )
+    claim_batch_size: int = Field(10, description="Number of due retries to take at once")
+    consume: RetryPolicy = Field(
+        default_factory=RetryPolicy, description="Incoming message processing (incl. AI inference)"
+    )
+    send: RetryPolicy = Field(
+        default_factory=RetryPolicy, description="Outgoing message delivery"
+    )
 
 
 class StorageConfig(BaseSettings):
@@ -40,6 +135,31 @@ class RedisConfig(BaseSettings):
 
     model_config = SettingsConfigDict(extra="ignore", env_prefix="")
     dsn: str = Field(..., description="Redis DSN")
+    max_connections: int = Field(
+        32,
+        description="Maximum number of connections in the shared pool, callers wait for a free one",
+    )
+    pool_timeout: float | None = Field(
+        10, description="Seconds to wait for a free pooled connection (None - wait forever)",
+    )
+    socket_timeout: float | None = Field(
+        None,
+        description="Seconds to wait for a command reply (None - wait forever), should exceed blocking reads",
+    )
+    socket_connect_timeout: float | None = Field(5, description="Seconds to wait for a connection to be established")
+    health_check_interval: float = Field(
+        30, description="Idle connections are checked with PING before use after this many seconds (0 - disabled)",
+    )
+    pool_stats_interval: float = Field(300, description="Interval of pool utilization and thread cache reports in logs (0 - disabled)")
+    thread_cache_size: int = Field(
+        10000,
+        description="Maximum number of message-to-thread mappings cached in-process (0 - disabled)",
+    )
+    cluster: bool = Field(False, description="DSN points to a Redis Cluster node, pool limits apply per node")
+    hash_tag: str = Field(
+        "pmea",
+        description="Cluster hash tag of keys updated together: leader lease, message stream, mailbox state",
+    )
 
 
 class ChatsConfig(BaseSettings):
@@ -47,6 +167,17 @@ class ChatsConfig(BaseSettings):
 
     model_config = SettingsConfigDict(extra="ignore", env_prefix="")
     ttl: int | None = Field(None, description="Redis key TTL")
+    compression: Literal["zstd"] | None = Field(None, description="Chat history compression, requires `zstd` extra (None - disabled)")
+    compression_level: int = Field(3, description="zstd compression level")
+    compression_min_size: int = Field(512, description="Messages smaller than this many bytes aren't compressed")
+
+
+class SendRateLimit(BaseSettings):
+    """Budget of outgoing messages of one kind"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    per_minute: int | None = Field(None, description="Maximum number of messages per minute (None - unlimited)")
+    per_day: int | None = Field(None, description="Maximum number of messages per day (None - unlimited)")
 
 
 class EmailConfig(BaseSettings):
@@ -73,6 +204,36 @@ class EmailConfig(BaseSettings):
     msg_id_domain: str | None = Field(
         None, description="Domain to use for Message-ID header"
     )
+    smtp_pool_size: int = Field(
+        2, description="Maximum number of concurrent SMTP connections"
+    )
+    smtp_idle_timeout: float = Field(
+        60, description="Time in seconds after which unused SMTP connection is closed"
+    )
+    smtp_health_check_interval: float = Field(
+        10, description="SMTP connection unused for this number of seconds is checked with NOOP before reuse"
+    )
+    reply_rate_limit: SendRateLimit = Field(
+        default_factory=SendRateLimit, description="Budget of replies in threads"
+    )
+    forward_rate_limit: SendRateLimit = Field(
+        default_factory=SendRateLimit, description="Budget of messages forwarded to stakeholders"
+    )
+    throttle_pause: float = Field(
+        60, description="Pause in seconds of all sending after server throttled a message with 4xx or 5xx quota reply"
+    )
+    status_poll: bool = Field(
+        False, description="Poll mailbox UIDNEXT with STATUS alongside IDLE to detect new messages faster"
+    )
+    status_poll_min_interval: float = Field(
+        5, description="STATUS poll interval in seconds while new messages keep arriving"
+    )
+    status_poll_max_interval: float = Field(
+        120, description="Maximum STATUS poll interval in seconds for a quiet mailbox"
+    )
+    status_poll_backoff: float = Field(
+        2, description="Multiplier of STATUS poll interval after each poll without new messages"
+    )
 
     def with_defaults(self) -> Self:
         if not self.msg_id_domain:
@@ -93,12 +254,50 @@ class LoggerConfig(BaseSettings):
     file: Optional[Path] = Field(None, description="Path to log file")
 
 
+class DigestOptions(BaseSettings):
+    """Stakeholder forwards digest configuration"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    enabled: bool = Field(
+        False, description="Collect non-urgent forwards to the same stakeholder into a single digest message"
+    )
+    window: float = Field(300, description="Time in seconds to collect forwards before sending a digest")
+    poll_interval: float = Field(5, description="Interval in seconds to check for due digests")
+    lease: float = Field(
+        600, description="Time in seconds after which digest claimed by a crashed process is sent by another one"
+    )
+
+
+class ThreadStorageOptions(BaseSettings):
+    """Message-to-thread mapping storage configuration"""
+
+    model_config = SettingsConfigDict(extra="ignore", env_prefix="")
+    bucket_count: int = Field(
+        1024,
+        description=(
+            "Number of Redis hashes message mappings are spread over. Buckets stay compact while they have "
+            "fewer than `hash-max-listpack-entries` (128) messages, so keep it above expected message count / 128. "
+            "Mappings are moved to a new count with `domos-pmea rebucket-threads`"
+        ),
+    )
+    retention: float | None = Field(
+        7776000, description="Time in seconds after the last message when a thread is forgotten (None - forever)"
+    )
+    sweep_interval: float = Field(3600, description="Interval in seconds to check for inactive threads")
+    migrate_batch_size: int = Field(500, description="Number of legacy keys moved to buckets at once on startup")
+
+
 class Config(BaseSettings):
     email: EmailConfig = Field(default_factory=EmailConfig)
     llm: LLMConfig = Field(default_factory=LLMConfig)
     redis: RedisConfig = Field(default_factory=RedisConfig)
     logging: LoggerConfig = Field(default_factory=LoggerConfig)
     listener: ListenerOptions = Field(default_factory=ListenerOptions)
+    queue: QueueOptions = Field(default_factory=QueueOptions)
+    retry: RetryOptions = Field(default_factory=RetryOptions)
+    leader: LeaderOptions = Field(default_factory=LeaderOptions)
+    digest: DigestOptions = Field(default_factory=DigestOptions)
+    threads: ThreadStorageOptions = Field(default_factory=ThreadStorageOptions)
     chats: ChatsConfig = Field(default_factory=ChatsConfig)
     storage: StorageConfig = Field(default_factory=StorageConfig)
 
@@ -1,4 +1,6 @@
-from .mail_listener import IncomingMailListener, ListenerConfig, MailConsumer
+from .mail_listener import IncomingMailListener, ListenerConfig
+from .msg_queue import MessageQueue, InMemoryMessageQueue, RedisStreamQueue, SpillingMessageQueue
+from .workers import MailConsumer, MailWorkers
 from .thread_listener import ThreadConsumer, ThreadMailConsumer
 from .types import Contact, Message, MessageHeaders
 from .sender import MailSender, ThreadUpdater, make_forward_message
@@ -11,6 +13,11 @@ __all__ = [
     "Message",
     "MessageHeaders",
     "MailConsumer",
+    "MailWorkers",
+    "MessageQueue",
+    "InMemoryMessageQueue",
+    "RedisStreamQueue",
+    "SpillingMessageQueue",
     "ThreadConsumer",
     "ThreadMailConsumer",
     "ThreadUpdater",
@@ -0,0 +1,137 @@
+"""Minimal IMAP BODYSTRUCTURE parser (RFC 3501, section 7.4.2) to locate message text part."""
+import base64
+import codecs
+from dataclasses import dataclass
+import quopri
+import re
+from typing import Optional
+
+RE_BODYSTRUCTURE_START = re.compile(rb"BODYSTRUCTURE \(")
+RE_TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}|([^\s()"]+))')
+RE_QUOTED_ESCAPE = re.compile(rb'\\(.)')
+
+DEFAULT_CHARSET = "utf-8"
+
+type BodyNode = str | None | list[BodyNode]
+
+
+@dataclass
+class BodyPart:
+    """Location and encoding of a message body part."""
+    section: str
+    encoding: str
+    charset: str
+    size: int
+
+
+def parse_bodystructure(attrs: bytes) -> Optional[BodyNode]:
+    """Extracts and parses BODYSTRUCTURE from FETCH response attributes into nested lists."""
+    match = RE_BODYSTRUCTURE_START.search(attrs)
+    if not match:
+        return None
+
+    stack: list[list[BodyNode]] = []
+    pos = match.end() - 1
+    while pos < len(attrs):
+        token = RE_TOKEN.match(attrs, pos)
+        if not token:
+            raise ValueError(f"malformed BODYSTRUCTURE at position {pos}")
+        pos = token.end()
+        open_paren, close_paren, quoted, literal, atom = token.groups()
+        if open_paren:
+            stack.append([])
+            continue
+        if close_paren:
+            node = stack.pop()
+            if not stack:
+                return node
+            stack[-1].append(node)
+            continue
+        if quoted is not None:
+            value = RE_QUOTED_ESCAPE.sub(rb"\1", quoted).decode("utf-8", errors="replace")
+        elif literal is not None:
+            # Literal contents are returned separately and never needed to locate a text part.
+            value = ""
+        else:
+            value = None if atom.upper() == b"NIL" else atom.decode("ascii", errors="replace")
+        stack[-1].append(value)
+    raise ValueError("unterminated BODYSTRUCTURE")
+
+
+def find_text_part(node: BodyNode, content_subtype: str = "plain") -> Optional[BodyPart]:
+    """
+    Finds the first inline 'text/<content_subtype>' part of a message.
+
+    Single-part text messages are returned regardless of subtype, same as when
+    whole message is parsed. Attached messages (message/rfc822) are not traversed.
+    """
+    if not isinstance(node, list) or not node:
+        return None
+    if not isinstance(node[0], list):
+        if _str_at(node, 0).lower() == "text":
+            return _make_body_part(node, "1")
+        return None
+    return _find_multipart_text(node, "", content_subtype)
+
+
+def _find_multipart_text(node: list[BodyNode], prefix: str, content_subtype: str) -> Optional[BodyPart]:
+    for i, child in enumerate(node, 1):
+        if not isinstance(child, list):
+            # Multipart subtype follows child parts.
+            break
+        section = f"{prefix}{i}"
+        if child and isinstance(child[0], list):
+            found = _find_multipart_text(child, f"{section}.", content_subtype)
+            if found:
+                return found
+            continue
+        if _str_at(child, 0).lower() != "text" or _str_at(child, 1).lower() != content_subtype:
+            continue
+        if _is_attachment(child):
+            continue
+        return _make_body_part(child, section)
+    return None
+
+
+def _make_body_part(node: list[BodyNode], section: str) -> BodyPart:
+    params = node[2] if len(node) > 2 and isinstance(node[2], list) else []
+    charset = DEFAULT_CHARSET
+    for key, value in zip(params[::2], params[1::2]):
+        if isinstance(key, str) and key.lower() == "charset" and isinstance(value, str):
+            charset = value
+            break
+    size = _str_at(node, 6)
+    return BodyPart(
+        section=section,
+        encoding=_str_at(node, 5).lower() or "7bit",
+        charset=charset,
+        size=int(size) if size.isdigit() else 0,
+    )
+
+
+def _is_attachment(node: list[BodyNode]) -> bool:
+    # Text parts have extra "lines" field, so disposition is located at index 9.
+    disposition = node[9] if len(node) > 9 else None
+    return isinstance(disposition, list) and _str_at(disposition, 0).lower() == "attachment"
+
+
+def _str_at(node: list[BodyNode], i: int) -> str:
+    value = node[i] if len(node) > i else None
+    return value if isinstance(value, str) else ""
+
+
+def decode_part_payload(data: bytes, encoding: str, charset: str) -> str:
+    """Decodes body part contents using its Content-Transfer-Encoding and charset."""
+    encoding = encoding.lower()
+    if encoding == "base64":
+        payload = base64.b64decode(bytes(data), validate=False)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(bytes(data))
+    else:
+        payload = bytes(data)
+
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = DEFAULT_CHARSET
+    return payload.decode(charset, errors="replace")
@@ -0,0 +1,173 @@
+"""Collecting forwards to the same stakeholder into periodic digests."""
+import asyncio
+from dataclasses import asdict, dataclass
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Protocol, Self
+import redis.asyncio as aioredis
+from redis.commands.core import AsyncScript
+from ..repository.keys import hash_tagged, is_cluster
+from .types import Message
+
+REDIS_KEY_DIGEST_DUE = "digest:due"
+REDIS_KEY_PREFIX_DIGEST_ITEMS = "digest:items:"
+
+# Digest window starts with the first item, items added later don't postpone it.
+ADD_ITEM_LUA = """
+local count = redis.call('RPUSH', KEYS[1], ARGV[2])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+  redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+end
+return count
+"""
+
+# Claimed digests stay in the set with a lease deadline, so they're sent again if a process dies.
+CLAIM_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, member in ipairs(due) do
+  redis.call('ZADD', KEYS[1], ARGV[2], member)
+end
+return due
+"""
+
+# Items added while digest was sent start a new window.
+COMMIT_LUA = """
+redis.call('LTRIM', KEYS[1], ARGV[2], -1)
+if redis.call('LLEN', KEYS[1]) == 0 then
+  redis.call('ZREM', KEYS[2], ARGV[1])
+else
+  redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+end
+return 1
+"""
+
+
+@dataclass
+class DigestItem:
+    """Forwarded message waiting to be sent in a digest."""
+    sender: str
+    subject: str
+    body: str
+    sent_at: str
+    comments: str | None = None
+
+    @staticmethod
+    def from_message(msg: Message, comments: str | None) -> Self:
+        return DigestItem(
+            sender=msg.sender.email,
+            subject=msg.subject,
+            body=msg.body,
+            sent_at=msg.sent_at.isoformat(),
+            comments=comments,
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @staticmethod
+    def from_json(raw: str | bytes) -> Self:
+        return DigestItem(**json.loads(raw))
+
+
+class DigestBuffer(Protocol):
+    """Abstract storage of buffered forwards grouped by recipient."""
+
+    async def add(self, dst_email: str, item: DigestItem, due_at: float) -> None:
+        """Buffers an item. Digest of a recipient becomes due at `due_at` of its first item."""
+
+    async def claim_due(self, now: float, lease: float, limit: int) -> list[str]:
+        """Returns recipients with due digests and hides them for `lease` seconds."""
+
+    async def items(self, dst_email: str) -> list[DigestItem]:
+        """Returns buffered items of a recipient in order."""
+
+    async def commit(self, dst_email: str, count: int, next_due_at: float) -> None:
+        """Removes first `count` sent items. Digest of remaining items becomes due at `next_due_at`."""
+
+
+class RedisDigestBuffer(DigestBuffer):
+    """
+    Digest buffer stored in Redis lists with a sorted set of due recipients.
+    Keys get `hash_tag` on Redis Cluster, since scripts update items and due recipients together.
+    """
+    _redis_client: aioredis.Redis
+    _add_script: AsyncScript
+    _claim_due_script: AsyncScript
+    _commit_script: AsyncScript
+    _due_key: str
+    _items_key_prefix: str
+
+    def __init__(self, redis_client: aioredis.Redis, hash_tag: str | None = None):
+        self._redis_client = redis_client
+        hash_tag = hash_tag if is_cluster(redis_client) else None
+        self._due_key = hash_tagged(REDIS_KEY_DIGEST_DUE, hash_tag)
+        self._items_key_prefix = hash_tagged(REDIS_KEY_PREFIX_DIGEST_ITEMS, hash_tag)
+        self._add_script = redis_client.register_script(ADD_ITEM_LUA)
+        self._claim_due_script = redis_client.register_script(CLAIM_DUE_LUA)
+        self._commit_script = redis_client.register_script(COMMIT_LUA)
+
+    async def add(self, dst_email: str, item: DigestItem, due_at: float) -> None:
+        keys = [f"{self._items_key_prefix}{dst_email}", self._due_key]
+        await self._add_script(keys=keys, args=[dst_email, item.to_json(), due_at])
+
+    async def claim_due(self, now: float, lease: float, limit: int) -> list[str]:
+        members = await self._claim_due_script(keys=[self._due_key], args=[now, now + lease, limit])
+        return [m.decode() if isinstance(m, bytes) else m for m in members]
+
+    async def items(self, dst_email: str) -> list[DigestItem]:
+        raw_items = await self._redis_client.lrange(f"{self._items_key_prefix}{dst_email}", 0, -1)
+        return [DigestItem.from_json(raw) for raw in raw_items]
+
+    async def commit(self, dst_email: str, count: int, next_due_at: float) -> None:
+        keys = [f"{self._items_key_prefix}{dst_email}", self._due_key]
+        await self._commit_script(keys=keys, args=[dst_email, count, next_due_at])
+
+
+class ForwardDigest:
+    """
+    Buffers forwards to the same recipient for `window` seconds and hands them over as a single digest.
+
+    Digest is committed only after the handler succeeded, so items are sent at least once.
+    """
+    _buffer: DigestBuffer
+    _window: float
+    _lease: float
+    _poll_interval: float
+    _claim_count: int
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(self, buffer: DigestBuffer, window: float, lease: float, poll_interval: float, claim_count: int = 10):
+        self._buffer = buffer
+        self._window = window
+        self._lease = lease
+        self._poll_interval = poll_interval
+        self._claim_count = claim_count
+
+    async def add(self, dst_email: str, item: DigestItem) -> None:
+        await self._buffer.add(dst_email, item, time.time() + self._window)
+
+    async def run(self, send: Callable[[str, list[DigestItem]], Awaitable[None]]):
+        while True:
+            try:
+                recipients = await self._buffer.claim_due(time.time(), self._lease, self._claim_count)
+            except Exception as e:
+                self._logger.error(f"failed to claim due digests: {e}", exc_info=True)
+                recipients = []
+
+            for dst_email in recipients:
+                try:
+                    await self._flush(dst_email, send)
+                except Exception as e:
+                    # Digest is sent again after its lease expires.
+                    self._logger.error(f"failed to send digest to {dst_email}: {e}", exc_info=True)
+
+            if len(recipients) < self._claim_count:
+                await asyncio.sleep(self._poll_interval)
+
+    async def _flush(self, dst_email: str, send: Callable[[str, list[DigestItem]], Awaitable[None]]):
+        items = await self._buffer.items(dst_email)
+        if items:
+            self._logger.info(f"sending digest of {len(items)} forwards to {dst_email}")
+            await send(dst_email, items)
+        await self._buffer.commit(dst_email, len(items), time.time() + self._window)
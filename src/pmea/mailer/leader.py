@@ -0,0 +1,158 @@
+"""Leader election on top of a Redis lease."""
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+import redis.asyncio as aioredis
+from redis.commands.core import AsyncScript
+from ..repository.threads import ThreadsRepository
+
+# Each new lease gets a greater token, so writes of a previous leader can be rejected.
+ACQUIRE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return nil
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+
+RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+@dataclass
+class Fence:
+    """Lease key and fencing token of the current leader. Fenced writes fail once the lease is lost."""
+    lease_key: str
+    token: int
+
+
+class LeaderElection:
+    """
+    Runs a task only while holding a lease in Redis.
+
+    Standby instances poll the lease and take over once it expires. Leader renews the lease
+    periodically and cancels the task as soon as the lease can't be confirmed anymore.
+    If the task fails, the lease is released and the instance campaigns again with the others.
+    """
+    _redis_client: aioredis.Redis
+    _lease_key: str
+    _ttl: float
+    _renew_interval: float
+    _acquire_script: AsyncScript
+    _renew_script: AsyncScript
+    _release_script: AsyncScript
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(self, redis_client: aioredis.Redis, lease_key: str, ttl: float, renew_interval: float):
+        if renew_interval >= ttl:
+            raise ValueError("lease renew interval should be less than lease TTL")
+        self._redis_client = redis_client
+        self._lease_key = lease_key
+        self._ttl = ttl
+        self._renew_interval = renew_interval
+        self._acquire_script = redis_client.register_script(ACQUIRE_LUA)
+        self._renew_script = redis_client.register_script(RENEW_LUA)
+        self._release_script = redis_client.register_script(RELEASE_LUA)
+
+    async def run(self, leader_task: Callable[[Fence], Awaitable[None]]):
+        """Waits for leadership and runs a task while it lasts. Repeats after leadership is lost."""
+        self._logger.info(f"waiting for leadership [{self._lease_key}]...")
+        while True:
+            try:
+                token = await self._try_acquire()
+            except Exception as e:
+                self._logger.error(f"failed to acquire lease: {e}")
+                token = None
+
+            if token is None:
+                await asyncio.sleep(self._renew_interval)
+                continue
+
+            self._logger.info(f"became leader [{self._lease_key}] with token {token}")
+            await self._lead(leader_task, Fence(self._lease_key, token))
+            self._logger.warning(f"lost leadership [{self._lease_key}], switching to standby...")
+            # Give standbys a chance to take over, e.g. if the task failed on this instance.
+            await asyncio.sleep(self._renew_interval)
+
+    async def _lead(self, leader_task: Callable[[Fence], Awaitable[None]], fence: Fence):
+        task = asyncio.create_task(leader_task(fence))
+        renewed_at = time.monotonic()
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=self._renew_interval)
+                if done:
+                    # Leader task isn't supposed to exit. Its failure must not stop the rest of the service.
+                    err = None if task.cancelled() else task.exception()
+                    self._logger.error(f"leader task exited: {err}", exc_info=err)
+                    return
+
+                try:
+                    if not await self._renew(fence.token):
+                        return
+                    renewed_at = time.monotonic()
+                except Exception as e:
+                    # Lease might be still valid, keep leading until it surely expires.
+                    self._logger.error(f"failed to renew lease: {e}")
+                    if time.monotonic() - renewed_at >= self._ttl:
+                        return
+        finally:
+            if not task.done():
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+            with suppress(Exception):
+                await self._release(fence.token)
+
+    async def _try_acquire(self) -> Optional[int]:
+        token = await self._acquire_script(keys=[self._lease_key, f"{self._lease_key}:token"], args=[self._ttl_ms])
+        return int(token) if token is not None else None
+
+    async def _renew(self, token: int) -> bool:
+        return bool(await self._renew_script(keys=[self._lease_key], args=[token, self._ttl_ms]))
+
+    async def _release(self, token: int) -> None:
+        await self._release_script(keys=[self._lease_key], args=[token])
+
+    @property
+    def _ttl_ms(self) -> int:
+        return int(self._ttl * 1000)
+
+
+class FencedUIDStore:
+    """Last UID store which rejects updates from an instance which isn't a leader anymore."""
+    _threads_repo: ThreadsRepository
+    _fence: Fence
+
+    def __init__(self, threads_repo: ThreadsRepository, fence: Fence):
+        self._threads_repo = threads_repo
+        self._fence = fence
+
+    async def get_last_uid(self, email: str) -> Optional[int]:
+        return await self._threads_repo.get_last_uid(email)
+
+    async def set_last_uid(self, email: str, uid: int) -> None:
+        ok = await self._threads_repo.set_last_uid_fenced(email, uid, self._fence.lease_key, self._fence.token)
+        if not ok:
+            raise Exception(f"last UID update rejected, fencing token {self._fence.token} is stale")
+
+    async def get_mailbox_state(self, email: str) -> Optional[tuple[int, int]]:
+        return await self._threads_repo.get_mailbox_state(email)
+
+    async def set_mailbox_state(self, email: str, uidvalidity: int, highestmodseq: int) -> None:
+        # Mailbox state is saved only after a successful fenced last UID update.
+        await self._threads_repo.set_mailbox_state(email, uidvalidity, highestmodseq)
@@ -1,71 +1,199 @@
 import asyncio
+from collections import deque
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+import multiprocessing
+from itertools import batched
+import json
 import re
-from typing import Optional, Protocol
+import time
 from aioimaplib import aioimaplib
 from dataclasses import dataclass
 import logging
 from ..config import EmailConfig, ListenerOptions
-from .utils import assert_ok, is_server_push_exists_result, iter_messages, parse_message_headers, parse_msg_payload, uid_from_fetch_line, uidnext_from_select_response
-from email.utils import parsedate_to_datetime
-from email import message
-from .types import Contact, Message
+from .bodystructure import find_text_part, parse_bodystructure
+from .metrics import ArrivalMetrics
+from .msg_queue import InMemoryMessageQueue, MessageQueue, SpillingMessageQueue
+from .retry import DelayQueue, RetryTask
+from .utils import MailboxStatus, assert_ok, is_server_push_exists_result, iter_fetch_responses, mailbox_status_from_select_response, parse_fetched_message, parse_header_literal, uid_from_fetch_line, uidnext_from_status_response, uids_from_search_response
+from .types import Contact, FetchedMessage
+from .watermark import LastUIDStore, UIDWatermark
 
 UID_RX = re.compile(rb"\* \d+ EXISTS")
 
+# Headers necessary to filter out messages before downloading the whole message.
+PREFETCH_HEADERS = "From To Subject Date Message-ID In-Reply-To References"
+
+# Messages which can't be downloaded or parsed are moved to the dead letter queue of this stage.
+LISTENER_DEAD_LETTER_STAGE = "fetch"
+
 @dataclass
 class ListenerConfig:
     email_provider: EmailConfig
     options: ListenerOptions
 
-class LastUIDStore(Protocol):
-    """Abstract interface to implement last read UID store."""
-    async def get_last_uid(self, email: str) -> Optional[int]:
-        pass
-    async def set_last_uid(self, email: str, uid: int) -> None:
-        pass
+@dataclass
+class FetchedChunk:
+    """Downloaded messages chunk and UIDs of filtered messages."""
+    messages: list[FetchedMessage]
+    skipped_uids: list[int]
+
+class FetchError(Exception):
+    """Server rejected a FETCH command, while the connection is still usable."""
+
+class AdaptivePollInterval:
+    """Poll interval which tightens on mailbox activity and backs off exponentially while it's quiet."""
+    _min_interval: float
+    _max_interval: float
+    _backoff: float
+    _value: float
 
+    def __init__(self, min_interval: float, max_interval: float, backoff: float):
+        self._min_interval = min_interval
+        self._max_interval = max(min_interval, max_interval)
+        self._backoff = backoff
+        self._value = min_interval
 
-class MailConsumer(Protocol):
-    """Abstract interface to implement mail handler."""
-    async def consume_mail(self, m: Message) -> None:
-        pass
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def active(self):
+        self._value = self._min_interval
+
+    def quiet(self):
+        self._value = min(self._max_interval, self._value * self._backoff)
 
 class IncomingMailListener:
-    """Listens for new messages and passes them to consumer."""
+    """
+    Listens for new messages and puts them to the message queue.
+    Messages which can't be downloaded or parsed are skipped and moved to the dead letter queue of `dead_letters` (if set).
+    """
     _config: ListenerConfig
-    _msg_queue: asyncio.Queue[tuple[int, message.Message]] | None = None
+    _msg_queue: MessageQueue
+    _dead_letters: DelayQueue | None
+    _parse_pool: ProcessPoolExecutor | None = None
     _running: bool = False
+    # IDLE connection only signals mailbox changes, messages are downloaded on the fetch connection.
     _client: aioimaplib.IMAP4 | aioimaplib.IMAP4_SSL | None = None
-    _consumer: MailConsumer
+    _idle_client: aioimaplib.IMAP4 | aioimaplib.IMAP4_SSL | None = None
+    # STATUS must not be used on a selected mailbox (RFC 3501), so polling uses a connection without one.
+    _status_client: aioimaplib.IMAP4 | aioimaplib.IMAP4_SSL | None = None
+    _mailbox_changed: asyncio.Event
+
+    # Source ("push", "poll" or "resync") and timestamp of the pending mailbox change.
+    _change_source: str | None = None
+    _detected_at: float | None = None
+    _uidnext: int | None = None
+    _poll_interval: AdaptivePollInterval | None = None
+    _arrival_metrics: ArrivalMetrics
+    _fetched_arrivals: list[float]
     _logger: logging.Logger = logging.getLogger(__name__)
-    _last_uid_store: LastUIDStore
-
-    def __init__(self, config: ListenerConfig, last_uid_store: LastUIDStore, consumer: MailConsumer):
+    _watermark: UIDWatermark
+    _store: LastUIDStore
+
+    # CONDSTORE (RFC 7162) state: last persisted (UIDVALIDITY, HIGHESTMODSEQ) and pending
+    # (UID, UIDVALIDITY, HIGHESTMODSEQ) checkpoints which are persisted once UID is processed.
+    _condstore: bool = False
+    _mailbox_state: tuple[int, int] | None = None
+    _modseq_checkpoints: deque[tuple[int, int, int]]
+
+    def __init__(
+        self,
+        config: ListenerConfig,
+        last_uid_store: LastUIDStore,
+        msg_queue: MessageQueue | None = None,
+        dead_letters: DelayQueue | None = None,
+    ):
         self._config = config
-        self._consumer = consumer
-        self._last_uid_store = last_uid_store
+        self._store = last_uid_store
+        self._dead_letters = dead_letters
+        self._modseq_checkpoints = deque()
+        self._mailbox_changed = asyncio.Event()
+        self._arrival_metrics = ArrivalMetrics()
+        self._fetched_arrivals = []
+        email_cfg = config.email_provider
+        if email_cfg.status_poll:
+            self._poll_interval = AdaptivePollInterval(
+                email_cfg.status_poll_min_interval, email_cfg.status_poll_max_interval, email_cfg.status_poll_backoff
+            )
+        self._watermark = UIDWatermark(
+            store=last_uid_store,
+            email=config.email_provider.username,
+            flush_count=config.options.uid_flush_batch_size,
+            flush_interval=config.options.uid_flush_interval,
+            on_flush=self._persist_modseq,
+        )
+        # In-memory queue reports processed messages back to advance last UID.
+        self._msg_queue = msg_queue or self._make_queue(config.options)
+
+    def _make_queue(self, options: ListenerOptions) -> MessageQueue:
+        if options.msg_queue_max_bytes is None:
+            return InMemoryMessageQueue(options.msg_queue_size, self._ack_message)
+        return SpillingMessageQueue(
+            options.msg_queue_max_bytes,
+            self._ack_message,
+            spill_dir=options.msg_queue_spill_dir,
+            max_spill_bytes=options.msg_queue_max_spill_bytes,
+        )
+
+    @property
+    def queue(self) -> MessageQueue:
+        return self._msg_queue
+
+    @property
+    def arrival_metrics(self) -> ArrivalMetrics:
+        return self._arrival_metrics
 
     async def start(self):
         self._running = True
-        self._msg_queue = asyncio.Queue[tuple[int, message.Message]](self._config.options.msg_queue_size)
-        await self._connect_and_idle()
-
-    async def _update_last_uid(self, uid: int):
-        await self._last_uid_store.set_last_uid(self._config.email_provider.username, uid)
+        if self._config.options.parser_pool_size > 0:
+            # Forking a process with running event loop is unsafe.
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=self._config.options.parser_pool_size,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
 
-    async def _get_last_uid(self) -> int:
-        last_uid = await self._last_uid_store.get_last_uid(self._config.email_provider.username)
-        if last_uid is None:
-            self._logger.warning("last UID is not set, using first UID")
-            return 0
-        return last_uid
+        await self._watermark.load()
+        self._mailbox_state = await self._store.get_mailbox_state(self._config.email_provider.username)
+        flusher = asyncio.create_task(self._watermark.run_flusher())
+        try:
+            await self._connect_and_idle()
+        finally:
+            # Listener may be stopped on leadership loss while the rest of the service keeps running.
+            self._running = False
+            flusher.cancel()
+            # Persist the last acks while the lease is still held, so they aren't processed again after restart.
+            try:
+                await self._watermark.flush()
+            except Exception as e:
+                self._logger.error(f"failed to save last UID {self._watermark.watermark} on stop: {e}", exc_info=True)
+            if self._parse_pool:
+                self._parse_pool.shutdown(wait=False, cancel_futures=True)
+            self._disconnect()
 
     async def _connect(self):
-        if self._client is not None:
-            await self._client.logout()
-            await self._client.close()
-            self._client = None
+        """(Re)connects the fetch connection which runs SELECT and downloads messages."""
+        await self._close_client(self._client)
+        self._client = None
+        client = await self._open_connection("fetch")
+        self._client = client
+        self._condstore = await self._enable_condstore(client)
+
+    async def _connect_idle(self):
+        """(Re)connects the IDLE connection. It only watches the mailbox and never fetches."""
+        await self._close_client(self._idle_client)
+        self._idle_client = None
+        client = await self._open_connection("IDLE")
+        # EXAMINE opens the mailbox read-only, so IDLE doesn't interfere with flags of the fetch connection.
+        code, rsp = await client.examine(self._config.email_provider.mailbox)
+        if code != "OK":
+            await self._close_client(client)
+            raise Exception(f"failed to examine mailbox: {rsp} (code: {code})")
+        self._idle_client = client
 
+    async def _open_connection(self, name: str) -> aioimaplib.IMAP4:
         ssl = self._config.email_provider.use_ssl
         imap_host = self._config.email_provider.imap_host
         imap_port = self._config.email_provider.imap_port
@@ -74,9 +202,9 @@ class IncomingMailListener:
         for attempt in range(max_attempts):
             try:
                 if attempt > 0:
-                    self._logger.info(f"reconnecting to IMAP server [attempt {attempt + 1}/{max_attempts}]...")
+                    self._logger.info(f"reconnecting {name} connection to IMAP server [attempt {attempt + 1}/{max_attempts}]...")
                 else:
-                    self._logger.info("connecting to IMAP server...")
+                    self._logger.info(f"opening {name} connection to IMAP server...")
 
                 if ssl:
                     client = aioimaplib.IMAP4_SSL(imap_host, imap_port)
@@ -91,142 +219,444 @@ class IncomingMailListener:
                 if code != "OK":
                     client.close()
                     raise Exception(f"can't login to IMAP server: {rsp} (code: {code})")
-                
-                self._client = client
-                return
+                return client
             except Exception as e:
                 self._logger.error(f"can't connect to IMAP server: {e} (attempt {attempt + 1}/{max_attempts})", exc_info=True)
                 if attempt == last_attempt:
                     raise
                 await asyncio.sleep(self._config.email_provider.reconnect_delay)
 
+    async def _close_client(self, client: aioimaplib.IMAP4 | None):
+        if client is None:
+            return
+        try:
+            await client.logout()
+            await client.close()
+        except Exception as e:
+            self._logger.debug(f"failed to close IMAP connection: {e}")
+
+    def _disconnect(self):
+        # Drop connections without LOGOUT, they may be in the middle of IDLE.
+        for client in (self._idle_client, self._client, self._status_client):
+            transport = client.protocol.transport if client else None
+            if transport:
+                transport.close()
+        self._client = None
+        self._idle_client = None
+        self._status_client = None
+
     async def _connect_and_idle(self):
         await self._connect()
+        await self._connect_idle()
+        if not self._watermark.restored:
+            await self._initial_sync()
 
         # Fetch messages that were missed while offline.
         self._logger.info("fetching missed messages...")
-        await self._check_missed_messages()
-        await self._start_consumers()
+        self._signal_change("resync")
 
         self._logger.info("starting IDLE loop...")
-        await self._idle_loop()
-
-    async def _check_missed_messages(self):
-        # TODO: process dead letter queue.
-        await self._fetch_messages()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self._idle_loop())
+            tg.create_task(self._fetch_loop())
 
     async def _fetch_messages(self):
-        # TODO: implement a dead letter queue.
-        last_uid = await self._get_last_uid()
+        # Messages which are still in the queue are not persisted yet, so continue from last queued one.
+        last_uid = self._watermark.last_tracked
 
         self._logger.info(f"fetching messages since uid {last_uid}...")
         code, lines = await self._client.select(self._config.email_provider.mailbox)
         assert_ok(code, "failed to select mailbox")
-        uidnext = uidnext_from_select_response(lines)
-        if uidnext is None:
+        status = mailbox_status_from_select_response(lines)
+        if status.uidnext is None:
             raise Exception("failed to get UIDNEXT from mailbox")
 
-        remote_last_uid = uidnext - 1
+        self._uidnext = status.uidnext
+        remote_last_uid = status.uidnext - 1
+        if remote_last_uid > last_uid and self._poll_interval:
+            self._poll_interval.active()
         if remote_last_uid <= last_uid:
             self._logger.info(f"no new messages since {last_uid}")
+            await self._checkpoint_modseq(last_uid, status)
             return
 
-        query = f"{last_uid + 1}:*"
-        code, lines = await self._client.uid("FETCH", query, "(UID)")
+        # Mailbox mod-sequence grows on each change, so only messages changed since last sync are listed.
+        changed_since = self._changed_since(status)
+        if changed_since is not None and changed_since >= status.highestmodseq:
+            self._logger.info(f"no changes since modseq {changed_since}")
+            return
+
+        # UIDs may be sparse (e.g. Gmail), so new messages are found with one search instead of listing UID ranges.
+        uids = await self._search_new_uids(last_uid, remote_last_uid, changed_since)
+        if not uids:
+            self._logger.debug(f"no messages found in [{last_uid + 1}:{remote_last_uid}]")
+
+        # Messages are processed page by page, so downloads of a large backlog aren't all planned at once.
+        for page in batched(uids, self._config.options.uid_page_size):
+            # Bulk fetch messages in chunks. Can't do in parallel due to IMAP protocol limitations.
+            chunks = [list(c) for c in batched(page, self._config.options.msg_fetch_batch_size)]
+            if self._config.options.fetch_pipeline_depth > 0:
+                await self._fetch_messages_pipelined(chunks)
+            else:
+                for chunk in chunks:
+                    await self._fetch_messages_bulk(chunk)
+
+        # All messages up to the selected state are queued.
+        await self._checkpoint_modseq(max(remote_last_uid, self._watermark.last_tracked), status)
+
+    async def _search_new_uids(self, last_uid: int, remote_last_uid: int, changed_since: int | None) -> list[int]:
+        criteria = ["UID", f"{last_uid + 1}:{remote_last_uid}"]
+        if changed_since is not None:
+            # MODSEQ criterion (RFC 7162) matches messages with mod-sequence greater or equal to the given one.
+            criteria += ["MODSEQ", str(changed_since + 1)]
+        code, lines = await self._client.uid_search(*criteria, charset=None)
         assert_ok(code, "failed to search messages")
 
-        if not lines:
-            self._logger.info(f"no messages found since {last_uid}")
+        # Explicitly specify UIDs to fetch to avoid accessing deleted messages or Gmail-style expunging.
+        # UID range is unordered in IMAP, the last message matches it even if its UID is below the range.
+        return sorted(uid for uid in uids_from_search_response(lines) if uid > last_uid)
+
+    async def _initial_sync(self):
+        """On the first run, marks mailbox history outside of the configured window as processed."""
+        options = self._config.options
+        if options.initial_sync_days is None and options.initial_sync_max_count is None and not options.initial_sync_skip_history:
             return
 
-        # Explicitly specify UIDs to fetch to avoid accessing deleted messages or Gmail-style expunging.
-        uids: list[int] = []
+        code, lines = await self._client.select(self._config.email_provider.mailbox)
+        assert_ok(code, "failed to select mailbox")
+        status = mailbox_status_from_select_response(lines)
+        if status.uidnext is None:
+            raise Exception("failed to get UIDNEXT from mailbox")
+
+        first_uid = status.uidnext
+        if not options.initial_sync_skip_history:
+            first_uid = 1
+            if options.initial_sync_max_count is not None:
+                first_uid = max(first_uid, await self._first_uid_of_latest(status, options.initial_sync_max_count))
+            if options.initial_sync_days is not None:
+                first_uid = max(first_uid, await self._first_uid_since(status, options.initial_sync_days))
+
+        if first_uid > 1:
+            self._logger.info(f"first run, skipping mailbox history before uid {first_uid}")
+            await self._watermark.skip_to(first_uid - 1)
+
+    async def _first_uid_of_latest(self, status: MailboxStatus, count: int) -> int:
+        # Sequence numbers are dense, so UID of N-th latest message is known without listing the mailbox.
+        if status.exists is None:
+            raise Exception("failed to get messages count from mailbox")
+        if count >= status.exists:
+            return 1
+        if count <= 0:
+            return status.uidnext
+        code, lines = await self._client.fetch(str(status.exists - count + 1), "(UID)")
+        assert_ok(code, "failed to fetch message UID")
         for line in lines:
-            if not line:
-                continue
-            msg_uid = uid_from_fetch_line(line)
-            if msg_uid is None:
-                continue
-            uids.append(msg_uid)
+            uid = uid_from_fetch_line(line) if line else None
+            if uid is not None:
+                return uid
+        raise Exception(f"failed to get UID of message #{status.exists - count + 1}")
+
+    async def _first_uid_since(self, status: MailboxStatus, days: int) -> int:
+        since = datetime.date.today() - datetime.timedelta(days=days)
+        code, lines = await self._client.uid_search("SINCE", since.strftime("%d-%b-%Y"), charset=None)
+        assert_ok(code, "failed to search messages")
+        uids = uids_from_search_response(lines)
+        return min(uids) if uids else status.uidnext
+
+    async def _enable_condstore(self, client: aioimaplib.IMAP4) -> bool:
+        capabilities = client.protocol.capabilities
+        if "CONDSTORE" not in capabilities and "QRESYNC" not in capabilities:
+            self._logger.info("server doesn't support CONDSTORE, using full resync")
+            return False
+        if "ENABLE" in capabilities:
+            code, rsp = await client.enable("CONDSTORE")
+            if code != "OK":
+                self._logger.warning(f"failed to enable CONDSTORE: {rsp}")
+                return False
+        return True
+
+    def _changed_since(self, status: MailboxStatus) -> int | None:
+        if not self._condstore or status.highestmodseq is None or self._mailbox_state is None:
+            return None
+        uidvalidity, modseq = self._mailbox_state
+        if uidvalidity != status.uidvalidity:
+            self._logger.warning(f"mailbox UIDVALIDITY changed ({uidvalidity} -> {status.uidvalidity}), using full resync")
+            return None
+        return modseq
+
+    async def _checkpoint_modseq(self, uid: int, status: MailboxStatus):
+        if not self._condstore or status.highestmodseq is None or status.uidvalidity is None:
+            return
+        self._modseq_checkpoints.append((uid, status.uidvalidity, status.highestmodseq))
+        try:
+            await self._persist_modseq(self._watermark.flushed)
+        except Exception as e:
+            self._logger.error(f"failed to save mailbox state: {e}", exc_info=True)
+
+    async def _persist_modseq(self, flushed_uid: int):
+        """Saves the latest mod-sequence whose messages were all processed and persisted."""
+        state = None
+        while self._modseq_checkpoints and self._modseq_checkpoints[0][0] <= flushed_uid:
+            _, uidvalidity, modseq = self._modseq_checkpoints.popleft()
+            state = (uidvalidity, modseq)
+        if state is None or state == self._mailbox_state:
+            return
+        await self._store.set_mailbox_state(self._config.email_provider.username, *state)
+        self._mailbox_state = state
+
+    async def _fetch_messages_pipelined(self, chunks: list[list[int]]):
+        """Downloads next chunks while already downloaded ones are parsed and queued."""
+        depth = self._config.options.fetch_pipeline_depth
+        downloaded = asyncio.Queue[FetchedChunk | None](depth)
+
+        async def download():
+            for chunk in chunks:
+                await downloaded.put(await self._download_chunk(chunk))
+            await downloaded.put(None)
+
+        async def enqueue():
+            while (chunk := await downloaded.get()) is not None:
+                await self._enqueue_messages(chunk)
 
-        # Bulk fetch messages in chunks. Can't do in parallel due to IMAP protocol limitations.
-        chunk_size = self._config.options.msg_fetch_batch_size
-        for i in range(0, len(uids), chunk_size):
-            # TODO: dead-letter queue for unfetched uids.
-            chunk = uids[i:i + chunk_size]
-            await self._fetch_messages_bulk(chunk)
+        # Failure of any stage cancels the other one.
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(download())
+            tg.create_task(enqueue())
 
     async def _fetch_messages_bulk(self, uids: list[int]):
-        self._logger.debug(f"fetching messages chunk {uids}...")
-        code, msg_data = await self._client.uid("FETCH", ",".join(map(str, uids)), "(RFC822)")
+        chunk = await self._download_chunk(uids)
+        await self._enqueue_messages(chunk)
+
+    async def _download_chunk(self, uids: list[int]) -> FetchedChunk:
+        try:
+            return await self._download_messages(uids)
+        except FetchError as e:
+            if len(uids) == 1:
+                self._logger.error(f"failed to fetch message #{uids[0]}: {e}")
+                await self._dead_letter(uids[0], e)
+                return FetchedChunk(messages=[], skipped_uids=uids)
+            # Single message may fail the whole batch, others are still downloaded.
+            self._logger.warning(f"{e}, fetching messages one by one...")
+            chunks = [await self._download_chunk([uid]) for uid in uids]
+            return FetchedChunk(
+                messages=[m for c in chunks for m in c.messages],
+                skipped_uids=[uid for c in chunks for uid in c.skipped_uids],
+            )
+
+    async def _download_messages(self, uids: list[int]) -> FetchedChunk:
+        # Check headers first to avoid downloading ignored messages with large attachments.
+        accepted, skipped_uids = await self._prefetch_headers(uids)
+        if not accepted:
+            return FetchedChunk(messages=[], skipped_uids=skipped_uids)
+
+        # Download only text part of each message. Requests are grouped by part section.
+        by_section: dict[str, list[FetchedMessage]] = {}
+        for msg in accepted:
+            section = msg.body_part.section if msg.body_part else ""
+            by_section.setdefault(section, []).append(msg)
+
+        for section, msgs in by_section.items():
+            await self._download_bodies(section, msgs)
+        return FetchedChunk(messages=accepted, skipped_uids=skipped_uids)
+
+    async def _download_bodies(self, section: str, msgs: list[FetchedMessage]):
+        uids = [m.uid for m in msgs]
+        self._logger.debug(f"fetching section [{section}] of messages {uids}...")
+        code, lines = await self._client.uid("FETCH", ",".join(map(str, uids)), f"(UID BODY.PEEK[{section}])")
+        if code != "OK":
+            raise FetchError(f"failed to fetch msg batch [{uids[0]}:{uids[-1]}]: {code} {lines}")
+
+        msgs_by_uid = {m.uid: m for m in msgs}
+        item_name = f"BODY[{section}]".encode()
+        for rsp in iter_fetch_responses(lines):
+            msg = msgs_by_uid.get(rsp.uid)
+            body = rsp.get_item(item_name)
+            # Servers may send separate FLAGS updates of the same messages.
+            if msg is not None and body is not None:
+                msg.body = body
+
+    async def _prefetch_headers(self, uids: list[int]) -> tuple[list[FetchedMessage], list[int]]:
+        """Fetches message headers and structure, returns messages to download and UIDs to skip."""
+        query = f"(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({PREFETCH_HEADERS})])"
+        code, lines = await self._client.uid("FETCH", ",".join(map(str, uids)), query)
         if code != "OK":
-            raise Exception(f"failed to fetch msg batch [{uids}:{uids[-1]}]: {code} {msg_data}")
-        for uid, msg in iter_messages(msg_data):
-            await self._update_last_uid(uid)
-            await self._msg_queue.put((uid, msg))
+            raise FetchError(f"failed to fetch headers [{uids[0]}:{uids[-1]}]: {code} {lines}")
+
+        accepted: list[FetchedMessage] = []
+        skipped: list[int] = []
+        total_size = 0
+        for rsp in iter_fetch_responses(lines):
+            raw_headers = rsp.get_item(b"BODY[HEADER")
+            if raw_headers is None:
+                continue
+            headers = parse_header_literal(raw_headers)
+            sender = Contact.parse(headers.get("From", ""))
+            if self._is_ignored_sender(sender.email):
+                self._logger.debug(f"skipping message #{rsp.uid} from {sender.email} ({rsp.size} bytes)")
+                skipped.append(rsp.uid)
+                continue
 
-    async def _idle_loop(self):
-        idle_timeout = self._config.email_provider.idle_timeout
-        while self._running:
+            msg = FetchedMessage(uid=rsp.uid, size=rsp.size or 0, headers=raw_headers)
             try:
-                await self._client.idle_start(timeout=idle_timeout)
-                push = await self._client.wait_server_push()
-                self._client.idle_done()
-
-                if not is_server_push_exists_result(push):
+                msg.body_part = find_text_part(parse_bodystructure(rsp.attrs))
+            except Exception as e:
+                # Download the whole message as a fallback.
+                self._logger.warning(f"failed to parse BODYSTRUCTURE of message #{rsp.uid}: {e}")
+            else:
+                if msg.body_part is None:
+                    self._logger.warning(
+                        f"no text body found in message from {sender.email} (#{rsp.uid}), skipping..."
+                    )
+                    skipped.append(rsp.uid)
                     continue
 
-                await self._fetch_messages()
+            accepted.append(msg)
+            total_size += msg.body_part.size if msg.body_part else msg.size
+
+        self._logger.debug(f"accepted {len(accepted)} of {len(uids)} messages ({total_size} bytes to download)")
+        return accepted, skipped
+
+    async def _enqueue_messages(self, chunk: FetchedChunk):
+        # Whole chunk is submitted to the pool at once, each message is queued as soon as it's parsed.
+        parse_results = None
+        if self._parse_pool:
+            loop = asyncio.get_running_loop()
+            parse_results = [
+                loop.run_in_executor(self._parse_pool, parse_fetched_message, m)
+                for m in chunk.messages
+            ]
+
+        # Filtered messages are tracked together with downloaded ones to keep UIDs order.
+        skipped = deque(chunk.skipped_uids)
+        for i, fetched_msg in enumerate(chunk.messages):
+            while skipped and skipped[0] < fetched_msg.uid:
+                await self._skip_message(skipped.popleft())
+            try:
+                if parse_results:
+                    msg = await parse_results[i]
+                else:
+                    msg = parse_fetched_message(fetched_msg)
             except Exception as e:
-                self._logger.error(f"Error in IMAP idle loop: {e}", exc_info=True)
-                await self._connect()
+                self._logger.error(f"failed to parse message #{fetched_msg.uid}: {e}", exc_info=True)
+                await self._dead_letter(fetched_msg.uid, e)
+                await self._skip_message(fetched_msg.uid)
+                continue
+            if not self._watermark.track(msg.uid):
+                continue
+            await self._msg_queue.put(msg)
+            self._fetched_arrivals.append(msg.sent_at.timestamp())
+            if self._msg_queue.durable:
+                # Message is persisted in the queue, no need to fetch it again after restart.
+                await self._ack_message(msg.uid)
 
-    async def _start_consumers(self):
-        for i in range(self._config.options.worker_count):
-            asyncio.create_task(self._listen_queue(i))
+        while skipped:
+            await self._skip_message(skipped.popleft())
+
+    async def _dead_letter(self, uid: int, err: Exception):
+        if not self._dead_letters:
+            return
+        email_cfg = self._config.email_provider
+        # Message stays in the mailbox, so it's referenced by UID.
+        payload = json.dumps({"email": email_cfg.username, "mailbox": email_cfg.mailbox, "uid": uid})
+        try:
+            await self._dead_letters.dead_letter(RetryTask(LISTENER_DEAD_LETTER_STAGE, payload, attempt=0, error=str(err)))
+        except Exception as e:
+            self._logger.error(f"failed to move message #{uid} to dead letter queue: {e}", exc_info=True)
+
+    async def _skip_message(self, uid: int):
+        if self._watermark.track(uid):
+            await self._ack_message(uid)
 
-    async def _listen_queue(self, worker_id: int):
-        self._logger.info(f"starting consumer #{worker_id}...")
+    async def _idle_loop(self):
+        """Waits for server pushes on the IDLE connection and signals the fetch loop about new messages."""
+        idle_timeout = self._config.email_provider.idle_timeout
         while self._running:
-            msg_uid, msg = await self._msg_queue.get()
             try:
-                await self._handle_message(msg_uid, msg)
-            except Exception as e:
-                self._logger.error(
-                    f"worker#{worker_id}: cannot handle message #{msg_uid}: {e}",
-                    exc_info=True,
-                )
+                await self._idle_client.idle_start(timeout=idle_timeout)
+                push = await self._idle_client.wait_server_push()
+                self._idle_client.idle_done()
 
-    async def _handle_message(self, uid: int, msg: message.Message):
-        sender = Contact.parse(msg.get("From", ""))
+                if is_server_push_exists_result(push):
+                    self._signal_change("push")
+            except Exception as e:
+                self._logger.error(f"Error in IMAP idle loop: {e}", exc_info=True)
+                await self._connect_idle()
+                # Pushes might be lost while reconnecting.
+                self._signal_change("resync")
 
-        # HACK: ignore messages from myself.
-        if sender.email == self._config.email_provider.username:
-            return
+    async def _fetch_loop(self):
+        """Fetches new messages on the fetch connection each time the mailbox is reported as changed."""
+        while self._running:
+            wait_timeout = self._poll_interval.value if self._poll_interval else self._config.email_provider.idle_timeout
+            with suppress(TimeoutError):
+                await asyncio.wait_for(self._mailbox_changed.wait(), timeout=wait_timeout)
+            try:
+                if not self._mailbox_changed.is_set():
+                    await self._poll_status()
+                if not self._mailbox_changed.is_set():
+                    continue
 
-        if sender.email in self._config.options.ignore_addresses:
-            self._logger.info(f"ignoring message from {sender.email}")
+                # Changes signaled during a fetch are coalesced into the next one.
+                self._mailbox_changed.clear()
+                source, self._change_source = self._change_source, None
+                detected_at, self._detected_at = self._detected_at, None
+                self._fetched_arrivals = []
+                await self._fetch_messages()
+                # Resyncs catch up on changes which may be old, they'd skew the latency.
+                if source in ("push", "poll"):
+                    self._observe_arrivals(source, detected_at)
+            except Exception as e:
+                self._logger.error(f"Error in IMAP fetch loop: {e}", exc_info=True)
+                await self._connect()
+                self._signal_change("resync")
+
+    def _signal_change(self, source: str):
+        # The earliest signal of a change is the one which detected it.
+        if not self._mailbox_changed.is_set():
+            self._change_source = source
+            self._detected_at = time.time()
+            self._mailbox_changed.set()
+
+    async def _poll_status(self):
+        """Keeps the fetch connection alive and checks mailbox UIDNEXT with STATUS if polling is enabled."""
+        # Servers drop inactive connections, keep fetch connection alive while mailbox is quiet.
+        code, _ = await self._client.noop()
+        assert_ok(code, "NOOP failed")
+        if self._poll_interval is None:
             return
 
-        receiver = Contact.parse(msg.get("To", ""))
-        subject = msg.get("Subject", "")
-        sent_at = parsedate_to_datetime(msg.get("Date", ""))
-        body = parse_msg_payload(msg)
-        headers = parse_message_headers(msg)
-
-        if not body:
-            self._logger.warning(
-                f"no body found in message from {sender.email} (#{uid}), skipping..."
-            )
+        # Failure of the STATUS connection doesn't affect the fetch connection, only STATUS one is reopened.
+        try:
+            if self._status_client is None:
+                self._status_client = await self._open_connection("STATUS")
+            code, lines = await self._status_client.status(self._config.email_provider.mailbox, "(UIDNEXT)")
+            assert_ok(code, "failed to get mailbox status")
+        except Exception as e:
+            self._logger.error(f"failed to poll mailbox status, reconnecting on the next poll: {e}", exc_info=True)
+            await self._close_client(self._status_client)
+            self._status_client = None
             return
-
-        m = Message(
-            uid=uid,
-            sender=sender, 
-            receiver=receiver, 
-            subject=subject, 
-            body=body, 
-            sent_at=sent_at, 
-            headers=headers,
-        )
-        await self._consumer.consume_mail(m)
+        uidnext = uidnext_from_status_response(lines)
+        if uidnext is not None and self._uidnext is not None and uidnext > self._uidnext:
+            self._signal_change("poll")
+        else:
+            self._poll_interval.quiet()
+
+    def _observe_arrivals(self, source: str, detected_at: float):
+        """Records delay between Date header and detection of messages queued by the last fetch."""
+        for sent_at in self._fetched_arrivals:
+            self._arrival_metrics.observe(source, detected_at - sent_at)
+        if self._fetched_arrivals:
+            self._logger.info(f"message arrival latency: {self._arrival_metrics.summary()}")
+
+    async def _ack_message(self, uid: int):
+        try:
+            await self._watermark.ack(uid)
+        except Exception as e:
+            self._logger.error(f"failed to save last UID after message #{uid}: {e}", exc_info=True)
+
+    def _is_ignored_sender(self, email: str) -> bool:
+        # HACK: ignore messages from myself.
+        if email == self._config.email_provider.username:
+            return True
+        return email in self._config.options.ignore_addresses
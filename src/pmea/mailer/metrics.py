@@ -0,0 +1,62 @@
+"""In-process counters of mailer internals, reported through logs."""
+from dataclasses import dataclass
+
+
+@dataclass
+class LatencyStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def observe(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self) -> str:
+        return f"n={self.count} mean={self.mean:.1f}s max={self.max:.1f}s"
+
+
+@dataclass
+class QueueMetrics:
+    """Sizes of a byte-budgeted queue. Sizes are approximate, see `SpillingMessageQueue`."""
+    # Messages in memory, including taken ones which aren't acknowledged yet.
+    memory_bytes: int = 0
+    spilled_bytes: int = 0
+    # Number of spilled messages which weren't read back yet.
+    spill_depth: int = 0
+    put_count: int = 0
+    spilled_count: int = 0
+
+    @property
+    def spill_rate(self) -> float:
+        """Share of queued messages which were spilled to disk."""
+        return self.spilled_count / self.put_count if self.put_count else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"memory={self.memory_bytes}B spilled={self.spilled_bytes}B spill_depth={self.spill_depth} "
+            f"spill_rate={self.spill_rate:.1%} ({self.spilled_count}/{self.put_count})"
+        )
+
+
+class ArrivalMetrics:
+    """Delay between message arrival and its detection, grouped by the way it was detected."""
+    _stats: dict[str, LatencyStats]
+
+    def __init__(self):
+        self._stats = {}
+
+    def observe(self, source: str, latency: float) -> None:
+        # Sender clock may be ahead of ours.
+        self._stats.setdefault(source, LatencyStats()).observe(max(latency, 0.0))
+
+    def get(self, source: str) -> LatencyStats:
+        return self._stats.get(source, LatencyStats())
+
+    def summary(self) -> str:
+        return ", ".join(f"{source}: {stats}" for source, stats in sorted(self._stats.items()))
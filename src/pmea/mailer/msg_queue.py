@@ -0,0 +1,471 @@
+"""Incoming messages queue backends."""
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from itertools import batched
+import logging
+import os
+import tempfile
+import time
+from typing import IO, Awaitable, Callable, Protocol
+import redis.asyncio as aioredis
+from redis.commands.core import AsyncScript
+from redis.exceptions import ResponseError
+from ..repository.keys import is_cluster
+from .leader import Fence
+from .metrics import QueueMetrics
+from .retry import DelayQueue, RetryTask
+from .types import ParsedMessage
+
+STREAM_FIELD_MSG = "msg"
+# Stream entries are processed by "consume" stage, its dead letter queue keeps malformed entries.
+STREAM_DEAD_LETTER_STAGE = "consume"
+
+# Adds a message and advances last UID (KEYS[3]) to its UID (ARGV[4]) in one step, so a new leader
+# doesn't queue again messages which were added after the last watermark flush.
+FENCED_XADD_LUA = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+  return redis.error_reply('FENCED fencing token is stale')
+end
+local id = redis.call('XADD', KEYS[1], '*', ARGV[2], ARGV[3])
+local current = redis.call('GET', KEYS[3])
+if (not current) or (tonumber(ARGV[4]) > tonumber(current)) then
+  redis.call('SET', KEYS[3], ARGV[4])
+end
+return id
+"""
+
+
+@dataclass
+class QueueEntry:
+    """Message taken from the queue. Has to be acknowledged after processing."""
+    entry_id: str
+    msg: ParsedMessage
+
+    # Set if message is retried after failure. Retries are tracked by RetryDispatcher instead of the queue.
+    retry: RetryTask | None = None
+
+
+class MessageQueue(Protocol):
+    """Abstract interface of incoming messages queue."""
+
+    @property
+    def durable(self) -> bool:
+        """Whether queued messages survive process restart."""
+
+    async def put(self, msg: ParsedMessage) -> None:
+        """Adds message to the queue. May block if queue is full."""
+
+    async def get(self) -> QueueEntry:
+        """Waits and takes next message from the queue."""
+
+    async def ack(self, entry: QueueEntry) -> None:
+        """Marks message as processed."""
+
+    async def stats(self) -> str | None:
+        """Returns a summary of queue state for periodic reports (None - nothing to report)."""
+
+
+class InMemoryMessageQueue(MessageQueue):
+    """Bounded in-process queue. Messages are lost on restart, acks are reported to a callback."""
+    _queue: asyncio.Queue[ParsedMessage]
+    _on_ack: Callable[[int], Awaitable[None]]
+
+    def __init__(self, maxsize: int, on_ack: Callable[[int], Awaitable[None]]):
+        self._queue = asyncio.Queue[ParsedMessage](maxsize)
+        self._on_ack = on_ack
+
+    @property
+    def durable(self) -> bool:
+        return False
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def put(self, msg: ParsedMessage) -> None:
+        await self._queue.put(msg)
+
+    async def get(self) -> QueueEntry:
+        msg = await self._queue.get()
+        return QueueEntry(entry_id=str(msg.uid), msg=msg)
+
+    async def ack(self, entry: QueueEntry) -> None:
+        await self._on_ack(entry.msg.uid)
+
+    async def stats(self) -> str | None:
+        return f"size={self.qsize()}"
+
+
+def message_size(msg: ParsedMessage) -> int:
+    """Approximate memory footprint of a queued message, dominated by its text body."""
+    return len(msg.body or "") + len(msg.subject)
+
+
+@dataclass
+class SpillSegment:
+    path: str
+    size: int = 0
+    # Number of messages which weren't read back yet.
+    count: int = 0
+
+
+class SpillingMessageQueue(MessageQueue):
+    """
+    In-process queue bounded by total size of messages kept in memory.
+
+    Taken messages stay in the budget until they're acknowledged, as they're kept in worker queues
+    and by workers meanwhile. Messages which don't fit into `max_bytes` are appended to segment files
+    on disk and read back in order once the budget allows. Segments are removed as soon as they're read.
+    Like in `InMemoryMessageQueue`, messages are lost on restart and acks are reported to a callback.
+    """
+    _max_bytes: int
+    _max_spill_bytes: int | None
+    _segment_size: int
+    _spill_dir: str | None
+    _on_ack: Callable[[int], Awaitable[None]]
+    _memory: deque[tuple[ParsedMessage, int]]
+    # Sizes of taken messages which aren't acknowledged yet, by entry ID.
+    _taken: dict[str, int]
+    _segments: deque[SpillSegment]
+    _writer: IO[bytes] | None = None
+    _reader: IO[bytes] | None = None
+    _segments_dir: str | None = None
+    _segment_seq: int = 0
+    # Set when a message is added or budget is released, `get` checks whether it can proceed.
+    _not_empty: asyncio.Event
+    _not_full: asyncio.Event
+    _metrics: QueueMetrics
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        max_bytes: int,
+        on_ack: Callable[[int], Awaitable[None]],
+        spill_dir: str | None = None,
+        segment_size: int = 64 * 1024 * 1024,
+        max_spill_bytes: int | None = None,
+    ):
+        """`put` blocks while spilled messages take more than `max_spill_bytes` on disk (if set)."""
+        self._max_bytes = max_bytes
+        self._max_spill_bytes = max_spill_bytes
+        self._segment_size = segment_size
+        self._spill_dir = spill_dir
+        self._on_ack = on_ack
+        self._memory = deque()
+        self._taken = {}
+        self._segments = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._metrics = QueueMetrics()
+
+    @property
+    def durable(self) -> bool:
+        return False
+
+    @property
+    def metrics(self) -> QueueMetrics:
+        return self._metrics
+
+    def qsize(self) -> int:
+        return len(self._memory) + sum(s.count for s in self._segments)
+
+    async def put(self, msg: ParsedMessage) -> None:
+        size = message_size(msg)
+        self._metrics.put_count += 1
+        # Once anything is spilled, new messages follow it to the disk to keep the order.
+        if not self._segments and self._metrics.memory_bytes + size <= self._max_bytes:
+            self._memory.append((msg, size))
+            self._metrics.memory_bytes += size
+        else:
+            while self._max_spill_bytes is not None and self._metrics.spilled_bytes >= self._max_spill_bytes:
+                self._not_full.clear()
+                await self._not_full.wait()
+            if not self._segments:
+                self._logger.warning(f"queue memory budget is exceeded, spilling messages to disk: {self._metrics}")
+            self._spill(msg)
+        self._not_empty.set()
+
+    async def get(self) -> QueueEntry:
+        while not self._can_get():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        if self._memory:
+            msg, size = self._memory.popleft()
+        else:
+            msg = self._read_spilled()
+            size = message_size(msg)
+            self._metrics.memory_bytes += size
+            self._not_full.set()
+        entry = QueueEntry(entry_id=str(msg.uid), msg=msg)
+        self._taken[entry.entry_id] = size
+        return entry
+
+    async def ack(self, entry: QueueEntry) -> None:
+        size = self._taken.pop(entry.entry_id, None)
+        if size is not None:
+            self._metrics.memory_bytes -= size
+            self._not_empty.set()
+        await self._on_ack(entry.msg.uid)
+
+    async def stats(self) -> str | None:
+        return str(self._metrics)
+
+    def _can_get(self) -> bool:
+        if self._memory:
+            return True
+        # Spilled message is read back once the budget is released, or if nothing else is in memory.
+        return bool(self._segments) and (not self._taken or self._metrics.memory_bytes < self._max_bytes)
+
+    def _spill(self, msg: ParsedMessage):
+        if not self._segments or self._segments[-1].size >= self._segment_size:
+            self._open_segment()
+        segment = self._segments[-1]
+        data = msg.to_json().encode() + b"\n"
+        self._writer.write(data)
+        # Reader uses a separate file handle.
+        self._writer.flush()
+        segment.size += len(data)
+        segment.count += 1
+        self._metrics.spilled_bytes += len(data)
+        self._metrics.spilled_count += 1
+        self._metrics.spill_depth += 1
+
+    def _open_segment(self):
+        if self._writer:
+            self._writer.close()
+        if self._segments_dir is None:
+            self._segments_dir = tempfile.mkdtemp(prefix="pmea-queue-", dir=self._spill_dir)
+        self._segment_seq += 1
+        path = os.path.join(self._segments_dir, f"segment-{self._segment_seq:08d}.jsonl")
+        self._writer = open(path, "ab")
+        self._segments.append(SpillSegment(path))
+
+    def _read_spilled(self) -> ParsedMessage:
+        segment = self._segments[0]
+        if self._reader is None:
+            self._reader = open(segment.path, "rb")
+        line = self._reader.readline()
+        segment.count -= 1
+        self._metrics.spilled_bytes -= len(line)
+        self._metrics.spill_depth -= 1
+        if segment.count == 0:
+            self._close_segment()
+        return ParsedMessage.from_json(line)
+
+    def _close_segment(self):
+        segment = self._segments.popleft()
+        self._reader.close()
+        self._reader = None
+        if not self._segments:
+            # Last segment is fully read, new messages fit into memory again.
+            self._writer.close()
+            self._writer = None
+            self._logger.info(f"spilled messages are drained: {self._metrics}")
+        os.remove(segment.path)
+
+
+class RedisStreamQueue(MessageQueue):
+    """
+    Durable queue on top of Redis Streams consumer group.
+
+    Any number of processes can consume the same stream. Entries which weren't acknowledged
+    by a consumer for `claim_idle` seconds (e.g. process crashed) are reclaimed by other consumers.
+    Malformed entries are acknowledged and moved to the dead letter queue of `dead_letters` (if set).
+
+    Entries taken by this consumer may wait in worker queues or be processed for longer than `claim_idle`,
+    `keep_claimed` periodically resets their idle time, so they aren't reclaimed while they're still in progress.
+    """
+    _redis_client: aioredis.Redis
+    _stream_key: str
+    _group: str
+    _consumer_name: str
+    _claim_idle_ms: int
+    _read_count: int
+    _block_ms: int
+    _buffer: deque[QueueEntry]
+    # Entries read by this consumer which aren't acknowledged yet.
+    _in_progress: set[str]
+    _fence: Fence | None
+    _last_uid_key: str | None
+    _dead_letters: DelayQueue | None
+    _fenced_xadd_script: AsyncScript | None = None
+    _claim_cursor: str = "0-0"
+    _last_claim_at: float = 0
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        redis_client: aioredis.Redis,
+        stream_key: str,
+        group: str,
+        consumer_name: str,
+        claim_idle: float,
+        read_count: int,
+        block_timeout: float = 5,
+        fence: Fence | None = None,
+        last_uid_key: str | None = None,
+        dead_letters: DelayQueue | None = None,
+    ):
+        """
+        If `fence` is set - messages are added only while fencing token matches the lease,
+        and last UID stored in `last_uid_key` is advanced to UID of each added message.
+        """
+        self._redis_client = redis_client
+        self._stream_key = stream_key
+        self._group = group
+        self._consumer_name = consumer_name
+        self._claim_idle_ms = int(claim_idle * 1000)
+        self._read_count = read_count
+        self._block_ms = int(block_timeout * 1000)
+        self._buffer = deque()
+        self._in_progress = set()
+        self._fence = fence
+        self._last_uid_key = last_uid_key
+        self._dead_letters = dead_letters
+        if fence:
+            self._fenced_xadd_script = redis_client.register_script(FENCED_XADD_LUA)
+
+    @property
+    def durable(self) -> bool:
+        return True
+
+    def with_fence(self, fence: Fence, last_uid_key: str) -> "RedisStreamQueue":
+        """
+        Returns a copy of the queue which adds messages only while fencing token is valid.
+        Last UID is advanced together with each added message, the key has to share a slot with the lease.
+        """
+        return RedisStreamQueue(
+            self._redis_client,
+            stream_key=self._stream_key,
+            group=self._group,
+            consumer_name=self._consumer_name,
+            claim_idle=self._claim_idle_ms / 1000,
+            read_count=self._read_count,
+            block_timeout=self._block_ms / 1000,
+            fence=fence,
+            last_uid_key=last_uid_key,
+            dead_letters=self._dead_letters,
+        )
+
+    async def ensure_group(self) -> None:
+        """Creates stream and consumer group if they don't exist."""
+        try:
+            await self._redis_client.xgroup_create(self._stream_key, self._group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def put(self, msg: ParsedMessage) -> None:
+        if self._fence:
+            await self._fenced_xadd_script(
+                keys=[self._stream_key, self._fence.lease_key, self._last_uid_key],
+                args=[self._fence.token, STREAM_FIELD_MSG, msg.to_json(), msg.uid],
+            )
+            return
+        await self._redis_client.xadd(self._stream_key, {STREAM_FIELD_MSG: msg.to_json()})
+
+    async def get(self) -> QueueEntry:
+        while not self._buffer:
+            await self._fill_buffer()
+        return self._buffer.popleft()
+
+    async def ack(self, entry: QueueEntry) -> None:
+        try:
+            await self._ack_entry(entry.entry_id)
+        finally:
+            # Entry which failed to be acknowledged is left to be reclaimed.
+            self._in_progress.discard(entry.entry_id)
+
+    async def keep_claimed(self) -> None:
+        """Resets idle time of entries in progress every third of `claim_idle`."""
+        while True:
+            await asyncio.sleep(self._claim_idle_ms / 3000)
+            try:
+                await self._touch_in_progress()
+            except Exception as e:
+                self._logger.error(f"failed to refresh claims of messages in progress: {e}", exc_info=True)
+
+    async def stats(self) -> str | None:
+        # Pending entries are delivered to any consumer of the group, but not acknowledged yet.
+        info = await self._redis_client.xpending(self._stream_key, self._group)
+        return f"pending={info['pending']} in_progress={len(self._in_progress)}"
+
+    async def _fill_buffer(self) -> None:
+        # Stalled entries are checked periodically, not on every read.
+        now = time.monotonic()
+        if (now - self._last_claim_at) * 1000 >= self._claim_idle_ms / 2:
+            self._last_claim_at = now
+            if await self._claim_stalled():
+                return
+
+        rsp = await self._redis_client.xreadgroup(
+            self._group,
+            self._consumer_name,
+            {self._stream_key: ">"},
+            count=self._read_count,
+            block=self._block_ms,
+        )
+        for _, entries in rsp or []:
+            await self._add_entries(entries)
+
+    async def _claim_stalled(self) -> bool:
+        next_cursor, entries, *_ = await self._redis_client.xautoclaim(
+            self._stream_key,
+            self._group,
+            self._consumer_name,
+            min_idle_time=self._claim_idle_ms,
+            start_id=self._claim_cursor,
+            count=self._read_count,
+        )
+        self._claim_cursor = next_cursor.decode() if isinstance(next_cursor, bytes) else next_cursor
+        if entries:
+            self._logger.warning(f"reclaimed {len(entries)} stalled messages from {self._stream_key}")
+        return await self._add_entries(entries) > 0
+
+    async def _add_entries(self, entries: list[tuple[bytes, dict[bytes, bytes]]]) -> int:
+        added = 0
+        for entry_id, fields in entries:
+            if not entry_id or not fields:
+                continue
+            entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+            if entry_id in self._in_progress:
+                # Reclaimed before its idle time was refreshed, the entry is already taken by this consumer.
+                continue
+            raw_msg = fields.get(STREAM_FIELD_MSG.encode()) or fields.get(STREAM_FIELD_MSG)
+            try:
+                msg = ParsedMessage.from_json(raw_msg)
+            except Exception as e:
+                self._logger.error(f"malformed stream entry {entry_id}: {e}")
+                await self._reject_entry(entry_id, raw_msg, e)
+                continue
+            self._buffer.append(QueueEntry(entry_id=entry_id, msg=msg))
+            self._in_progress.add(entry_id)
+            added += 1
+        return added
+
+    async def _touch_in_progress(self) -> None:
+        # XCLAIM resets idle time, JUSTID keeps delivery counters. Acknowledged entries are ignored by Redis.
+        for entry_ids in batched(list(self._in_progress), 100):
+            await self._redis_client.xclaim(
+                self._stream_key,
+                self._group,
+                self._consumer_name,
+                min_idle_time=0,
+                message_ids=list(entry_ids),
+                justid=True,
+            )
+
+    async def _reject_entry(self, entry_id: str, raw_msg: bytes | str | None, err: Exception) -> None:
+        # Acknowledged entry isn't reclaimed again, so it's dead-lettered first.
+        if self._dead_letters:
+            payload = raw_msg.decode(errors="replace") if isinstance(raw_msg, bytes) else raw_msg or ""
+            await self._dead_letters.dead_letter(RetryTask(STREAM_DEAD_LETTER_STAGE, payload, attempt=0, error=str(err)))
+        await self._ack_entry(entry_id)
+
+    async def _ack_entry(self, entry_id: str) -> None:
+        # Entry is consumed by a single group, so it can be removed to keep stream short.
+        async with self._redis_client.pipeline(transaction=not is_cluster(self._redis_client)) as p:
+            p.xack(self._stream_key, self._group, entry_id)
+            p.xdel(self._stream_key, entry_id)
+            await p.execute()
@@ -0,0 +1,127 @@
+"""Outgoing messages rate limiting."""
+import time
+from typing import Callable
+from ..config import SendRateLimit
+
+SECONDS_PER_MINUTE = 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Refill rate multiplier bounds and its additive recovery step after each delivered message.
+MIN_RATE_FACTOR = 0.1
+RATE_FACTOR_STEP = 0.05
+
+
+class TokenBucket:
+    """Bucket of `capacity` tokens refilled evenly over `period` seconds."""
+    _capacity: float
+    _period: float
+    _tokens: float
+    _updated_at: float
+
+    def __init__(self, capacity: int, period: float, now: float):
+        self._capacity = capacity
+        self._period = period
+        self._tokens = capacity
+        self._updated_at = now
+
+    @property
+    def capacity(self) -> int:
+        return int(self._capacity)
+
+    @property
+    def period(self) -> float:
+        return self._period
+
+    @property
+    def remaining(self) -> int:
+        return int(self._tokens)
+
+    def refill(self, now: float, rate_factor: float):
+        rate = self._capacity / self._period * rate_factor
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * rate)
+        self._updated_at = now
+
+    def wait_time(self, rate_factor: float) -> float:
+        """Seconds until a token is available. Bucket has to be refilled first."""
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) * self._period / (self._capacity * rate_factor)
+
+    def take(self):
+        self._tokens -= 1
+
+    def give_back(self):
+        self._tokens = min(self._capacity, self._tokens + 1)
+
+
+class SendRateLimiter:
+    """
+    Token bucket limits of outgoing messages with separate budgets per message kind.
+
+    Once server throttles a message, sending is paused for `throttle_pause` seconds and budgets are
+    refilled slower (multiplicative decrease). Each delivered message speeds refill up back again.
+    """
+    _buckets: dict[str, list[TokenBucket]]
+    _throttle_pause: float
+    _clock: Callable[[], float]
+    _rate_factor: float = 1.0
+    _paused_until: float = 0
+
+    def __init__(
+        self,
+        limits: dict[str, SendRateLimit],
+        throttle_pause: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._throttle_pause = throttle_pause
+        self._clock = clock
+        now = clock()
+        self._buckets = {}
+        for kind, limit in limits.items():
+            buckets = []
+            if limit.per_minute:
+                buckets.append(TokenBucket(limit.per_minute, SECONDS_PER_MINUTE, now))
+            if limit.per_day:
+                buckets.append(TokenBucket(limit.per_day, SECONDS_PER_DAY, now))
+            self._buckets[kind] = buckets
+
+    def reserve(self, kind: str) -> float:
+        """Takes a token of each budget of a kind. Returns 0 on success or seconds to wait before trying again."""
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        buckets = self._buckets.get(kind, [])
+        for bucket in buckets:
+            bucket.refill(now, self._rate_factor)
+        wait = max((b.wait_time(self._rate_factor) for b in buckets), default=0)
+        if wait > 0:
+            return wait
+        for bucket in buckets:
+            bucket.take()
+        return 0
+
+    def refund(self, kind: str):
+        """Returns tokens taken by `reserve` for a message which wasn't sent."""
+        for bucket in self._buckets.get(kind, []):
+            bucket.give_back()
+
+    def throttled(self):
+        self._rate_factor = max(MIN_RATE_FACTOR, self._rate_factor / 2)
+        self._paused_until = self._clock() + self._throttle_pause
+
+    def delivered(self):
+        self._rate_factor = min(1.0, self._rate_factor + RATE_FACTOR_STEP)
+
+    def status(self) -> str:
+        """Remaining budgets, e.g. 'reply: 18/20 per 60s, 480/500 per 86400s'."""
+        now = self._clock()
+        parts = []
+        for kind, buckets in self._buckets.items():
+            for bucket in buckets:
+                bucket.refill(now, self._rate_factor)
+            budgets = ", ".join(f"{b.remaining}/{b.capacity} per {b.period:.0f}s" for b in buckets) or "unlimited"
+            parts.append(f"{kind}: {budgets}")
+        if self._rate_factor < 1:
+            parts.append(f"refill rate {self._rate_factor:.0%}")
+        return "; ".join(parts)
@@ -0,0 +1,228 @@
+"""Delayed retries of failed processing stages and dead letter queue."""
+import asyncio
+from contextlib import suppress
+from dataclasses import asdict, dataclass
+import json
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Protocol, Self
+import redis.asyncio as aioredis
+from redis.commands.core import AsyncScript
+from ..config import RetryPolicy
+from ..repository.keys import hash_tagged, is_cluster
+
+REDIS_KEY_PREFIX_RETRY = "retry:"
+REDIS_KEY_PREFIX_DLQ = "dlq:"
+
+# Claimed tasks stay in the set with a lease deadline, so they're retried again if a process dies.
+CLAIM_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, member in ipairs(due) do
+  redis.call('ZADD', KEYS[1], ARGV[2], member)
+end
+return due
+"""
+
+
+@dataclass
+class RetryTask:
+    """Failed unit of work waiting for the next attempt."""
+    stage: str
+    payload: str
+    attempt: int
+    error: str | None = None
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, sort_keys=True)
+
+    @staticmethod
+    def from_json(raw: str | bytes) -> Self:
+        return RetryTask(**json.loads(raw))
+
+
+def backoff_delay(policy: RetryPolicy, attempt: int) -> float | None:
+    """
+    Returns delay in seconds before the next attempt after `attempt` failed attempts,
+    or None if attempts are exhausted. Uses exponential backoff with "equal jitter".
+    """
+    if attempt >= policy.max_attempts:
+        return None
+    delay = min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class DelayQueue(Protocol):
+    """Abstract storage of delayed tasks ordered by due time."""
+
+    async def schedule(self, task: RetryTask, due_at: float, replaces: RetryTask | None = None) -> None:
+        """Adds task to be retried after `due_at` timestamp. Replaced task is removed."""
+
+    async def claim_due(self, stage: str, now: float, lease: float, limit: int) -> list[RetryTask]:
+        """Returns due tasks of a stage and hides them for `lease` seconds."""
+
+    async def remove(self, task: RetryTask) -> None:
+        """Removes completed task."""
+
+    async def dead_letter(self, task: RetryTask, replaces: RetryTask | None = None) -> None:
+        """Adds task to the dead letter queue of its stage. Replaced task is removed."""
+
+
+class RedisDelayQueue(DelayQueue):
+    """
+    Delay queue stored in Redis sorted sets scored by due time.
+
+    On Redis Cluster keys get `hash_tag`, so a replaced task and its successor are stored on the same node.
+    Commands are sent in order without a transaction, a task may be duplicated but is never lost.
+    """
+    _redis_client: aioredis.Redis
+    _claim_due_script: AsyncScript
+    _transaction: bool
+    _hash_tag: str | None
+
+    def __init__(self, redis_client: aioredis.Redis, hash_tag: str | None = None):
+        self._redis_client = redis_client
+        self._claim_due_script = self._redis_client.register_script(CLAIM_DUE_LUA)
+        self._transaction = not is_cluster(redis_client)
+        self._hash_tag = None if self._transaction else hash_tag
+
+    async def schedule(self, task: RetryTask, due_at: float, replaces: RetryTask | None = None) -> None:
+        key = self._key(REDIS_KEY_PREFIX_RETRY, task.stage)
+        member = task.to_json()
+        async with self._redis_client.pipeline(transaction=self._transaction) as p:
+            p.zadd(key, {member: due_at})
+            if replaces and replaces.to_json() != member:
+                p.zrem(key, replaces.to_json())
+            await p.execute()
+
+    async def claim_due(self, stage: str, now: float, lease: float, limit: int) -> list[RetryTask]:
+        key = self._key(REDIS_KEY_PREFIX_RETRY, stage)
+        members = await self._claim_due_script(keys=[key], args=[now, now + lease, limit])
+        return [RetryTask.from_json(m) for m in members]
+
+    async def remove(self, task: RetryTask) -> None:
+        await self._redis_client.zrem(self._key(REDIS_KEY_PREFIX_RETRY, task.stage), task.to_json())
+
+    async def dead_letter(self, task: RetryTask, replaces: RetryTask | None = None) -> None:
+        async with self._redis_client.pipeline(transaction=self._transaction) as p:
+            p.rpush(self._key(REDIS_KEY_PREFIX_DLQ, task.stage), task.to_json())
+            if replaces:
+                p.zrem(self._key(REDIS_KEY_PREFIX_RETRY, task.stage), replaces.to_json())
+            await p.execute()
+
+    def _key(self, prefix: str, stage: str) -> str:
+        return hash_tagged(f"{prefix}{stage}", self._hash_tag)
+
+
+class RetryDispatcher:
+    """
+    Schedules retries of a single processing stage and hands due tasks over to a handler.
+
+    Handler takes ownership of a task and has to report its outcome with `done` or `failed`.
+    Tasks which weren't reported within `lease` seconds are handed over again.
+
+    Stage may be used as a durable work queue as well: `enqueue` schedules the first attempt immediately.
+    """
+    _delay_queue: DelayQueue
+    _stage: str
+    _policy: RetryPolicy
+    _lease: float
+    _poll_interval: float
+    _claim_count: int
+    _wakeup: asyncio.Event
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        delay_queue: DelayQueue,
+        stage: str,
+        policy: RetryPolicy,
+        lease: float,
+        poll_interval: float,
+        claim_count: int,
+    ):
+        self._delay_queue = delay_queue
+        self._stage = stage
+        self._policy = policy
+        self._lease = lease
+        self._poll_interval = poll_interval
+        self._claim_count = claim_count
+        self._wakeup = asyncio.Event()
+
+    @property
+    def stage(self) -> str:
+        return self._stage
+
+    async def enqueue(self, payload: str) -> None:
+        """Schedules the first attempt of a task to run as soon as possible."""
+        await self._delay_queue.schedule(RetryTask(self._stage, payload, attempt=0), time.time())
+        self._wakeup.set()
+
+    async def submit(self, payload: str, err: Exception) -> bool:
+        """Schedules a retry after the first failed attempt. Returns False if task was dead-lettered."""
+        return await self._reschedule(RetryTask(self._stage, payload, attempt=0), err)
+
+    async def failed(self, task: RetryTask, err: Exception) -> bool:
+        """Schedules next attempt of a task. Returns False if task was dead-lettered."""
+        return await self._reschedule(task, err, replaces=task)
+
+    async def postpone(self, task: RetryTask, delay: float) -> None:
+        """Puts task back to run after `delay` seconds without counting it as a failed attempt."""
+        await self._delay_queue.schedule(task, time.time() + delay, replaces=task)
+
+    async def done(self, task: RetryTask) -> None:
+        await self._delay_queue.remove(task)
+
+    async def run(self, handler: Callable[[RetryTask], Awaitable[None]], concurrency: int = 1):
+        """Hands due tasks over to a handler, running up to `concurrency` handlers at once."""
+        active: set[asyncio.Task] = set()
+        try:
+            while True:
+                self._wakeup.clear()
+                limit = min(self._claim_count, concurrency - len(active))
+                tasks: list[RetryTask] = []
+                if limit > 0:
+                    try:
+                        tasks = await self._delay_queue.claim_due(self._stage, time.time(), self._lease, limit)
+                    except Exception as e:
+                        self._logger.error(f"failed to claim '{self._stage}' retries: {e}", exc_info=True)
+
+                for task in tasks:
+                    handler_task = asyncio.create_task(self._handle(handler, task))
+                    active.add(handler_task)
+                    handler_task.add_done_callback(self._on_handled(active))
+
+                if len(tasks) < limit or limit == 0:
+                    # Woken up by a new task or a finished handler.
+                    with suppress(TimeoutError):
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+        finally:
+            for handler_task in active:
+                handler_task.cancel()
+
+    async def _handle(self, handler: Callable[[RetryTask], Awaitable[None]], task: RetryTask):
+        if task.attempt > 0:
+            self._logger.info(f"retrying '{self._stage}' task [attempt {task.attempt + 1}]...")
+        try:
+            await handler(task)
+        except Exception as e:
+            self._logger.error(f"'{self._stage}' retry handler failed: {e}", exc_info=True)
+
+    def _on_handled(self, active: set[asyncio.Task]) -> Callable[[asyncio.Task], None]:
+        def callback(handler_task: asyncio.Task):
+            active.discard(handler_task)
+            self._wakeup.set()
+        return callback
+
+    async def _reschedule(self, task: RetryTask, err: Exception, replaces: RetryTask | None = None) -> bool:
+        attempt = task.attempt + 1
+        next_task = RetryTask(self._stage, task.payload, attempt=attempt, error=str(err))
+        delay = backoff_delay(self._policy, attempt)
+        if delay is None:
+            self._logger.error(f"'{self._stage}' task failed after {attempt} attempts, moving to dead letter queue")
+            await self._delay_queue.dead_letter(next_task, replaces=replaces)
+            return False
+
+        self._logger.warning(f"'{self._stage}' task failed [attempt {attempt}], retrying in {delay:.1f}s: {err}")
+        await self._delay_queue.schedule(next_task, time.time() + delay, replaces=replaces)
+        return True
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+import zlib
+
+
+class KeyedScheduler[T]:
+    """
+    Distributes work items between workers by key.
+
+    Each worker owns a shard queue. Items with the same key always land in the same shard,
+    so they're handled one after another in order of submission, while items with different
+    keys are processed in parallel.
+    """
+    _shards: list[asyncio.Queue[T]]
+    _handler: Callable[[int, T], Awaitable[None]]
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(self, shard_count: int, shard_size: int, handler: Callable[[int, T], Awaitable[None]]):
+        if shard_count < 1:
+            raise ValueError("shard count should be at least 1")
+        self._shards = [asyncio.Queue[T](shard_size) for _ in range(shard_count)]
+        self._handler = handler
+
+    @property
+    def shard_count(self) -> int:
+        return len(self._shards)
+
+    def shard_of(self, key: str) -> int:
+        """Returns index of shard which handles a given key."""
+        return zlib.crc32(key.encode("utf-8", errors="replace")) % len(self._shards)
+
+    def shard_depths(self) -> list[int]:
+        """Returns number of queued items per shard."""
+        return [q.qsize() for q in self._shards]
+
+    async def put(self, key: str, item: T) -> None:
+        """Queues item to a shard of a key. Blocks if shard queue is full."""
+        await self._shards[self.shard_of(key)].put(item)
+
+    async def join(self) -> None:
+        """Waits until all queued items are processed."""
+        for q in self._shards:
+            await q.join()
+
+    def start(self) -> list[asyncio.Task]:
+        """Starts a worker per each shard."""
+        return [asyncio.create_task(self._run_worker(i)) for i in range(len(self._shards))]
+
+    async def _run_worker(self, shard_id: int) -> None:
+        self._logger.info(f"starting consumer #{shard_id}...")
+        q = self._shards[shard_id]
+        while True:
+            item = await q.get()
+            try:
+                await self._handler(shard_id, item)
+            except Exception as e:
+                self._logger.error(f"worker#{shard_id}: unhandled error: {e}", exc_info=True)
+            finally:
+                q.task_done()
@@ -1,28 +1,157 @@
+import asyncio
 from asyncio import Protocol
+from collections import deque
+import email
+from email.policy import default as default_policy
 from email.utils import make_msgid
 from email.message import EmailMessage
+import json
 import logging
-from aiosmtplib import SMTP
+import re
+import time
+from typing import Callable
+from aiosmtplib import SMTP, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected, SMTPStatus
 from ..config import EmailConfig
 from .types import Message
+from .digest import DigestItem, ForwardDigest
 from .file_writer import MailFileWriter
+from .rate_limit import SendRateLimiter
+from .retry import RetryDispatcher, RetryTask
 
 DEFAULT_IGNORED_DOMAINS = set(["example.com", "example.org"])
 
+# Kinds of outgoing messages with separate rate limits.
+MSG_KIND_REPLY = "reply"
+MSG_KIND_FORWARD = "forward"
+
+# Enhanced status codes (RFC 3463) of permanent replies caused by sending rate or quota:
+# daily sending quota exceeded (e.g. Gmail "550 5.4.5") and mail flood detected (RFC 7372).
+RATE_LIMIT_STATUS_CODES = {"5.4.5", "5.7.28"}
+ENHANCED_STATUS_RX = re.compile(r"\s*([245]\.\d{1,3}\.\d{1,3})\b")
+
 
 class ThreadUpdater(Protocol):
     async def add_thread_message(self, message_id: str, thread_id: str) -> None:
         pass
 
 
+class SMTPPool:
+    """
+    Pool of persistent SMTP connections shared by concurrent senders.
+
+    Each connection is used by a single sender at a time. Connections idle for longer than
+    `health_check_interval` are checked with NOOP before reuse and closed after `idle_timeout`
+    by `close_idle` (or on the next send if it isn't running).
+    If a reused connection turns out to be closed by server (e.g. 421 reply), message is sent
+    over a new connection.
+    """
+    _factory: Callable[[], SMTP]
+    _idle_timeout: float
+    _health_check_interval: float
+    _slots: asyncio.Semaphore
+    # Idle connections with the time they were released, the most recently used are on the right.
+    _idle: deque[tuple[SMTP, float]]
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(self, factory: Callable[[], SMTP], size: int, idle_timeout: float, health_check_interval: float):
+        self._factory = factory
+        self._idle_timeout = idle_timeout
+        self._health_check_interval = health_check_interval
+        self._slots = asyncio.Semaphore(size)
+        self._idle = deque()
+
+    async def send_message(self, msg: EmailMessage):
+        async with self._slots:
+            smtp, reused = await self._acquire()
+            try:
+                await smtp.send_message(msg)
+            except Exception as e:
+                self._discard(smtp)
+                if not (reused and _is_connection_lost(e)):
+                    raise
+                self._logger.info(f"SMTP connection was closed by server ({e}), reconnecting...")
+                smtp, _ = await self._acquire(reuse=False)
+                try:
+                    await smtp.send_message(msg)
+                except Exception:
+                    self._discard(smtp)
+                    raise
+            self._idle.append((smtp, time.monotonic()))
+
+    def close(self):
+        while self._idle:
+            self._discard(self._idle.pop()[0])
+
+    async def close_idle(self):
+        """Closes connections which are idle for longer than `idle_timeout` periodically. Runs until cancelled."""
+        while True:
+            await asyncio.sleep(self._idle_timeout / 2)
+            self._close_expired()
+
+    async def _acquire(self, reuse: bool = True) -> tuple[SMTP, bool]:
+        """Returns a connected client and whether it was reused."""
+        self._close_expired()
+        while reuse and self._idle:
+            smtp, released_at = self._idle.pop()
+            if time.monotonic() - released_at < self._health_check_interval:
+                return smtp, True
+            try:
+                await smtp.noop()
+                return smtp, True
+            except Exception as e:
+                self._logger.info(f"SMTP connection health check failed: {e}")
+                self._discard(smtp)
+
+        smtp = self._factory()
+        try:
+            await smtp.connect()
+        except Exception:
+            self._discard(smtp)
+            raise
+        return smtp, False
+
+    def _close_expired(self):
+        deadline = time.monotonic() - self._idle_timeout
+        while self._idle and self._idle[0][1] < deadline:
+            self._discard(self._idle.popleft()[0])
+
+    def _discard(self, smtp: SMTP):
+        # Drop connection without QUIT, it may be broken already.
+        smtp.close()
+
+
+def is_throttled(err: Exception) -> bool:
+    """
+    Whether server rejected a message due to sending rate or quota: with a transient 4xx reply,
+    or with a 5xx reply with one of `RATE_LIMIT_STATUS_CODES`. Refused recipients are checked one by one.
+    """
+    if isinstance(err, SMTPRecipientsRefused):
+        return any(is_throttled(e) for e in err.recipients)
+    if not isinstance(err, SMTPResponseException):
+        return False
+    if 400 <= err.code < 500:
+        return True
+    m = ENHANCED_STATUS_RX.match(err.message or "")
+    return m is not None and m.group(1) in RATE_LIMIT_STATUS_CODES
+
+
+def _is_connection_lost(err: Exception) -> bool:
+    if isinstance(err, SMTPServerDisconnected):
+        return True
+    return isinstance(err, SMTPResponseException) and err.code == SMTPStatus.domain_unavailable
+
+
 class MailSender:
     _msg_id_domain: str
     _sender: str
-    _smtp: SMTP
+    _smtp: SMTPPool
     _logger: logging.Logger
     _thread_updater: ThreadUpdater
     _file_writer: MailFileWriter | None
     _ignored_domains: set[str]
+    _outbox: RetryDispatcher | None
+    _limiter: SendRateLimiter
+    _digest: ForwardDigest | None
 
     def __init__(
         self,
@@ -30,49 +159,97 @@ class MailSender:
         thread_updater: ThreadUpdater,
         file_writer: MailFileWriter | None = None,
         ignored_domains: set[str] = DEFAULT_IGNORED_DOMAINS,
+        outbox: RetryDispatcher | None = None,
+        digest: ForwardDigest | None = None,
     ):
+        """
+        If `outbox` is set - messages are queued and delivered with retries by `deliver` handler,
+        otherwise they're sent immediately.
+        If `digest` is set - non-urgent forwards are collected and sent by `send_digest` handler.
+        """
         self._logger = logging.getLogger(__name__)
+        self._outbox = outbox
+        self._digest = digest
         self._msg_id_domain = config.msg_id_domain
         self._sender = config.username
         self._thread_updater = thread_updater
         self._file_writer = file_writer
         self._ignored_domains = ignored_domains
-        self._smtp = SMTP(
-            hostname=config.smtp_host,
-            port=config.smtp_port,
-            username=config.username,
-            password=config.password,
+        self._limiter = SendRateLimiter(
+            {MSG_KIND_REPLY: config.reply_rate_limit, MSG_KIND_FORWARD: config.forward_rate_limit},
+            throttle_pause=config.throttle_pause,
         )
+        self._smtp = SMTPPool(
+            lambda: SMTP(
+                hostname=config.smtp_host,
+                port=config.smtp_port,
+                username=config.username,
+                password=config.password,
+            ),
+            size=config.smtp_pool_size,
+            idle_timeout=config.smtp_idle_timeout,
+            health_check_interval=config.smtp_health_check_interval,
+        )
+
+    @property
+    def rate_limit_status(self) -> str:
+        return self._limiter.status()
+
+    def close(self):
+        """Closes idle SMTP connections."""
+        self._smtp.close()
+
+    async def close_idle_connections(self):
+        """Closes SMTP connections unused for `smtp_idle_timeout` before server drops them. Runs until cancelled."""
+        await self._smtp.close_idle()
 
     def _should_ignore_domain(self, email: str) -> bool:
         parts = email.split("@")
         return len(parts) > 1 and parts[1] in self._ignored_domains
 
     async def forward_message(
-        self, parent_msg: Message, dst_email: str, body: str | None
+        self, parent_msg: Message, dst_email: str, body: str | None, urgent: bool = False
     ):
-        msg_id = make_msgid(domain=self._msg_id_domain)
+        """Forwards a message. Unless it's urgent, it may be buffered and sent later within a digest."""
+        if self._digest and not urgent:
+            await self._digest.add(dst_email, DigestItem.from_message(parent_msg, body))
+            self._logger.info(f"added forwarded message to digest for {dst_email}")
+            return
+
         msg = make_forward_message(
-            msg_id=msg_id,
+            msg_id=make_msgid(domain=self._msg_id_domain),
             parent_msg=parent_msg,
             from_email=self._sender,
             dst_email=dst_email,
             body=body,
         )
+        await self._forward(msg, dst_email)
+
+    async def send_digest(self, dst_email: str, items: list[DigestItem]):
+        """Sends buffered forwards as a single message. Used as a handler of the digest."""
+        msg = make_digest_message(
+            msg_id=make_msgid(domain=self._msg_id_domain),
+            items=items,
+            from_email=self._sender,
+            dst_email=dst_email,
+        )
+        await self._forward(msg, dst_email)
 
+    async def _forward(self, msg: EmailMessage, dst_email: str):
         if self._should_ignore_domain(dst_email) and self._file_writer:
             self._file_writer.save(msg)
             return
 
-        # TODO: dead letter queue for failed messages.
+        if self._outbox:
+            await self._enqueue(msg, MSG_KIND_FORWARD, None)
+            self._logger.info(f"queued forwarded message to {dst_email}")
+            return
+
         try:
             self._logger.info(f"sending forwarded message to {dst_email}")
-            await self._smtp.connect()
-            await self._smtp.send_message(msg)
+            await self._send_now(msg, MSG_KIND_FORWARD)
         except Exception as e:
             raise Exception(f"failed to send forward message to {dst_email}") from e
-        finally:
-            self._smtp.close()
 
     async def reply_in_thread(self, thread_id: str, parent_msg: Message, body: str):
         """
@@ -102,19 +279,75 @@ class MailSender:
         msg["X-PMEA-Thread-ID"] = thread_id  # For debugging purposes.
         msg.set_content(body)
 
-        # TODO: dead letter queue for failed messages.
+        if self._outbox:
+            # Message is added to the thread once it's delivered.
+            await self._enqueue(msg, MSG_KIND_REPLY, thread_id)
+            self._logger.info(f"queued reply to {receiver} in thread {thread_id}")
+            return
+
         try:
-            # TODO: should connection be closed after sending?
-            await self._smtp.connect()
-            await self._smtp.send_message(msg)
+            await self._send_now(msg, MSG_KIND_REPLY)
         except Exception as e:
             raise Exception(
                 f"failed to send reply to {receiver} in thread {thread_id}"
             ) from e
-        finally:
-            self._smtp.close()
 
         self._logger.info(f"sent reply to {receiver} in thread {thread_id}")
+        await self._add_thread_message(msg_id, thread_id)
+
+    async def deliver(self, task: RetryTask):
+        """Delivers a queued message. Used as a handler of the outbox."""
+        payload = json.loads(task.payload)
+        msg = email.message_from_string(payload["msg"], policy=default_policy)
+        thread_id = payload["thread_id"]
+        kind = payload.get("kind") or (MSG_KIND_REPLY if thread_id else MSG_KIND_FORWARD)
+
+        # Over budget messages are postponed instead of holding a sender.
+        delay = self._limiter.reserve(kind)
+        if delay > 0:
+            self._logger.info(f"{kind} budget is exhausted, postponing message to {msg['To']} by {delay:.0f}s")
+            await self._outbox.postpone(task, delay)
+            return
+
+        try:
+            await self._send(msg)
+        except Exception as e:
+            # Failed attempts don't use up the budget of messages which can still be sent.
+            self._limiter.refund(kind)
+            self._logger.warning(f"failed to send message to {msg['To']} [attempt {task.attempt + 1}]: {e}")
+            await self._outbox.failed(task, e)
+            return
+
+        self._logger.info(f"sent message to {msg['To']} [attempt {task.attempt + 1}], budget: {self._limiter.status()}")
+        await self._outbox.done(task)
+        if thread_id:
+            await self._add_thread_message(msg["Message-ID"], thread_id)
+
+    async def _send(self, msg: EmailMessage):
+        try:
+            await self._smtp.send_message(msg)
+        except Exception as e:
+            if is_throttled(e):
+                self._limiter.throttled()
+                self._logger.warning(f"sending is throttled by server, slowing down: {self._limiter.status()}")
+            raise
+        self._limiter.delivered()
+
+    async def _send_now(self, msg: EmailMessage, kind: str):
+        while (delay := self._limiter.reserve(kind)) > 0:
+            self._logger.info(f"{kind} budget is exhausted, waiting {delay:.0f}s")
+            await asyncio.sleep(delay)
+        try:
+            await self._send(msg)
+        except Exception:
+            self._limiter.refund(kind)
+            raise
+
+    async def _enqueue(self, msg: EmailMessage, kind: str, thread_id: str | None):
+        payload = json.dumps({"msg": msg.as_string(), "kind": kind, "thread_id": thread_id}, ensure_ascii=False)
+        await self._outbox.enqueue(payload)
+
+    async def _add_thread_message(self, msg_id: str, thread_id: str):
         try:
             await self._thread_updater.add_thread_message(msg_id, thread_id)
         except Exception as e:
@@ -140,3 +373,21 @@ def make_forward_message(
     else:
         msg.set_content(parent_msg.body + forward_header)
     return msg
+
+
+def make_digest_message(items: list[DigestItem], from_email: str, msg_id: str, dst_email: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Message-ID"] = msg_id
+    msg["From"] = from_email
+    msg["To"] = dst_email
+    msg["Subject"] = f"FWD: {len(items)} messages" if len(items) > 1 else f"FWD: {items[0].subject}"
+
+    sections = [f"Forwarded {len(items)} messages:"]
+    for i, item in enumerate(items, 1):
+        section = f"{i}. {item.subject}\nFrom {item.sender} at {item.sent_at}\n"
+        if item.comments:
+            section += f"\n{item.comments}\n"
+        section += "\n" + "\n".join([f"> {line}" for line in item.body.splitlines()])
+        sections.append(section)
+    msg.set_content("\n\n---\n\n".join(sections))
+    return msg
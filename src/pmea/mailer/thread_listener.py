@@ -1,8 +1,7 @@
 """Provides functionality to map incoming messages to threads."""
 import logging
-from typing import Optional
-from pmea.repository.threads import ThreadsRepository
-from .mail_listener import MailConsumer
+from pmea.repository.threads import THREAD_RESOLVED_EXISTING, THREAD_RESOLVED_NEW, ThreadsRepository
+from .workers import MailConsumer
 from .types import Message
 
 class ThreadConsumer:
@@ -10,6 +9,9 @@ class ThreadConsumer:
     async def consume_thread_message(self, thread_id: str, m: Message) -> None:
         """Handle new message in a thread."""
 
+    async def reject_thread_message(self, thread_id: str, m: Message, err: Exception) -> None:
+        """Handle message which processing failed and won't be retried anymore."""
+
 class ThreadMailConsumer(MailConsumer):
     """MailConsumer interface implementation which assembles sequence of messages into a thread."""
     _consumer: ThreadConsumer
@@ -23,40 +25,35 @@ class ThreadMailConsumer(MailConsumer):
     async def consume_mail(self, m: Message) -> None:
         """Implements MailConsumer interface."""
         msg_id = m.headers.msg_id
-
-        # If message already exists in a thread, skip it.
-        thread_id = await self._threads_repo.get_message_thread_id(msg_id)
-        if thread_id:
+        thread_id, status = await self._threads_repo.resolve_thread_id(msg_id, self._get_parent_ids(m))
+        if status == THREAD_RESOLVED_EXISTING:
             self._logger.info("Message %s already exists in thread %s", msg_id, thread_id)
-            await self._consumer.consume_thread_message(thread_id, m)
-            return
-
-        thread_id = await self._get_thread_id(m)
-        if not thread_id:
-            thread_id = self._threads_repo.new_thread_id()
+        elif status == THREAD_RESOLVED_NEW:
             self._logger.info(
                 "No thread found for message %s, creating new thread %s.", msg_id, thread_id,
             )
         else:
             self._logger.info("Found thread %s for message %s", thread_id, msg_id)
-        await self._threads_repo.add_thread_message(msg_id, thread_id)
         await self._consumer.consume_thread_message(thread_id, m)
 
-    async def _get_thread_id(self, m: Message) -> Optional[str]:
-        if not m.headers.in_reply_to and not m.headers.references:
-            return None
+    async def reject_mail(self, m: Message, err: Exception) -> None:
+        """Implements MailConsumer interface."""
+        thread_id = await self._threads_repo.get_message_thread_id(m.headers.msg_id)
+        if not thread_id:
+            self._logger.error("Message %s failed before it was added to a thread: %s", m.headers.msg_id, err)
+            return
+        await self._consumer.reject_thread_message(thread_id, m, err)
 
+    def _get_parent_ids(self, m: Message) -> list[str]:
+        """Returns IDs of messages which may define a thread, in the order they're checked."""
+        parent_ids: list[str] = []
         if m.headers.in_reply_to:
-            thread_id = await self._threads_repo.get_message_thread_id(m.headers.in_reply_to)
-            if thread_id:
-                return thread_id
+            parent_ids.append(m.headers.in_reply_to)
 
         # First guess: if parent message is a reply by LLM - it will be tracked.
-        references = m.headers.references
-        thread_id = await self._threads_repo.get_message_thread_id(references[-1])
-        if thread_id:
-            return thread_id
-
-        # Try to lookup if any of referenced messages have a thread.
-        references = references[:-1]
-        return await self._threads_repo.lookup_thread_id(references)
+        # Then any of referenced messages may have a thread.
+        references = m.headers.references or []
+        if references:
+            parent_ids.append(references[-1])
+            parent_ids += references[:-1]
+        return parent_ids
@@ -1,7 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from email.utils import parseaddr
 import datetime
+import json
 from typing import Self
+from .bodystructure import BodyPart
 
 @dataclass
 class MessageHeaders:
@@ -30,4 +32,57 @@ class Message:
     subject: str
     body: str
     sent_at: datetime.datetime
-    headers: MessageHeaders
\ No newline at end of file
+    headers: MessageHeaders
+
+@dataclass
+class FetchedMessage:
+    """Raw message data downloaded from IMAP server."""
+    uid: int
+    size: int
+    headers: bytes
+    body: bytes | None = None
+
+    # Location of a text part within a message. If empty - body contains the whole message.
+    body_part: BodyPart | None = None
+
+@dataclass
+class ParsedMessage:
+    """Pre-parsed message record. Compact and picklable to pass between processes."""
+    uid: int
+    size: int
+    sender: Contact
+    receiver: Contact
+    subject: str
+    sent_at: datetime.datetime
+    headers: MessageHeaders
+    body: str | None
+
+    def to_message(self) -> Message:
+        return Message(
+            uid=self.uid,
+            sender=self.sender,
+            receiver=self.receiver,
+            subject=self.subject,
+            body=self.body or "",
+            sent_at=self.sent_at,
+            headers=self.headers,
+        )
+
+    def to_json(self) -> str:
+        data = asdict(self)
+        data["sent_at"] = self.sent_at.isoformat()
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def from_json(raw: str | bytes) -> Self:
+        data = json.loads(raw)
+        return ParsedMessage(
+            uid=data["uid"],
+            size=data["size"],
+            sender=Contact(**data["sender"]),
+            receiver=Contact(**data["receiver"]),
+            subject=data["subject"],
+            sent_at=datetime.datetime.fromisoformat(data["sent_at"]),
+            headers=MessageHeaders(**data["headers"]),
+            body=data["body"],
+        )
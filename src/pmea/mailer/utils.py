@@ -1,31 +1,32 @@
-from itertools import batched
+from dataclasses import dataclass
 import re
 import email
 from email import message
-from typing import Generator, Optional
-
-from pmea.mailer.types import MessageHeaders
-
-RE_UID_RX_LINE = re.compile(r'^\d+\s+FETCH\s+\(UID\s+(\d+)')
-RE_UIDNEXT_RX_LINE = re.compile(r"^OK \[UIDNEXT (\d+)\]")
-RE_SERVER_PUSH_EXISTS_LINE = re.compile(r"^[\d]+ EXISTS$")
-RE_FETCH_FLAGS_LINE = re.compile(r"^[\d]+ FETCH \(UID [\d]+ FLAGS")
-
-MAIL_RSP_LINES_COUNT = 3
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
+from typing import Generator, Iterable, Optional
+
+from pmea.mailer.bodystructure import decode_part_payload
+from pmea.mailer.types import Contact, FetchedMessage, MessageHeaders, ParsedMessage
+
+RE_UIDNEXT_RX_LINE = re.compile(rb"^OK \[UIDNEXT (\d+)\]")
+RE_SELECT_STATUS_LINE = re.compile(rb"^OK \[(UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)\]")
+RE_STATUS_UIDNEXT_LINE = re.compile(rb"^STATUS .*\(.*?\bUIDNEXT (\d+)")
+RE_SERVER_PUSH_EXISTS_LINE = re.compile(rb"^\d+ EXISTS$")
+RE_SELECT_EXISTS_LINE = re.compile(rb"^(\d+) EXISTS$")
+RE_LITERAL_MARKER = re.compile(rb"\{\d+\}$")
+RE_FETCH_UID_LINE = re.compile(rb"^\d+ FETCH \(.*?(?<=[( ])UID (\d+)")
+RE_FETCH_START = re.compile(rb"^\d+ FETCH \(")
+RE_FETCH_ATTR_UID = re.compile(rb"[( ]UID (\d+)")
+RE_FETCH_ATTR_SIZE = re.compile(rb"[( ]RFC822\.SIZE (\d+)")
+RE_FETCH_LITERAL_ITEM = re.compile(rb"(?<![\w.])((?:BODY|RFC822)(?:\[[^\]]*\](?:<\d+>)?|\.HEADER|\.TEXT)?) \{\d+\}$")
+RE_FETCH_QUOTED_ITEM = re.compile(rb'(?<![\w.])((?:BODY|RFC822)(?:\[[^\]]*\](?:<\d+>)?|\.HEADER|\.TEXT)?) (?:"((?:[^"\\]|\\.)*)"|NIL)')
+RE_QUOTED_ESCAPE = re.compile(rb"\\(.)")
 
 def uid_from_fetch_line(line: bytes) -> int | None:
     """Parses UID from FETCH response line (e.g. 'x FETCH (UID x)')"""
-    try:
-        line_str = line.decode("utf-8", errors="replace")
-    except Exception:
-        return None
-    match = RE_UID_RX_LINE.match(line_str)
-    if not match:
-        return None
-    try:
-        return int(match.group(1))
-    except ValueError:
-        return None
+    match = RE_FETCH_UID_LINE.match(line)
+    return int(match.group(1)) if match else None
 
 def parse_msg_payload(msg: message.Message) -> str | None:
     if not msg.is_multipart():
@@ -38,61 +39,110 @@ def parse_msg_payload(msg: message.Message) -> str | None:
             return part.get_payload(decode=True).decode('utf-8')
     return None
 
-def cut_fetch_flags_suffix(lines: list[bytes]) -> list[bytes]:
-    skip_count = 0
-    for line in reversed(lines):
+@dataclass
+class FetchResponse:
+    """Single message data from FETCH response."""
+    uid: int
+    attrs: bytes
+    items: dict[bytes, bytes]
+
+    @property
+    def size(self) -> int | None:
+        """Returns RFC822.SIZE attribute if it was requested."""
+        match = RE_FETCH_ATTR_SIZE.search(self.attrs)
+        return int(match.group(1)) if match else None
+
+    def get_item(self, prefix: bytes) -> bytes | None:
+        """Returns data of the first item whose name starts with prefix, e.g. 'BODY[HEADER'."""
+        prefix = prefix.upper()
+        return next((v for k, v in self.items.items() if k.startswith(prefix)), None)
+
+
+def iter_fetch_responses(lines: Iterable[bytes]) -> Generator[FetchResponse, None]:
+    """
+    Parses FETCH response lines into per-message responses as they arrive.
+
+    Doesn't depend on attributes order and amount of literals. Lines are matched as bytes and literals
+    (bytearrays) are passed through without copying. Response ends on a line without a trailing literal,
+    so other untagged responses in between (EXISTS, EXPUNGE) and command completion text are skipped.
+    Message data items (BODY[...], RFC822) are returned by name, the rest of response is joined into `attrs`.
+    Responses without UID (e.g. unsolicited FLAGS updates) are skipped.
+    """
+    attrs: list[bytes] = []
+    items: dict[bytes, bytes] = {}
+    literal_name: bytes | None = None
+    in_response = False
+
+    for line in lines:
         if isinstance(line, bytearray):
-            break
-        line_str = line.decode("utf-8", errors="replace")
-        if RE_FETCH_FLAGS_LINE.match(line_str):
-            skip_count += 1
+            if literal_name is not None:
+                items[literal_name] = line
+            literal_name = None
+            continue
+        if not in_response:
+            if not RE_FETCH_START.match(line):
+                continue
+            attrs, items = [], {}
+        attrs.append(line)
+
+        # Response line continues after a literal.
+        in_response = line.endswith(b"}") and RE_LITERAL_MARKER.search(line) is not None
+        if in_response:
+            literal_name = _literal_item_name(line)
             continue
-        break
-    return lines if not skip_count else lines[:-skip_count]
-
-# A list contains combined contents of all messages + enclosing 'Success' line.
-def iter_messages(msgs_response: list[bytes]) -> Generator[tuple[int, message.Message], None]:
-    """Returns an async iterator to traverse over batch messages response"""
-    if not msgs_response:
-        return
-
-    # Last element should be 'Success' line.
-    # Rest: there are 2 potential cases:
-    # 1. If done outside of IDLE loop: 
-    #    header: 'x FETCH (UID y RFC8222 {size})'
-    #    payload: <bytearray>
-    #    ending:')'
-    # 2. After IDLE loop:
-    #    header: 'x FETCH (UID y RFC8222 {size})'
-    #    payload: <bytearray>
-    #    ending: ' FLAGS (\Seen)'
-    #    ...
-    #    flags for each message before 'Success' line:
-    #    'x FETCH (UID y FLAGS (\Seen))'  - for each message at bottom
-    last_line = msgs_response[-1]
-    if not last_line.startswith(b'Success'):
-        raise Exception(f"unexpected response end: {last_line}")
-
-    # Trim 'Success' line.
-    msgs_response = msgs_response[:-1]
-
-    # Check for second case - trim 'x FETCH' suffixes.
-    # Flags there allow checking if message is seen but atm they're not needed.
-    msgs_response = cut_fetch_flags_suffix(msgs_response)
-
-    if len(msgs_response) % MAIL_RSP_LINES_COUNT != 0:
-        raise Exception(f"response lines not divisible by {MAIL_RSP_LINES_COUNT}, got {len(msgs_response)}")
-
-    for header, body, _ in batched(msgs_response, MAIL_RSP_LINES_COUNT):
-        uid = uid_from_fetch_line(header)
-        if not uid:
-            raise Exception(f"failed to parse UID from header: {header}")
-        try:
-            msg = email.message_from_bytes(body)
-            yield uid, msg
-        except Exception as e:
-            raise Exception(f"failed to message body (uid: {uid})") from e
-        
+        if rsp := _make_fetch_response(attrs, items):
+            yield rsp
+
+
+def _literal_item_name(line: bytes) -> bytes | None:
+    # Item name is the last one in the line, avoid scanning the whole line for it.
+    start = max(line.rfind(b"BODY"), line.rfind(b"RFC822"))
+    if start < 0:
+        return None
+    match = RE_FETCH_LITERAL_ITEM.match(line, start)
+    return match.group(1).upper() if match else None
+
+
+def _make_fetch_response(attrs: list[bytes], items: dict[bytes, bytes]) -> FetchResponse | None:
+    joined = attrs[0] if len(attrs) == 1 else b" ".join(attrs)
+    match = RE_FETCH_ATTR_UID.search(joined)
+    if not match:
+        return None
+    if b'"' not in joined and b"NIL" not in joined:
+        return FetchResponse(uid=int(match.group(1)), attrs=joined, items=items)
+    for m in RE_FETCH_QUOTED_ITEM.finditer(joined):
+        value = m.group(2)
+        items.setdefault(m.group(1).upper(), b"" if value is None else RE_QUOTED_ESCAPE.sub(rb"\1", value))
+    return FetchResponse(uid=int(match.group(1)), attrs=joined, items=items)
+
+
+def parse_header_literal(data: bytes) -> message.Message:
+    """Parses headers returned by 'BODY[HEADER.FIELDS (...)]' fetch."""
+    return BytesHeaderParser().parsebytes(bytes(data))
+
+
+def decode_message_body(msg: FetchedMessage) -> str | None:
+    """Decodes downloaded text part or finds it in the whole message if part is unknown."""
+    if msg.body is None:
+        return None
+    if msg.body_part is None:
+        return parse_msg_payload(email.message_from_bytes(msg.body))
+    return decode_part_payload(msg.body, msg.body_part.encoding, msg.body_part.charset)
+
+def parse_fetched_message(msg: FetchedMessage) -> ParsedMessage:
+    """Parses headers and decodes text body. CPU-bound, can be called from a process pool."""
+    headers = parse_header_literal(msg.headers)
+    return ParsedMessage(
+        uid=msg.uid,
+        size=msg.size,
+        sender=Contact.parse(headers.get("From", "")),
+        receiver=Contact.parse(headers.get("To", "")),
+        subject=headers.get("Subject", ""),
+        sent_at=parsedate_to_datetime(headers.get("Date", "")),
+        headers=parse_message_headers(headers),
+        body=decode_message_body(msg),
+    )
+
 def parse_message_headers(msg: message.Message) -> MessageHeaders:
     references = msg.get('References', '').split()
     return MessageHeaders(
@@ -101,22 +151,70 @@ def parse_message_headers(msg: message.Message) -> MessageHeaders:
         references=references if references else None,
     )
 
+def thread_key_from_headers(headers: MessageHeaders) -> str:
+    """
+    Returns a provisional thread key of a message without looking up thread storage.
+
+    Thread root is the first entry in References header. If it's absent, message is either
+    a first reply or a new thread, so parent or own Message-ID is used.
+    """
+    if headers.references:
+        return headers.references[0]
+    return (headers.in_reply_to or "").strip() or headers.msg_id
+
 def uidnext_from_select_response(lines: list[bytes]) -> Optional[int]:
     """Parses UIDNEXT from SELECT response line (e.g. 'x FETCH (UID x)')"""
     if not lines:
         return None
     for line in lines:
-        if not line.startswith(b'OK'):
-            continue
-        match = RE_UIDNEXT_RX_LINE.match(line.decode("utf-8", errors="replace"))
+        match = RE_UIDNEXT_RX_LINE.match(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+def uidnext_from_status_response(lines: list[bytes]) -> Optional[int]:
+    """Parses UIDNEXT from STATUS response line (e.g. 'STATUS INBOX (UIDNEXT x)')"""
+    for line in lines or []:
+        match = RE_STATUS_UIDNEXT_LINE.match(line)
         if match:
             return int(match.group(1))
     return None
 
+@dataclass
+class MailboxStatus:
+    """Mailbox state from SELECT response. HIGHESTMODSEQ is set only if server supports CONDSTORE."""
+    uidnext: int | None = None
+    uidvalidity: int | None = None
+    highestmodseq: int | None = None
+    exists: int | None = None
+
+
+def mailbox_status_from_select_response(lines: list[bytes]) -> MailboxStatus:
+    """Parses messages count and UIDNEXT, UIDVALIDITY, HIGHESTMODSEQ response codes from SELECT response."""
+    status = MailboxStatus()
+    for line in lines or []:
+        match = RE_SELECT_STATUS_LINE.match(line)
+        if match:
+            setattr(status, match.group(1).decode().lower(), int(match.group(2)))
+            continue
+        match = RE_SELECT_EXISTS_LINE.match(line)
+        if match:
+            status.exists = int(match.group(1))
+    return status
+
+def uids_from_search_response(lines: list[bytes]) -> list[int]:
+    """Parses UIDs from UID SEARCH response line (e.g. 'SEARCH 1 2 3' or 'SEARCH 1 2 3 (MODSEQ 917)')"""
+    uids: list[int] = []
+    for line in lines or []:
+        if line.startswith(b"SEARCH"):
+            # MODSEQ search criterion adds the highest mod-sequence of found messages.
+            uids += [int(uid) for uid in line.split(b"(", 1)[0].split()[1:]]
+    return uids
+
 def is_server_push_exists_result(lines: list[bytes]) -> bool:
     if not lines:
         return False
-    return RE_SERVER_PUSH_EXISTS_LINE.match(lines[0].decode("utf-8", errors="replace")) is not None
+    return RE_SERVER_PUSH_EXISTS_LINE.match(lines[0]) is not None
 
 def assert_ok(code: str, msg: str) -> None:
     if code != "OK":
@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque
+import logging
+from typing import Awaitable, Callable, Optional, Protocol
+
+
+class LastUIDStore(Protocol):
+    """Abstract interface to implement last read UID store."""
+    async def get_last_uid(self, email: str) -> Optional[int]:
+        pass
+    async def set_last_uid(self, email: str, uid: int) -> None:
+        pass
+    async def get_mailbox_state(self, email: str) -> Optional[tuple[int, int]]:
+        """Returns UIDVALIDITY and HIGHESTMODSEQ of last synchronization."""
+    async def set_mailbox_state(self, email: str, uidvalidity: int, highestmodseq: int) -> None:
+        pass
+
+
+class UIDWatermark:
+    """
+    Tracks UIDs of queued messages and persists the highest UID up to which all messages were processed.
+
+    Workers acknowledge messages in any order, stored UID only moves forward over a contiguous
+    range of acknowledged messages. Store is updated in batches - after `flush_count` acks
+    or every `flush_interval` seconds, whichever comes first.
+    """
+    _store: LastUIDStore
+    _email: str
+    _flush_count: int
+    _flush_interval: float
+    _pending: deque[int]
+    _done: set[int]
+    _last_tracked: int = 0
+    _watermark: int = 0
+    _flushed: int = 0
+    _unflushed_acks: int = 0
+    _restored: bool = False
+    _on_flush: Callable[[int], Awaitable[None]] | None
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        store: LastUIDStore,
+        email: str,
+        flush_count: int,
+        flush_interval: float,
+        on_flush: Callable[[int], Awaitable[None]] | None = None,
+    ):
+        """`on_flush` is called with a new persisted UID after each successful flush."""
+        self._store = store
+        self._on_flush = on_flush
+        self._email = email
+        self._flush_count = flush_count
+        self._flush_interval = flush_interval
+        self._pending = deque()
+        self._done = set()
+
+    @property
+    def last_tracked(self) -> int:
+        """Highest UID which was queued for processing."""
+        return self._last_tracked
+
+    @property
+    def watermark(self) -> int:
+        """Highest UID below which all queued messages were processed."""
+        return self._watermark
+
+    @property
+    def flushed(self) -> int:
+        """Highest UID which was persisted."""
+        return self._flushed
+
+    @property
+    def restored(self) -> bool:
+        """Whether last UID was restored from the store, i.e. mailbox was synced before."""
+        return self._restored
+
+    @property
+    def pending_count(self) -> int:
+        """Number of queued messages which are not acknowledged yet."""
+        return len(self._pending)
+
+    async def load(self) -> int:
+        """Restores last persisted UID. Has to be called before tracking any message."""
+        last_uid = await self._store.get_last_uid(self._email)
+        self._restored = last_uid is not None
+        if last_uid is None:
+            self._logger.warning("last UID is not set, using first UID")
+            last_uid = 0
+
+        self._pending.clear()
+        self._done.clear()
+        self._last_tracked = self._watermark = self._flushed = last_uid
+        return last_uid
+
+    def track(self, uid: int) -> bool:
+        """
+        Registers queued message UID. UIDs should be tracked in ascending order.
+
+        Returns False if UID was already tracked before and message should be skipped.
+        """
+        if uid <= self._last_tracked:
+            return False
+        self._pending.append(uid)
+        self._last_tracked = uid
+        return True
+
+    async def skip_to(self, uid: int) -> None:
+        """Marks all messages up to UID as processed without queueing them and persists it."""
+        if uid <= self._last_tracked:
+            return
+        if self._pending:
+            raise Exception(f"can't skip to UID {uid}, {len(self._pending)} messages are still pending")
+        self._last_tracked = self._watermark = uid
+        await self.flush()
+
+    async def ack(self, uid: int) -> None:
+        """Marks message as processed."""
+        self._done.add(uid)
+        while self._pending and self._pending[0] in self._done:
+            self._watermark = self._pending.popleft()
+            self._done.discard(self._watermark)
+
+        self._unflushed_acks += 1
+        if self._unflushed_acks >= self._flush_count:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Persists current watermark if it has moved since the last flush."""
+        self._unflushed_acks = 0
+        uid = self._watermark
+        if uid <= self._flushed:
+            return
+
+        prev_flushed = self._flushed
+        self._flushed = uid
+        try:
+            await self._store.set_last_uid(self._email, uid)
+        except Exception:
+            if self._flushed == uid:
+                self._flushed = prev_flushed
+            raise
+        if self._on_flush:
+            await self._on_flush(uid)
+
+    async def run_flusher(self) -> None:
+        """Periodically flushes watermark. Runs until cancelled."""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self._logger.error(f"failed to save last UID {self._watermark}: {e}", exc_info=True)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from typing import Protocol
+from .msg_queue import MessageQueue, QueueEntry
+from .retry import RetryDispatcher, RetryTask
+from .scheduler import KeyedScheduler
+from .types import Message, ParsedMessage
+from .utils import thread_key_from_headers
+
+
+class MailConsumer(Protocol):
+    """Abstract interface to implement mail handler."""
+    async def consume_mail(self, m: Message) -> None:
+        pass
+
+    async def reject_mail(self, m: Message, err: Exception) -> None:
+        """Called when message processing failed and won't be retried anymore."""
+
+
+class MailWorkers:
+    """Takes messages from the queue and passes them to consumer."""
+    _queue: MessageQueue
+    _consumer: MailConsumer
+    _scheduler: KeyedScheduler[QueueEntry]
+    _retries: RetryDispatcher | None
+    _stats_interval: float
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        queue: MessageQueue,
+        consumer: MailConsumer,
+        worker_count: int,
+        shard_size: int,
+        retries: RetryDispatcher | None = None,
+        stats_interval: float = 0,
+    ):
+        """Worker and incoming queue stats are logged every `stats_interval` seconds (0 - disabled)."""
+        self._queue = queue
+        self._consumer = consumer
+        self._retries = retries
+        self._stats_interval = stats_interval
+        self._scheduler = KeyedScheduler(
+            shard_count=worker_count,
+            shard_size=shard_size,
+            handler=self._process_message,
+        )
+
+    def shard_depths(self) -> list[int]:
+        """Returns number of messages waiting in each worker's queue."""
+        return self._scheduler.shard_depths()
+
+    async def run(self):
+        tasks = self._scheduler.start()
+        if self._retries:
+            tasks.append(asyncio.create_task(self._retries.run(self._dispatch_retry)))
+        if self._stats_interval:
+            tasks.append(asyncio.create_task(self._report_stats()))
+        try:
+            # Messages of the same thread are routed to the same worker to be processed in order.
+            while True:
+                entry = await self._queue.get()
+                await self._scheduler.put(thread_key_from_headers(entry.msg.headers), entry)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self._stats_interval)
+            depths = self.shard_depths()
+            self._logger.info(f"worker queues: depths={depths} total={sum(depths)}")
+            try:
+                queue_stats = await self._queue.stats()
+            except Exception as e:
+                self._logger.error(f"failed to get incoming queue stats: {e}")
+                continue
+            if queue_stats:
+                self._logger.info(f"incoming queue: {queue_stats}")
+
+    async def _dispatch_retry(self, task: RetryTask):
+        msg = ParsedMessage.from_json(task.payload)
+        entry = QueueEntry(entry_id=f"retry:{msg.uid}", msg=msg, retry=task)
+        await self._scheduler.put(thread_key_from_headers(msg.headers), entry)
+
+    async def _process_message(self, worker_id: int, entry: QueueEntry):
+        msg = entry.msg
+        try:
+            await self._handle_message(msg.to_message())
+        except Exception as e:
+            self._logger.error(
+                f"worker#{worker_id}: cannot handle message #{msg.uid}: {e}",
+                exc_info=True,
+            )
+            # Failed message waits for the next attempt in the retry queue, not in the worker.
+            await self._retry_message(entry, e)
+        else:
+            if entry.retry:
+                await self._complete_retry(entry.retry)
+        finally:
+            if entry.retry is None:
+                await self._ack_message(entry)
+
+    async def _retry_message(self, entry: QueueEntry, err: Exception):
+        try:
+            if self._retries:
+                if entry.retry:
+                    scheduled = await self._retries.failed(entry.retry, err)
+                else:
+                    scheduled = await self._retries.submit(entry.msg.to_json(), err)
+                if scheduled:
+                    return
+            await self._consumer.reject_mail(entry.msg.to_message(), err)
+        except Exception as e:
+            self._logger.error(f"failed to handle failure of message #{entry.msg.uid}: {e}", exc_info=True)
+
+    async def _complete_retry(self, task: RetryTask):
+        try:
+            await self._retries.done(task)
+        except Exception as e:
+            self._logger.error(f"failed to complete '{task.stage}' retry: {e}", exc_info=True)
+
+    async def _ack_message(self, entry: QueueEntry):
+        try:
+            await self._queue.ack(entry)
+        except Exception as e:
+            self._logger.error(f"failed to acknowledge message #{entry.msg.uid}: {e}", exc_info=True)
+
+    async def _handle_message(self, msg: Message):
+        if not msg.body:
+            self._logger.warning(
+                f"no body found in message from {msg.sender.email} (#{msg.uid}), skipping..."
+            )
+            return
+
+        await self._consumer.consume_mail(msg)
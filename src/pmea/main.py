@@ -1,6 +1,7 @@
+import asyncio
 import typer
 from pydantic import ValidationError
-from .app import ServerApplication, ChatApplication
+from .app import ServerApplication, ChatApplication, memory_report, migrate_history, rebucket_threads
 from .config import Config, setup_logging
 
 app = typer.Typer()
@@ -22,6 +23,22 @@ def serve(
     app.run()
 
 
+@app.command(help="Start workers which process messages queued by server. Requires Redis queue backend.")
+def worker(
+    config_path: str = typer.Option(
+        ...,
+        "--config",
+        "-c",
+        help="Path to the YAML config file",
+        envvar="CONFIG_FILE",
+    )
+):
+    cfg = Config.from_path(config_path)
+    setup_logging(cfg.logging)
+    app = ServerApplication(cfg, listen=False)
+    app.run()
+
+
 @app.command(help="Start agent in inline chat mode. Used for AI prompt testing.")
 def chat(
     actor_email: str = typer.Option(
@@ -47,6 +64,56 @@ def chat(
     app.run()
 
 
+@app.command(help="Move chat histories stored by previous versions into the current format.")
+def migrate_chats(
+    config_path: str = typer.Option(
+        ...,
+        "--config",
+        "-c",
+        help="Path to the YAML config file",
+        envvar="CONFIG_FILE",
+    )
+):
+    cfg = Config.from_path(config_path)
+    setup_logging(cfg.logging)
+    asyncio.run(migrate_history(cfg))
+
+
+@app.command(
+    name="rebucket-threads",
+    help="Move message-to-thread mappings into `threads.bucket_count` buckets. Servers must be stopped.",
+)
+def rebucket(
+    config_path: str = typer.Option(
+        ...,
+        "--config",
+        "-c",
+        help="Path to the YAML config file",
+        envvar="CONFIG_FILE",
+    )
+):
+    cfg = Config.from_path(config_path)
+    setup_logging(cfg.logging)
+    asyncio.run(rebucket_threads(cfg))
+
+
+@app.command(help="Show Redis memory usage and encodings of keys grouped by prefix.")
+def memory(
+    max_keys: int = typer.Option(None, "--max-keys", "-n", help="Maximum number of keys to scan (all by default)"),
+    config_path: str = typer.Option(
+        ...,
+        "--config",
+        "-c",
+        help="Path to the YAML config file",
+        envvar="CONFIG_FILE",
+    ),
+):
+    cfg = Config.from_path(config_path)
+    setup_logging(cfg.logging)
+    for group in asyncio.run(memory_report(cfg, max_keys)):
+        print(group)
+
+
 def main():
     try:
         app()
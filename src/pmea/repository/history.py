@@ -0,0 +1,191 @@
+"""Chat history of a thread stored in a Redis list, one compact frame per message."""
+from collections import defaultdict
+import json
+import logging
+from typing import Any, Optional, Sequence
+import redis
+import redis.asyncio as aioredis
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from .keys import is_cluster
+
+REDIS_KEY_PREFIX_HISTORY = "history:"
+# Keys of `langchain_redis.RedisChatMessageHistory`: one JSON document per message.
+LEGACY_KEY_PREFIX_HISTORY = "chat:"
+
+# First byte of a frame tells how the rest of it is encoded.
+FRAME_JSON = b"j"
+FRAME_ZSTD = b"z"
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryCodec:
+    """
+    Encodes messages as compact JSON (fields with default values are omitted).
+    Frames larger than `min_size` are compressed with zstd if it's enabled.
+    """
+    _compressor: Any
+    _decompressor: Any
+    _min_size: int
+
+    def __init__(self, compression: Optional[str] = None, level: int = 3, min_size: int = 512):
+        self._compressor = None
+        self._decompressor = None
+        self._min_size = min_size
+        if compression == "zstd":
+            self._compressor = _zstd().ZstdCompressor(level=level)
+        elif compression is not None:
+            raise ValueError(f"unsupported chat history compression: {compression}")
+
+    def encode(self, message: BaseMessage) -> bytes:
+        raw = message_to_dict(message)
+        data = {k: v for k, v in raw["data"].items() if k == "content" or (k != "type" and not _is_default(v))}
+        payload = json.dumps([raw["type"], data], ensure_ascii=False, separators=(",", ":")).encode()
+        if self._compressor and len(payload) > self._min_size:
+            return FRAME_ZSTD + self._compressor.compress(payload)
+        return FRAME_JSON + payload
+
+    def decode(self, frame: bytes) -> BaseMessage:
+        kind, payload = frame[:1], frame[1:]
+        if kind == FRAME_ZSTD:
+            # Compressed frames may be read with compression disabled, e.g. after config change.
+            if not self._decompressor:
+                self._decompressor = _zstd().ZstdDecompressor()
+            payload = self._decompressor.decompress(payload)
+        elif kind != FRAME_JSON:
+            raise ValueError(f"unknown chat history frame type: {kind!r}")
+        msg_type, data = json.loads(payload)
+        return messages_from_dict([{"type": msg_type, "data": data}])[0]
+
+
+class RedisChatHistory(BaseChatMessageHistory):
+    """
+    Chat history kept in a Redis list. Whole history is loaded with one LRANGE and
+    messages of a turn are appended with one transaction, which also refreshes TTL.
+
+    Async methods use the application's asyncio Redis client. Sync methods (`RunnableWithMessageHistory.invoke`)
+    need a sync client, which isn't created by the application as its chains are always run with `ainvoke`.
+    """
+    _redis_client: aioredis.Redis
+    _sync_client: Optional[redis.Redis]
+    _key: str
+    _ttl: Optional[int]
+    _codec: HistoryCodec
+
+    def __init__(
+        self, redis_client: aioredis.Redis, session_id: str, codec: HistoryCodec, ttl: Optional[int] = None,
+        sync_client: Optional[redis.Redis] = None,
+    ):
+        self._redis_client = redis_client
+        self._sync_client = sync_client
+        self._key = f"{REDIS_KEY_PREFIX_HISTORY}{session_id}"
+        self._ttl = ttl
+        self._codec = codec
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        frames = self._get_sync_client().lrange(self._key, 0, -1)
+        return [self._codec.decode(f) for f in frames]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        client = self._get_sync_client()
+        with client.pipeline(transaction=not is_cluster(client)) as p:
+            p.rpush(self._key, *[self._codec.encode(m) for m in messages])
+            if self._ttl:
+                p.expire(self._key, self._ttl)
+            p.execute()
+
+    def clear(self) -> None:
+        self._get_sync_client().delete(self._key)
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        frames = await self._redis_client.lrange(self._key, 0, -1)
+        return [self._codec.decode(f) for f in frames]
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        async with self._redis_client.pipeline(transaction=not is_cluster(self._redis_client)) as p:
+            p.rpush(self._key, *[self._codec.encode(m) for m in messages])
+            if self._ttl:
+                p.expire(self._key, self._ttl)
+            await p.execute()
+
+    async def aclear(self) -> None:
+        await self._redis_client.delete(self._key)
+
+    def _get_sync_client(self) -> redis.Redis:
+        if self._sync_client is None:
+            raise RuntimeError("sync access to chat history requires a sync Redis client, use async methods instead")
+        return self._sync_client
+
+
+async def migrate_legacy_history(
+    redis_client: aioredis.Redis, codec: HistoryCodec, ttl: Optional[int] = None, batch_size: int = 500,
+) -> tuple[int, int]:
+    """
+    Moves histories stored by `langchain_redis.RedisChatMessageHistory` into `RedisChatHistory` lists.
+    Legacy messages are prepended to already existing lists and deleted. Requires RedisJSON to read them.
+
+    Only key names are collected up front, messages are loaded one session at a time.
+    Every session is written and its legacy keys are deleted at once, so an interrupted migration can be rerun.
+
+    Returns number of migrated sessions and messages.
+    """
+    # Legacy keys look like `chat:<session_id>:<ulid>`.
+    session_keys: dict[str, list[str]] = defaultdict(list)
+    async for key in redis_client.scan_iter(match=f"{LEGACY_KEY_PREFIX_HISTORY}*", count=batch_size):
+        key = key.decode() if isinstance(key, bytes) else key
+        session_id, sep, _ = key[len(LEGACY_KEY_PREFIX_HISTORY):].rpartition(":")
+        if sep:
+            session_keys[session_id].append(key)
+
+    session_count = message_count = 0
+    for session_id, keys in session_keys.items():
+        migrated = await _migrate_legacy_session(redis_client, codec, ttl, session_id, keys)
+        if migrated:
+            session_count += 1
+            message_count += migrated
+            logger.info(f"migrated {migrated} messages of chat history '{session_id}'")
+    return session_count, message_count
+
+
+async def _migrate_legacy_session(
+    redis_client: aioredis.Redis, codec: HistoryCodec, ttl: Optional[int], session_id: str, keys: list[str],
+) -> int:
+    items: list[tuple[float, str, BaseMessage]] = []
+    for key in keys:
+        doc = await redis_client.json().get(key)
+        if not isinstance(doc, dict) or doc.get("session_id") != session_id:
+            continue
+        message = messages_from_dict([{"type": doc["type"], "data": doc["data"]}])[0]
+        items.append((float(doc.get("timestamp", 0)), key, message))
+    if not items:
+        return 0
+
+    items.sort(key=lambda item: item[0])
+    key = f"{REDIS_KEY_PREFIX_HISTORY}{session_id}"
+    async with redis_client.pipeline(transaction=not is_cluster(redis_client)) as p:
+        p.lpush(key, *[codec.encode(m) for _, _, m in reversed(items)])
+        if ttl:
+            p.expire(key, ttl)
+        # Legacy keys are spread across slots on Redis Cluster.
+        for _, k, _ in items:
+            p.delete(k)
+        await p.execute()
+    return len(items)
+
+
+def _is_default(value: Any) -> bool:
+    return value is None or value is False or (isinstance(value, (str, list, dict)) and not value)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd compression of chat history requires 'zstandard' package, install 'domos-pmea[zstd]'")
+    return zstandard
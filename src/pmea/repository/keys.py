@@ -0,0 +1,18 @@
+"""Redis key helpers which keep multi-key operations working on Redis Cluster."""
+import redis
+import redis.asyncio as aioredis
+
+
+def is_cluster(redis_client: aioredis.Redis | redis.Redis) -> bool:
+    """Cluster client doesn't support transactions, multi-key operations have to stay within a slot."""
+    return isinstance(redis_client, (aioredis.RedisCluster, redis.RedisCluster))
+
+
+def hash_tagged(key: str, tag: str | None) -> str:
+    """
+    Prepends a hash tag to a key, so keys with the same tag are stored in the same cluster slot.
+    Keys which already have a tag and keys without a tag given are returned as is.
+    """
+    if not tag or ("{" in key and "}" in key[key.index("{") + 2:]):
+        return key
+    return f"{{{tag}}}{key}"
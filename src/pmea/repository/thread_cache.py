@@ -0,0 +1,155 @@
+"""In-process cache of message-to-thread mappings kept coherent by Redis client-side caching."""
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+from typing import Optional
+import redis.asyncio as aioredis
+from redis.asyncio.client import PubSub
+
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"hits={self.hits} misses={self.misses} hit_rate={self.hit_rate:.1%} "
+            f"invalidations={self.invalidations}"
+        )
+
+
+class ThreadCache:
+    """
+    Bounded LRU cache of message ID to thread ID mappings.
+
+    Mappings never change once written, so found threads are cached right away. Missing mappings
+    may be created by another replica at any moment, they're cached only while invalidation
+    messages are being received (see `track_invalidations`) and only if no invalidation
+    arrived while the lookup was in flight.
+
+    Each entry remembers Redis keys its mapping is stored in, invalidation of any of them drops the entry.
+    """
+    _max_size: int
+    _entries: OrderedDict[str, tuple[Optional[str], list[str]]]
+    _messages_by_key: dict[str, set[str]]
+    _generation: int
+    _tracking: bool
+    _stats: CacheStats
+    _logger: logging.Logger = logging.getLogger(__name__)
+
+    def __init__(self, max_size: int):
+        if max_size <= 0:
+            raise ValueError("thread cache size should be positive")
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._messages_by_key = {}
+        self._generation = 0
+        self._tracking = False
+        self._stats = CacheStats()
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._stats
+
+    @property
+    def generation(self) -> int:
+        """Changes on every invalidation. Captured before a lookup to guard caching of its result."""
+        return self._generation
+
+    def get(self, message_id: str) -> tuple[bool, Optional[str]]:
+        """Returns whether the message is cached and its thread ID (None if it's known to be missing)."""
+        if message_id not in self._entries:
+            self._stats.misses += 1
+            return False, None
+        self._stats.hits += 1
+        self._entries.move_to_end(message_id)
+        return True, self._entries[message_id][0]
+
+    def put(self, message_id: str, thread_id: Optional[str], keys: list[str], generation: int) -> None:
+        """Caches result of a lookup of Redis `keys` which started at `generation`."""
+        if thread_id is None and (not self._tracking or generation != self._generation):
+            return
+        self._drop(message_id)
+        self._entries[message_id] = (thread_id, keys)
+        for key in keys:
+            self._messages_by_key.setdefault(key, set()).add(message_id)
+        while len(self._entries) > self._max_size:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate(self, keys: Optional[list[str]]) -> None:
+        """Drops cached entries stored in Redis keys, or the whole cache if keys are unknown (None)."""
+        self._generation += 1
+        self._stats.invalidations += 1
+        if keys is None:
+            self._entries.clear()
+            self._messages_by_key.clear()
+            return
+        for key in keys:
+            for message_id in self._messages_by_key.get(key, set()).copy():
+                self._drop(message_id)
+
+    async def track_invalidations(self, redis_client: aioredis.Redis, key_prefixes: list[str], retry_delay: float = 1.0):
+        """
+        Subscribes to invalidation messages of all keys with given prefixes (broadcast tracking).
+
+        Tracking is bound to a connection, so once it breaks the cache is flushed
+        and missing mappings aren't cached until tracking is re-established.
+        """
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await self._subscribe(pubsub, key_prefixes)
+                self._tracking = True
+                self._logger.info(f"tracking invalidations of {key_prefixes} keys...")
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                    if msg and msg["type"] == "message":
+                        self._on_invalidate(msg["data"])
+            except Exception as e:
+                self._logger.error(f"thread cache invalidation tracking failed, retrying: {e}")
+            finally:
+                self._tracking = False
+                self.invalidate(None)
+                await pubsub.aclose()
+            await asyncio.sleep(retry_delay)
+
+    async def _subscribe(self, pubsub: PubSub, key_prefixes: list[str]):
+        # Tracking is enabled on the subscriber connection itself and redirected to it,
+        # which works with both RESP2 and RESP3 connections.
+        await pubsub.connect()
+        conn = pubsub.connection
+        await conn.send_command("CLIENT", "ID")
+        client_id = int(await conn.read_response())
+        prefix_args = [arg for prefix in key_prefixes for arg in ("PREFIX", prefix)]
+        await conn.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", *prefix_args)
+        await conn.read_response()
+        await pubsub.subscribe(INVALIDATE_CHANNEL)
+
+    def _on_invalidate(self, data) -> None:
+        if data is None:
+            self.invalidate(None)
+            return
+        keys = data if isinstance(data, list) else [data]
+        self.invalidate([k.decode() if isinstance(k, bytes) else k for k in keys])
+
+    def _drop(self, message_id: str) -> None:
+        entry = self._entries.pop(message_id, None)
+        if not entry:
+            return
+        for key in entry[1]:
+            messages = self._messages_by_key.get(key)
+            if messages is None:
+                continue
+            messages.discard(message_id)
+            if not messages:
+                del self._messages_by_key[key]
@@ -1,11 +1,23 @@
+import hashlib
+import logging
+import time
 import uuid
 import redis.asyncio as aioredis
 from redis.commands.core import AsyncScript
 from typing import Optional, Set
+from .keys import hash_tagged, is_cluster
+from .thread_cache import ThreadCache
 
 REDIS_KEY_PREFIX_THREAD = "thread:"
+# Message to thread mappings are spread over hashes, which stay compact (listpack) while small.
+REDIS_KEY_PREFIX_MSG_BUCKET = "msgs:"
+# Previous layout: string key per message. Still read until migrated, see `migrate_legacy_keys`.
 REDIS_KEY_PREFIX_MSG_ID = "msg:"
+# Bucket count mappings are stored with, see `check_bucket_count`.
+REDIS_KEY_MSG_BUCKET_COUNT = "msg_bucket_count"
+REDIS_KEY_THREAD_ACTIVITY = "thread_activity"
 REDIS_KEY_PREFIX_LAST_UID = "last_uid:"
+REDIS_KEY_PREFIX_MAILBOX_STATE = "mailbox_state:"
 
 MAX_UID_LUA = """
 local current = redis.call('GET', KEYS[1])
@@ -17,37 +29,215 @@ else
 end
 """
 
+# Same as above, but only if the fencing token still matches the lease.
+FENCED_MAX_UID_LUA = """
+if redis.call('GET', KEYS[2]) ~= ARGV[2] then
+  return 0
+end
+local current = redis.call('GET', KEYS[1])
+if (not current) or (tonumber(ARGV[1]) > tonumber(current)) then
+  redis.call('SET', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Resolves thread of a message and links the message to it atomically, marking the thread as active.
+# KEYS[1] is the thread activity set, then come bucket and legacy keys of the message
+# followed by ones of its parents in priority order. ARGV[3..] are bucket fields in the same order.
+# Returns thread ID and how it was resolved: 'existing' message, 'found' by parent or 'new' thread.
+# Thread key isn't known before the lookup, so the message is added to thread's set by the caller.
+RESOLVE_THREAD_LUA = """
+local function lookup(i)
+  return redis.call('HGET', KEYS[i], ARGV[2 + i / 2]) or redis.call('GET', KEYS[i + 1])
+end
+local tid = lookup(2)
+if tid then
+  return {tid, 'existing'}
+end
+local status = 'found'
+for i = 4, #KEYS, 2 do
+  tid = lookup(i)
+  if tid then
+    break
+  end
+end
+if not tid then
+  tid = ARGV[1]
+  status = 'new'
+end
+redis.call('HSET', KEYS[2], ARGV[3], tid)
+redis.call('ZADD', KEYS[1], ARGV[2], tid)
+return {tid, status}
+"""
+
+# Removes a thread which wasn't active since ARGV[2] with all its message mappings.
+# KEYS[1] is the thread activity set, KEYS[2] is the thread's message set, then come bucket and legacy
+# keys of its messages. ARGV[3..] are bucket fields in the same order. Messages are listed by the caller,
+# a message linked after that also refreshes thread activity, so the thread is kept.
+EXPIRE_THREAD_LUA = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) > tonumber(ARGV[2]) then
+  return 0
+end
+for i = 3, #KEYS, 2 do
+  redis.call('HDEL', KEYS[i], ARGV[2 + (i - 1) / 2])
+  redis.call('DEL', KEYS[i + 1])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Cluster variant of resolver's last step: links a message to a thread unless it's already linked.
+# Returns thread ID of the message and 1 if it was linked by this call.
+CLAIM_MESSAGE_LUA = """
+local tid = redis.call('HGET', KEYS[1], ARGV[1])
+if tid then
+  return {tid, 0}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return {ARGV[2], 1}
+"""
+
+# Cluster variant of thread expiration: forgets thread activity unless it was active after ARGV[2].
+FORGET_INACTIVE_LUA = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) > tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+return 1
+"""
+
+THREAD_RESOLVED_EXISTING = "existing"
+THREAD_RESOLVED_FOUND = "found"
+THREAD_RESOLVED_NEW = "new"
+
 class ThreadsRepository:
-    """Repository for keeping track of email message-to-thread mappings."""
+    """
+    Repository for keeping track of email message-to-thread mappings.
+
+    Message ID is mapped to a thread in a field of one of `bucket_count` hashes, fields are
+    message ID digests. Bucket count is saved with the mappings, changing it requires moving them with `rebucket`.
+
+    On Redis Cluster lookups of a message and its parents fan out to nodes in parallel, and a message
+    is linked to a thread with a single-key script. Mailbox state keys get `hash_tag`, which has to match
+    the tag of the leader lease key for fenced updates.
+    """
     _redis_client: aioredis.Redis
     _max_uid_script: AsyncScript
+    _fenced_max_uid_script: AsyncScript
+    _resolve_thread_script: AsyncScript
+    _expire_thread_script: AsyncScript
+    _claim_message_script: AsyncScript
+    _forget_inactive_script: AsyncScript
+    _cache: ThreadCache | None
+    _bucket_count: int
+    _cluster: bool
+    _hash_tag: str | None
+    _logger: logging.Logger = logging.getLogger(__name__)
 
-    def __init__(self, redis_client: aioredis.Redis):
+    def __init__(
+        self,
+        redis_client: aioredis.Redis,
+        cache: ThreadCache | None = None,
+        bucket_count: int = 1024,
+        hash_tag: str | None = None,
+    ):
+        """Message-to-thread mappings are served from `cache` if it's given."""
         self._redis_client = redis_client
+        self._cache = cache
+        self._bucket_count = bucket_count
+        self._cluster = is_cluster(redis_client)
+        self._hash_tag = hash_tag if self._cluster else None
         self._max_uid_script = self._redis_client.register_script(MAX_UID_LUA)
+        self._fenced_max_uid_script = self._redis_client.register_script(FENCED_MAX_UID_LUA)
+        self._resolve_thread_script = self._redis_client.register_script(RESOLVE_THREAD_LUA)
+        self._expire_thread_script = self._redis_client.register_script(EXPIRE_THREAD_LUA)
+        self._claim_message_script = self._redis_client.register_script(CLAIM_MESSAGE_LUA)
+        self._forget_inactive_script = self._redis_client.register_script(FORGET_INACTIVE_LUA)
+
+    def last_uid_key(self, email: str) -> str:
+        """Returns Redis key of last processed message UID, it shares a hash tag with the leader lease."""
+        return hash_tagged(f"{REDIS_KEY_PREFIX_LAST_UID}{email}", self._hash_tag)
 
     async def set_last_uid(self, email: str, uid: int) -> None:
         """Updates last processed message UID for a given email."""
-        key = f"{REDIS_KEY_PREFIX_LAST_UID}{email}"
+        key = self.last_uid_key(email)
         await self._max_uid_script(keys=[key], args=[uid])
 
+    async def set_last_uid_fenced(self, email: str, uid: int, lease_key: str, token: int) -> bool:
+        """
+        Updates last processed message UID if `lease_key` still holds a given fencing token.
+        Returns False if update was rejected.
+        """
+        key = self.last_uid_key(email)
+        ok = await self._fenced_max_uid_script(keys=[key, lease_key], args=[uid, token])
+        return bool(ok)
+
     async def get_last_uid(self, email: str) -> Optional[int]:
         """Returns last processed message UID for a given email."""
-        key = f"{REDIS_KEY_PREFIX_LAST_UID}{email}"
+        key = self.last_uid_key(email)
         value = await self._redis_client.get(key)
         return int(value) if value else None
 
+    async def get_mailbox_state(self, email: str) -> Optional[tuple[int, int]]:
+        """Returns UIDVALIDITY and HIGHESTMODSEQ of last mailbox synchronization for a given email."""
+        key = hash_tagged(f"{REDIS_KEY_PREFIX_MAILBOX_STATE}{email}", self._hash_tag)
+        uidvalidity, modseq = await self._redis_client.hmget(key, "uidvalidity", "highestmodseq")
+        if uidvalidity is None or modseq is None:
+            return None
+        return int(uidvalidity), int(modseq)
+
+    async def set_mailbox_state(self, email: str, uidvalidity: int, highestmodseq: int) -> None:
+        """Saves UIDVALIDITY and HIGHESTMODSEQ up to which all mailbox changes were processed."""
+        key = hash_tagged(f"{REDIS_KEY_PREFIX_MAILBOX_STATE}{email}", self._hash_tag)
+        await self._redis_client.hset(key, mapping={"uidvalidity": uidvalidity, "highestmodseq": highestmodseq})
+
     async def get_message_thread_id(self, message_id: str) -> Optional[str]:
         """
         Retrieves the thread ID associated with a given message ID.
         Returns None if the message ID is not found or not linked to any thread.
         """
-        key = f"{REDIS_KEY_PREFIX_MSG_ID}{message_id}"
-        ok = await self._redis_client.exists(key)
-        if not ok:
-            return None
-        value = await self._redis_client.get(key)
-        return value.decode('utf-8') if value else None
+        thread_ids = await self._get_thread_ids([message_id])
+        return thread_ids[message_id]
+
+    async def resolve_thread_id(self, message_id: str, parent_ids: list[str]) -> tuple[str, str]:
+        """
+        Finds a thread of a message by its parents (in priority order) or allocates a new one,
+        and links the message to it. Message is linked by a single script, so concurrent workers agree on a thread.
+
+        Already linked message is resolved in one round trip. A new message takes two: key of its thread
+        isn't known before the lookup, so the script can't declare it, and the message is added to
+        the thread's set with a separate SADD.
+
+        Returns thread ID and one of `THREAD_RESOLVED_*` statuses.
+        """
+        if self._cache:
+            cached, thread_id = self._cache.get(message_id)
+            if cached and thread_id:
+                return thread_id, THREAD_RESOLVED_EXISTING
+            generation = self._cache.generation
+        if self._cluster:
+            return await self._resolve_thread_id_fanout(message_id, parent_ids)
+
+        keys: list[str] = []
+        fields: list[str] = []
+        for m in [message_id, *(p for p in dict.fromkeys(parent_ids) if p != message_id)]:
+            bucket_key, field = self._message_slot(m)
+            keys += [bucket_key, f"{REDIS_KEY_PREFIX_MSG_ID}{m}"]
+            fields.append(field)
+        thread_id, status = await self._resolve_thread_script(
+            keys=[REDIS_KEY_THREAD_ACTIVITY, *keys],
+            args=[self.new_thread_id(), time.time(), *fields],
+        )
+        thread_id, status = _decode(thread_id), _decode(status)
+        if status != THREAD_RESOLVED_EXISTING:
+            # Second round trip. Thread was just marked as active, so it isn't expired before the message is added.
+            await self._redis_client.sadd(f"{REDIS_KEY_PREFIX_THREAD}{thread_id}", message_id)
+        if self._cache:
+            self._cache.put(message_id, thread_id, keys[:2], generation)
+        return thread_id, status
     
     async def lookup_thread_id(self, message_ids: list[str]) -> Optional[str]:
         """
@@ -56,10 +246,8 @@ class ThreadsRepository:
         """
         if not message_ids:
             return None
-        values = await self._redis_client.mget(*[f"{REDIS_KEY_PREFIX_MSG_ID}{m}" for m in message_ids])
-        parent_tid = next((v.decode()                     # first non-None
-                   for v in values if v), None)
-        return parent_tid
+        thread_ids = await self._get_thread_ids(message_ids)
+        return next((thread_ids[m] for m in message_ids if thread_ids[m]), None)
 
     def new_thread_id(self) -> str:
         """
@@ -70,16 +258,21 @@ class ThreadsRepository:
     async def add_thread_message(self, message_id: str, thread_id: str) -> None:
         """
         Links a message ID to a thread ID in Redis.
-        This involves two operations:
-        1. Storing the mapping from message_id to thread_id (msg:<message_id> -> thread_id).
+        This involves three operations:
+        1. Storing the mapping from message_id to thread_id in its bucket (msgs:<bucket> -> {digest: thread_id}).
         2. Adding the message_id to the set of messages for the thread (thread:<thread_id> -> {message_id, ...}).
+        3. Marking the thread as active, so it's not expired (see `expire_inactive_threads`).
         """
-        msg_key = f"{REDIS_KEY_PREFIX_MSG_ID}{message_id}"
+        bucket_key, field = self._message_slot(message_id)
         thread_key = f"{REDIS_KEY_PREFIX_THREAD}{thread_id}"
-        async with self._redis_client.pipeline(transaction=True) as p:
-            p.set(msg_key, thread_id)
+        async with self._redis_client.pipeline(transaction=not self._cluster) as p:
+            p.hset(bucket_key, field, thread_id)
             p.sadd(thread_key, message_id)
+            p.zadd(REDIS_KEY_THREAD_ACTIVITY, {thread_id: time.time()})
             await p.execute()
+        if self._cache:
+            keys = [bucket_key, f"{REDIS_KEY_PREFIX_MSG_ID}{message_id}"]
+            self._cache.put(message_id, thread_id, keys, self._cache.generation)
 
     async def get_thread_messages(self, thread_id: str) -> Set[str]:
         """
@@ -88,4 +281,202 @@ class ThreadsRepository:
         """
         key = f"{REDIS_KEY_PREFIX_THREAD}{thread_id}"
         result = await self._redis_client.smembers(key)
-        return result or set()
\ No newline at end of file
+        return result or set()
+
+    async def expire_inactive_threads(self, inactive_for: float, batch_size: int = 100) -> int:
+        """Removes threads without new messages for `inactive_for` seconds. Returns number of removed threads."""
+        cutoff = time.time() - inactive_for
+        removed = 0
+        while True:
+            thread_ids = await self._redis_client.zrangebyscore(
+                REDIS_KEY_THREAD_ACTIVITY, "-inf", cutoff, start=0, num=batch_size,
+            )
+            if not thread_ids:
+                return removed
+            for tid in thread_ids:
+                tid = _decode(tid)
+                if self._cluster:
+                    removed += await self._expire_thread_fanout(tid, cutoff)
+                    continue
+                thread_key = f"{REDIS_KEY_PREFIX_THREAD}{tid}"
+                keys, fields = [REDIS_KEY_THREAD_ACTIVITY, thread_key], []
+                for m in await self._redis_client.smembers(thread_key):
+                    m = _decode(m)
+                    bucket_key, field = self._message_slot(m)
+                    keys += [bucket_key, f"{REDIS_KEY_PREFIX_MSG_ID}{m}"]
+                    fields.append(field)
+                removed += await self._expire_thread_script(keys=keys, args=[tid, cutoff, *fields])
+
+    async def migrate_legacy_keys(self, batch_size: int = 500) -> int:
+        """
+        Moves mappings from per-message string keys into bucket hashes, marking their threads
+        as active now. Safe to run concurrently with other writers. Returns number of moved mappings.
+        """
+        moved = 0
+        legacy_keys: list[str] = []
+        async for key in self._redis_client.scan_iter(match=f"{REDIS_KEY_PREFIX_MSG_ID}*", count=batch_size):
+            legacy_keys.append(_decode(key))
+            if len(legacy_keys) >= batch_size:
+                moved += await self._migrate_legacy_batch(legacy_keys)
+                legacy_keys = []
+        if legacy_keys:
+            moved += await self._migrate_legacy_batch(legacy_keys)
+        return moved
+
+    async def check_bucket_count(self) -> None:
+        """
+        Saves bucket count on first start, then fails if mappings are stored in another number of buckets.
+        Mappings stored before the count was saved are assumed to use the configured count.
+        """
+        await self._redis_client.set(REDIS_KEY_MSG_BUCKET_COUNT, self._bucket_count, nx=True)
+        stored = int(await self._redis_client.get(REDIS_KEY_MSG_BUCKET_COUNT))
+        if stored != self._bucket_count:
+            raise Exception(
+                f"message mappings are stored in {stored} buckets, but {self._bucket_count} are configured: "
+                "move them with `domos-pmea rebucket-threads` while servers are stopped"
+            )
+
+    async def rebucket(self, batch_size: int = 100) -> int:
+        """
+        Moves mappings stored in another number of buckets into `bucket_count` buckets and saves the new count.
+        Bucket index can't be restored from a field, so messages are listed by message sets of known threads.
+        Servers must be stopped. Interrupted run can be restarted. Returns number of moved mappings.
+        """
+        stored = await self._redis_client.get(REDIS_KEY_MSG_BUCKET_COUNT)
+        moved = 0
+        if stored is not None and int(stored) != self._bucket_count:
+            thread_ids: list[str] = []
+            async for tid, _ in self._redis_client.zscan_iter(REDIS_KEY_THREAD_ACTIVITY, count=batch_size):
+                thread_ids.append(_decode(tid))
+                if len(thread_ids) >= batch_size:
+                    moved += await self._rebucket_batch(thread_ids, int(stored))
+                    thread_ids = []
+            if thread_ids:
+                moved += await self._rebucket_batch(thread_ids, int(stored))
+        await self._redis_client.set(REDIS_KEY_MSG_BUCKET_COUNT, self._bucket_count)
+        return moved
+
+    async def _rebucket_batch(self, thread_ids: list[str], old_bucket_count: int) -> int:
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for tid in thread_ids:
+                p.smembers(f"{REDIS_KEY_PREFIX_THREAD}{tid}")
+            thread_messages = await p.execute()
+        # Old and new buckets of a message differ, field stays the same.
+        slots: list[tuple[str, str, str]] = []
+        for message_ids in thread_messages:
+            for m in message_ids:
+                old_key, field = self._message_slot(_decode(m), old_bucket_count)
+                new_key, _ = self._message_slot(_decode(m))
+                if old_key != new_key:
+                    slots.append((old_key, new_key, field))
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for old_key, _, field in slots:
+                p.hget(old_key, field)
+            values = await p.execute()
+        moves = [(slot, _decode(tid)) for slot, tid in zip(slots, values) if tid]
+        # Old fields are deleted after all new ones are written, so an interrupted batch is moved again.
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for (_, new_key, field), tid in moves:
+                p.hsetnx(new_key, field, tid)
+            await p.execute()
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for (old_key, _, field), _ in moves:
+                p.hdel(old_key, field)
+            await p.execute()
+        return len(moves)
+
+    async def _migrate_legacy_batch(self, legacy_keys: list[str]) -> int:
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for key in legacy_keys:
+                p.get(key)
+            thread_ids = await p.execute()
+        now = time.time()
+        moved = 0
+        # Legacy key is deleted last, so an interrupted batch is moved again.
+        async with self._redis_client.pipeline(transaction=not self._cluster) as p:
+            for key, tid in zip(legacy_keys, thread_ids):
+                if not tid:
+                    continue
+                bucket_key, field = self._message_slot(key[len(REDIS_KEY_PREFIX_MSG_ID):])
+                p.hsetnx(bucket_key, field, tid)
+                p.zadd(REDIS_KEY_THREAD_ACTIVITY, {tid: now}, nx=True)
+                p.delete(key)
+                moved += 1
+            await p.execute()
+        return moved
+
+    async def _get_thread_ids(self, message_ids: list[str]) -> dict[str, Optional[str]]:
+        """Looks up threads of messages in one round trip, falling back to the legacy layout."""
+        thread_ids: dict[str, Optional[str]] = {}
+        if self._cache:
+            for m in message_ids:
+                cached, thread_id = self._cache.get(m)
+                if cached:
+                    thread_ids[m] = thread_id
+            generation = self._cache.generation
+
+        missing = [m for m in dict.fromkeys(message_ids) if m not in thread_ids]
+        if not missing:
+            return thread_ids
+        keys = {m: [*self._message_slot(m), f"{REDIS_KEY_PREFIX_MSG_ID}{m}"] for m in missing}
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for bucket_key, field, legacy_key in keys.values():
+                p.hget(bucket_key, field)
+                p.get(legacy_key)
+            values = await p.execute()
+        for i, m in enumerate(missing):
+            value = values[2 * i] or values[2 * i + 1]
+            thread_ids[m] = value.decode('utf-8') if value else None
+            if self._cache:
+                self._cache.put(m, thread_ids[m], [keys[m][0], keys[m][2]], generation)
+        return thread_ids
+
+    async def _resolve_thread_id_fanout(self, message_id: str, parent_ids: list[str]) -> tuple[str, str]:
+        parent_ids = [p for p in dict.fromkeys(parent_ids) if p != message_id]
+        thread_ids = await self._get_thread_ids([message_id, *parent_ids])
+        if thread_ids[message_id]:
+            return thread_ids[message_id], THREAD_RESOLVED_EXISTING
+
+        thread_id = next((thread_ids[p] for p in parent_ids if thread_ids[p]), None)
+        status = THREAD_RESOLVED_FOUND if thread_id else THREAD_RESOLVED_NEW
+        bucket_key, field = self._message_slot(message_id)
+        thread_id, linked = await self._claim_message_script(
+            keys=[bucket_key], args=[field, thread_id or self.new_thread_id()],
+        )
+        thread_id = _decode(thread_id)
+        if not linked:
+            # Concurrent worker has linked the same message first.
+            return thread_id, THREAD_RESOLVED_EXISTING
+
+        async with self._redis_client.pipeline(transaction=False) as p:
+            p.sadd(f"{REDIS_KEY_PREFIX_THREAD}{thread_id}", message_id)
+            p.zadd(REDIS_KEY_THREAD_ACTIVITY, {thread_id: time.time()})
+            await p.execute()
+        if self._cache:
+            keys = [bucket_key, f"{REDIS_KEY_PREFIX_MSG_ID}{message_id}"]
+            self._cache.put(message_id, thread_id, keys, self._cache.generation)
+        return thread_id, status
+
+    async def _expire_thread_fanout(self, thread_id: str, cutoff: float) -> int:
+        thread_key = f"{REDIS_KEY_PREFIX_THREAD}{thread_id}"
+        message_ids = await self._redis_client.smembers(thread_key)
+        if not await self._forget_inactive_script(keys=[REDIS_KEY_THREAD_ACTIVITY], args=[thread_id, cutoff]):
+            return 0
+        async with self._redis_client.pipeline(transaction=False) as p:
+            for m in message_ids:
+                m = _decode(m)
+                p.hdel(*self._message_slot(m))
+                p.delete(f"{REDIS_KEY_PREFIX_MSG_ID}{m}")
+            p.delete(thread_key)
+            await p.execute()
+        return 1
+
+    def _message_slot(self, message_id: str, bucket_count: int | None = None) -> tuple[str, str]:
+        """Returns key of a hash and a field which keep thread of a message."""
+        digest = hashlib.sha1(message_id.encode()).hexdigest()
+        bucket = int(digest[:8], 16) % (bucket_count or self._bucket_count)
+        return f"{REDIS_KEY_PREFIX_MSG_BUCKET}{bucket}", digest[8:24]
+
+
+def _decode(value: str | bytes) -> str:
+    return value.decode() if isinstance(value, bytes) else value
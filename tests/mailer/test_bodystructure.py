@@ -0,0 +1,45 @@
+from pmea.mailer.bodystructure import (
+    BodyPart,
+    decode_part_payload,
+    find_text_part,
+    parse_bodystructure,
+)
+
+
+def test_find_text_part_single():
+    attrs = b'UID 1 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "ISO-8859-1") NIL NIL "BASE64" 24 1 NIL NIL NIL NIL)'
+    part = find_text_part(parse_bodystructure(attrs))
+    assert part == BodyPart(section="1", encoding="base64", charset="ISO-8859-1", size=24)
+
+
+def test_find_text_part_nested_multipart():
+    attrs = (
+        b'UID 7 RFC822.SIZE 5000 BODYSTRUCTURE ('
+        b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+        b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 300 8 NIL NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL NIL)'
+        b'("IMAGE" "JPEG" ("NAME" {8}) NIL NIL "BASE64" 4000000 NIL ("ATTACHMENT" ("FILENAME" "a.jpg")) NIL NIL)'
+        b' "MIXED" ("BOUNDARY" "b0") NIL NIL NIL)'
+    )
+    part = find_text_part(parse_bodystructure(attrs))
+    assert part == BodyPart(section="1.1", encoding="quoted-printable", charset="utf-8", size=120)
+
+
+def test_find_text_part_skips_text_attachments():
+    attrs = (
+        b'BODYSTRUCTURE (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL ("ATTACHMENT" ("FILENAME" "log.txt")) NIL NIL)'
+        b'("TEXT" "PLAIN" NIL NIL NIL "8BIT" 20 1 NIL ("INLINE" NIL) NIL NIL) "MIXED")'
+    )
+    part = find_text_part(parse_bodystructure(attrs))
+    assert part is not None and part.section == "2"
+    assert part.charset == "utf-8"
+
+
+def test_find_text_part_html_only():
+    attrs = b'BODYSTRUCTURE (("TEXT" "HTML" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL NIL) "ALTERNATIVE")'
+    assert find_text_part(parse_bodystructure(attrs)) is None
+
+
+def test_decode_part_payload():
+    assert decode_part_payload(b"SGVsbG8s\r\nIHdvcmxk", "BASE64", "utf-8") == "Hello, world"
+    assert decode_part_payload(b"caf=E9 =\r\nau lait", "quoted-printable", "iso-8859-1") == "café au lait"
+    assert decode_part_payload(b"plain", "7bit", "x-unknown-charset") == "plain"
@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import pytest
+from pmea.mailer import Contact, Message, MessageHeaders
+from pmea.mailer.digest import DigestItem, ForwardDigest
+from pmea.mailer.sender import make_digest_message
+
+
+class InMemoryDigestBuffer:
+    """Digest buffer stub which keeps items in memory."""
+
+    def __init__(self):
+        self.items_by_dst: dict[str, list[DigestItem]] = {}
+        self.due: dict[str, float] = {}
+
+    async def add(self, dst_email: str, item: DigestItem, due_at: float) -> None:
+        self.items_by_dst.setdefault(dst_email, []).append(item)
+        self.due.setdefault(dst_email, due_at)
+
+    async def claim_due(self, now: float, lease: float, limit: int) -> list[str]:
+        due = [dst for dst, t in self.due.items() if t <= now][:limit]
+        for dst in due:
+            self.due[dst] = now + lease
+        return due
+
+    async def items(self, dst_email: str) -> list[DigestItem]:
+        return list(self.items_by_dst.get(dst_email, []))
+
+    async def commit(self, dst_email: str, count: int, next_due_at: float) -> None:
+        remaining = self.items_by_dst.get(dst_email, [])[count:]
+        self.items_by_dst[dst_email] = remaining
+        if remaining:
+            self.due[dst_email] = next_due_at
+        else:
+            self.due.pop(dst_email, None)
+
+
+def make_message(uid: int, subject: str) -> Message:
+    return Message(
+        uid=uid,
+        sender=Contact("Tenant", f"tenant{uid}@example.com"),
+        receiver=Contact("Agent", "agent@example.com"),
+        subject=subject,
+        body=f"{subject} in apartment {uid}",
+        sent_at=datetime.datetime(2025, 6, 2, 10, uid),
+        headers=MessageHeaders(f"<{uid}@example.com>", None, None),
+    )
+
+
+@pytest.mark.asyncio
+async def test_forwards_are_collected_per_recipient():
+    buffer = InMemoryDigestBuffer()
+    digest = ForwardDigest(buffer, window=0.03, lease=10, poll_interval=0.005)
+    sent: list[tuple[str, list[str]]] = []
+    send_started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def send(dst_email: str, items: list[DigestItem]):
+        send_started.set()
+        await release.wait()
+        sent.append((dst_email, [item.subject for item in items]))
+
+    for uid in [1, 2]:
+        await digest.add("manager@pmea.io", DigestItem.from_message(make_message(uid, "No water"), None))
+    await digest.add("plumber@pmea.io", DigestItem.from_message(make_message(3, "Leak"), "Urgent"))
+    run = asyncio.create_task(digest.run(send))
+    await asyncio.wait_for(send_started.wait(), timeout=1)
+
+    # Item added while digest is sent goes to the next one.
+    await digest.add("manager@pmea.io", DigestItem.from_message(make_message(4, "Elevator"), None))
+    release.set()
+    await asyncio.sleep(0.08)
+    run.cancel()
+
+    assert sorted(sent) == [
+        ("manager@pmea.io", ["Elevator"]),
+        ("manager@pmea.io", ["No water", "No water"]),
+        ("plumber@pmea.io", ["Leak"]),
+    ]
+    assert buffer.due == {}
+
+
+def test_make_digest_message():
+    items = [
+        DigestItem.from_message(make_message(1, "No water"), "Water is off in the building"),
+        DigestItem.from_message(make_message(2, "No water"), None),
+    ]
+    msg = make_digest_message(items, "agent@example.com", "<d@example.com>", "manager@pmea.io")
+
+    assert msg["Subject"] == "FWD: 2 messages"
+    content = msg.get_content()
+    assert "1. No water\nFrom tenant1@example.com" in content
+    assert "Water is off in the building" in content
+    assert "> No water in apartment 2" in content
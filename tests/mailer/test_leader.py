@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from pmea.mailer.leader import ACQUIRE_LUA, RELEASE_LUA, RENEW_LUA, Fence, LeaderElection
+
+
+class FakeLeaseRedis:
+    """Emulates lease scripts on top of a dict. Expiration is triggered manually."""
+
+    def __init__(self):
+        self.data: dict[str, int] = {}
+
+    def expire(self, key: str):
+        self.data.pop(key, None)
+
+    def register_script(self, script: str):
+        async def acquire(keys, args):
+            if keys[0] in self.data:
+                return None
+            self.data[keys[1]] = self.data.get(keys[1], 0) + 1
+            self.data[keys[0]] = self.data[keys[1]]
+            return self.data[keys[0]]
+
+        async def renew(keys, args):
+            return int(self.data.get(keys[0]) == args[0])
+
+        async def release(keys, args):
+            if self.data.get(keys[0]) == args[0]:
+                del self.data[keys[0]]
+                return 1
+            return 0
+
+        return {ACQUIRE_LUA: acquire, RENEW_LUA: renew, RELEASE_LUA: release}[script]
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_expired_lease():
+    redis = FakeLeaseRedis()
+    terms: list[tuple[str, int]] = []
+    stopped: list[str] = []
+
+    def make_task(name: str):
+        async def lead(fence: Fence):
+            terms.append((name, fence.token))
+            try:
+                await asyncio.Event().wait()
+            finally:
+                stopped.append(name)
+        return lead
+
+    first = LeaderElection(redis, "leader:test", ttl=0.1, renew_interval=0.01)
+    second = LeaderElection(redis, "leader:test", ttl=0.1, renew_interval=0.01)
+    first_run = asyncio.create_task(first.run(make_task("first")))
+    await asyncio.sleep(0.03)
+    second_run = asyncio.create_task(second.run(make_task("second")))
+    await asyncio.sleep(0.03)
+    assert terms == [("first", 1)]
+
+    # Stopped leader releases its lease, standby acquires it with a greater token.
+    first_run.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first_run
+    assert stopped == ["first"]
+    assert "leader:test" not in redis.data
+    await asyncio.sleep(0.05)
+    assert terms == [("first", 1), ("second", 2)]
+
+    # Leader steps down once its lease expired and was taken by someone else.
+    redis.expire("leader:test")
+    redis.data["leader:test"] = 3
+    await asyncio.sleep(0.03)
+    assert stopped == ["first", "second"]
+    assert redis.data["leader:test"] == 3
+    second_run.cancel()
+
+
+@pytest.mark.asyncio
+async def test_failed_leader_task_releases_lease():
+    redis = FakeLeaseRedis()
+    terms: list[int] = []
+
+    async def lead(fence: Fence):
+        terms.append(fence.token)
+        if len(terms) == 1:
+            raise Exception("listener failure")
+        await asyncio.Event().wait()
+
+    election = LeaderElection(redis, "leader:test", ttl=0.1, renew_interval=0.01)
+    run = asyncio.create_task(election.run(lead))
+    await asyncio.sleep(0.05)
+
+    # Failure doesn't stop the election, lease is released and acquired again.
+    assert not run.done()
+    assert terms == [1, 2]
+    assert redis.data["leader:test"] == 2
+    run.cancel()
@@ -0,0 +1,514 @@
+import asyncio
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
+from email.utils import format_datetime, parsedate_to_datetime
+import json
+import pytest
+from pmea.config import EmailConfig, ListenerOptions
+from pmea.mailer import IncomingMailListener, ListenerConfig, MailWorkers, Message
+from pmea.mailer.mail_listener import AdaptivePollInterval
+from pmea.mailer.retry import RetryTask
+from pmea.mailer.types import ParsedMessage
+
+
+DEFAULT_SENDER = "User <user@example.com>"
+
+
+def make_message(uid: int, sender: str = DEFAULT_SENDER, date: datetime.datetime | None = None) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Message-ID"] = f"<{uid}@example.com>"
+    msg["From"] = sender
+    msg["To"] = "agent@example.com"
+    msg["Subject"] = f"Message #{uid}"
+    msg["Date"] = format_datetime(date) if date else "Mon, 02 Jun 2025 10:00:00 +0000"
+    msg.set_content(f"Body of message #{uid}")
+    return msg
+
+
+def make_bodystructure(part: EmailMessage) -> str:
+    if part.is_multipart():
+        children = "".join(make_bodystructure(p) for p in part.iter_parts())
+        return f'({children} "{part.get_content_subtype().upper()}")'
+
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    charset = part.get_param("charset")
+    params = f'("CHARSET" "{charset}")' if charset else "NIL"
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+    payload = part.get_payload()
+    fields = f'"{maintype}" "{subtype}" {params} NIL NIL "{encoding}" {len(payload)}'
+    if maintype == "text":
+        fields += f" {len(payload.splitlines())}"
+    disposition = part.get_content_disposition()
+    disposition = f'("{disposition}" NIL)' if disposition else "NIL"
+    return f"({fields} NIL {disposition} NIL NIL)"
+
+
+def get_section(msg: EmailMessage, section: str) -> bytes:
+    part = msg
+    if section == "":
+        return msg.as_bytes()
+    for i in map(int, section.split(".")):
+        if part.is_multipart():
+            part = list(part.iter_parts())[i - 1]
+    return part.get_payload().encode()
+
+
+class FakeIMAPClient:
+    """Minimal stub of aioimaplib client which serves messages from memory."""
+
+    messages: dict[int, EmailMessage]
+    fetch_calls: list[str]
+    search_calls: list[str]
+
+    # If set - emulates CONDSTORE, mod-sequence of each message is its UID * 10.
+    uidvalidity: int | None = None
+
+    def __init__(self, uids: list[int], senders: dict[int, str] | None = None):
+        senders = senders or {}
+        self.messages = {uid: make_message(uid, senders.get(uid, DEFAULT_SENDER)) for uid in uids}
+        self.fetch_calls = []
+        self.search_calls = []
+        # Server rejects downloads which include these messages.
+        self.broken_uids: set[int] = set()
+        self.selected = False
+
+    async def select(self, _mailbox: str) -> tuple[str, list[bytes]]:
+        self.selected = True
+        uidnext = max(self.messages, default=0) + 1
+        lines = [f"{len(self.messages)} EXISTS".encode(), f"OK [UIDNEXT {uidnext}] Predicted next UID".encode()]
+        if self.uidvalidity is not None:
+            lines += [
+                f"OK [UIDVALIDITY {self.uidvalidity}] UIDs valid".encode(),
+                f"OK [HIGHESTMODSEQ {(uidnext - 1) * 10}] Highest".encode(),
+            ]
+        return "OK", lines + [b"Success"]
+
+    async def fetch(self, seq: str, parts: str) -> tuple[str, list[bytes]]:
+        assert parts == "(UID)"
+        uid = list(self.messages)[int(seq) - 1]
+        return "OK", [f"{seq} FETCH (UID {uid})".encode(), b"Success"]
+
+    async def uid_search(self, *criteria: str, charset: str | None) -> tuple[str, list[bytes]]:
+        self.search_calls.append(" ".join(criteria))
+        if criteria[0] == "SINCE":
+            since = datetime.datetime.strptime(criteria[1], "%d-%b-%Y").date()
+            uids = [uid for uid, msg in self.messages.items() if parsedate_to_datetime(msg["Date"]).astimezone().date() >= since]
+            return "OK", [" ".join(["SEARCH", *map(str, uids)]).encode(), b"Success"]
+
+        assert criteria[0] == "UID"
+        start, end = map(int, criteria[1].split(":"))
+        min_modseq = int(criteria[3]) if criteria[2:3] == ("MODSEQ",) else 0
+        # Like real servers, the last message matches a range above it.
+        uids = [uid for uid in self.messages if start <= uid <= end or uid == max(self.messages)]
+        uids = [uid for uid in uids if uid * 10 >= min_modseq]
+        line = " ".join(["SEARCH", *map(str, uids)])
+        if min_modseq and uids:
+            line += f" (MODSEQ {max(uids) * 10})"
+        return "OK", [line.encode(), b"Success"]
+
+    async def noop(self) -> tuple[str, list[bytes]]:
+        return "OK", [b"NOOP completed"]
+
+    async def status(self, mailbox: str, names: str) -> tuple[str, list[bytes]]:
+        # Servers may report stale state of the selected mailbox.
+        assert not self.selected
+        assert names == "(UIDNEXT)"
+        uidnext = max(self.messages, default=0) + 1
+        return "OK", [f"STATUS {mailbox} (UIDNEXT {uidnext})".encode(), b"Success"]
+
+    async def uid(self, command: str, *criteria: str) -> tuple[str, list[bytes]]:
+        # Like aioimaplib, only message set and message items are sent with UID FETCH.
+        assert command == "FETCH"
+        query, parts = criteria[0], criteria[1]
+        self.fetch_calls.append(f"{query} {parts}")
+        if self.broken_uids & set(map(int, query.split(","))):
+            return "NO", [b"Some messages could not be FETCHed (Failure)"]
+        lines: list[bytes] = []
+        for i, uid in enumerate(map(int, query.split(",")), 1):
+            msg = self.messages[uid]
+            raw = msg.as_bytes()
+            if "BODY.PEEK[HEADER.FIELDS" in parts:
+                headers = raw.split(b"\n\n", 1)[0] + b"\n\n"
+                prefix = (
+                    f"{i} FETCH (RFC822.SIZE {len(raw)} BODYSTRUCTURE {make_bodystructure(msg)} "
+                    f"BODY[HEADER.FIELDS (FROM)] {{{len(headers)}}}"
+                )
+                lines += [prefix.encode(), bytearray(headers), f" UID {uid})".encode()]
+                continue
+
+            section = parts[len("(UID BODY.PEEK["):-2]
+            data = get_section(msg, section)
+            lines += [f"{i} FETCH (UID {uid} BODY[{section}] {{{len(data)}}}".encode(), bytearray(data), b")"]
+        return "OK", lines + [b"Success"]
+
+
+class FakeIdleClient:
+    """Stub of IDLE connection which replays server pushes put to `pushes`."""
+
+    pushes: asyncio.Queue[list[bytes]]
+
+    def __init__(self):
+        self.pushes = asyncio.Queue()
+
+    async def idle_start(self, timeout: float):
+        pass
+
+    async def wait_server_push(self) -> list[bytes]:
+        return await self.pushes.get()
+
+    def idle_done(self):
+        pass
+
+
+class InMemoryUIDStore:
+    last_uid: int | None = None
+    mailbox_state: tuple[int, int] | None = None
+
+    async def get_last_uid(self, _email: str) -> int | None:
+        return self.last_uid
+
+    async def set_last_uid(self, _email: str, uid: int) -> None:
+        self.last_uid = max(uid, self.last_uid or 0)
+
+    async def get_mailbox_state(self, _email: str) -> tuple[int, int] | None:
+        return self.mailbox_state
+
+    async def set_mailbox_state(self, _email: str, uidvalidity: int, highestmodseq: int) -> None:
+        self.mailbox_state = (uidvalidity, highestmodseq)
+
+
+class CollectingConsumer:
+    messages: list[Message]
+
+    def __init__(self):
+        self.messages = []
+
+    async def consume_mail(self, m: Message) -> None:
+        self.messages.append(m)
+
+
+class RecordingDeadLetters:
+    def __init__(self):
+        self.dead: list[RetryTask] = []
+
+    async def dead_letter(self, task: RetryTask, replaces: RetryTask | None = None) -> None:
+        self.dead.append(task)
+
+
+def make_listener(msg_queue=None, dead_letters=None, **options) -> IncomingMailListener:
+    email_cfg = EmailConfig(
+        imap_host="imap.example.com",
+        smtp_host="smtp.example.com",
+        username="agent@example.com",
+        password="",
+    )
+    cfg = ListenerConfig(email_cfg, ListenerOptions(**options))
+    return IncomingMailListener(cfg, InMemoryUIDStore(), msg_queue, dead_letters)
+
+
+async def drain_queue(listener: IncomingMailListener) -> list[ParsedMessage]:
+    queued = []
+    while listener.queue.qsize():
+        entry = await listener.queue.get()
+        queued.append(entry.msg)
+    return queued
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 3])
+async def test_fetch_messages_in_chunks(pipeline_depth: int):
+    uids = [3, 4, 7, 8, 9]
+    listener = make_listener(msg_fetch_batch_size=2, fetch_pipeline_depth=pipeline_depth)
+    client = FakeIMAPClient(uids)
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+
+    queued = [m.uid for m in await drain_queue(listener)]
+    assert queued == uids
+    body_fetches = [c for c in client.fetch_calls if c.endswith("(UID BODY.PEEK[1])")]
+    assert body_fetches == [f"{uids} (UID BODY.PEEK[1])" for uids in ["3,4", "7,8", "9"]]
+
+
+@pytest.mark.asyncio
+async def test_fetch_messages_skips_ignored_senders():
+    uids = [1, 2, 3, 4, 5]
+    listener = make_listener(
+        msg_fetch_batch_size=3,
+        fetch_pipeline_depth=1,
+        ignore_addresses={"no-reply@example.com"},
+    )
+    client = FakeIMAPClient(uids, senders={
+        1: "Me <agent@example.com>",
+        3: "no-reply@example.com",
+        5: "no-reply@example.com",
+    })
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+
+    queued = [m.uid for m in await drain_queue(listener)]
+    assert queued == [2, 4]
+    body_fetches = [c for c in client.fetch_calls if c.endswith("(UID BODY.PEEK[1])")]
+    assert body_fetches == ["2 (UID BODY.PEEK[1])", "4 (UID BODY.PEEK[1])"]
+
+    await listener._ack_message(2)
+    assert listener._watermark.watermark == 3
+    await listener._ack_message(4)
+    assert listener._watermark.watermark == 5
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_parse_pool", [False, True])
+async def test_fetch_messages_downloads_only_text_part(use_parse_pool: bool):
+    listener = make_listener(msg_fetch_batch_size=10)
+    if use_parse_pool:
+        listener._parse_pool = ProcessPoolExecutor(max_workers=2)
+    client = FakeIMAPClient([1, 2])
+    msg = client.messages[2]
+    msg.set_content("Привет, the sink is leaking", charset="koi8-r", cte="quoted-printable")
+    msg.add_attachment(b"\xff" * 4096, maintype="image", subtype="jpeg", filename="leak.jpg")
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+    queued = await drain_queue(listener)
+    assert [m.uid for m in queued] == [1, 2]
+    assert client.fetch_calls[-1] == "1,2 (UID BODY.PEEK[1])"
+
+    consumer = CollectingConsumer()
+    workers = MailWorkers(listener.queue, consumer, worker_count=1, shard_size=10)
+    for msg in queued:
+        await workers._handle_message(msg.to_message())
+    bodies = [m.body.strip() for m in consumer.messages]
+    assert bodies == ["Body of message #1", "Привет, the sink is leaking"]
+    assert consumer.messages[1].headers.msg_id == "<2@example.com>"
+
+    if listener._parse_pool:
+        listener._parse_pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_unfetched_and_malformed_messages_are_dead_lettered():
+    dead_letters = RecordingDeadLetters()
+    listener = make_listener(dead_letters=dead_letters, msg_fetch_batch_size=3)
+    client = FakeIMAPClient([1, 2, 3, 4])
+    client.broken_uids = {2}
+    client.messages[4].replace_header("Date", "yesterday")
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+
+    assert [m.uid for m in await drain_queue(listener)] == [1, 3]
+    assert [(t.stage, json.loads(t.payload)["uid"]) for t in dead_letters.dead] == [("fetch", 2), ("fetch", 4)]
+    await listener._ack_message(1)
+    await listener._ack_message(3)
+    assert listener._watermark.watermark == 4
+
+
+class DurableQueue:
+    """Stub of a durable queue which keeps messages in a list."""
+    durable = True
+
+    def __init__(self):
+        self.messages = []
+
+    async def put(self, msg: ParsedMessage) -> None:
+        self.messages.append(msg)
+
+
+@pytest.mark.asyncio
+async def test_fetch_messages_acks_durably_queued_messages():
+    msg_queue = DurableQueue()
+    listener = make_listener(msg_queue, uid_flush_batch_size=1)
+    listener._client = FakeIMAPClient([1, 2, 3])
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+
+    assert [m.uid for m in msg_queue.messages] == [1, 2, 3]
+    assert listener._watermark.watermark == 3
+
+
+@pytest.mark.asyncio
+async def test_stop_flushes_acked_messages():
+    listener = make_listener(uid_flush_batch_size=100)
+    acked = asyncio.Event()
+
+    async def connect_and_idle():
+        listener._watermark.track(1)
+        await listener._ack_message(1)
+        acked.set()
+        await asyncio.Event().wait()
+
+    listener._connect_and_idle = connect_and_idle
+    task = asyncio.create_task(listener.start())
+    await asyncio.wait_for(acked.wait(), timeout=1)
+    assert listener._store.last_uid is None
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert listener._store.last_uid == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_messages_changed_since_last_modseq():
+    listener = make_listener(uid_flush_batch_size=1)
+    store = listener._store
+    store.last_uid, store.mailbox_state = 4, (7, 40)
+    client = FakeIMAPClient([1, 2, 3, 4, 5, 6])
+    client.uidvalidity = 7
+    listener._client = client
+    listener._condstore = True
+    await listener._watermark.load()
+    listener._mailbox_state = await store.get_mailbox_state("")
+
+    await listener._fetch_messages()
+    assert client.search_calls == ["UID 5:6 MODSEQ 41"]
+    queued = await drain_queue(listener)
+    assert [m.uid for m in queued] == [5, 6]
+
+    # Mailbox state is saved only after all messages are processed.
+    assert store.mailbox_state == (7, 40)
+    for msg in queued:
+        await listener._ack_message(msg.uid)
+    assert store.mailbox_state == (7, 60)
+
+    # UIDVALIDITY change falls back to full resync.
+    client.search_calls.clear()
+    client.uidvalidity = 8
+    client.messages[7] = make_message(7)
+    await listener._fetch_messages()
+    assert client.search_calls == ["UID 7:7"]
+
+
+@pytest.mark.asyncio
+async def test_idle_connection_signals_fetch_connection():
+    listener = make_listener()
+    client = FakeIMAPClient([1])
+    idle_client = FakeIdleClient()
+    listener._client = client
+    listener._idle_client = idle_client
+    listener._running = True
+    await listener._watermark.load()
+
+    # Missed messages are fetched without waiting for a push.
+    listener._signal_change("resync")
+    tasks = [asyncio.create_task(listener._idle_loop()), asyncio.create_task(listener._fetch_loop())]
+    try:
+        first = await asyncio.wait_for(listener.queue.get(), timeout=1)
+        client.messages[2] = make_message(2)
+        await idle_client.pushes.put([b"1 RECENT"])
+        await idle_client.pushes.put([b"2 EXISTS"])
+        second = await asyncio.wait_for(listener.queue.get(), timeout=1)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    assert [first.msg.uid, second.msg.uid] == [1, 2]
+    # Only EXISTS push triggers a fetch.
+    assert client.search_calls == ["UID 1:1", "UID 2:2"]
+
+
+@pytest.mark.asyncio
+async def test_status_poll_detects_messages_without_push():
+    listener = make_listener()
+    listener._poll_interval = AdaptivePollInterval(0.01, 0.04, 2)
+    client = FakeIMAPClient([1])
+    listener._client = client
+    listener._status_client = FakeIMAPClient([])
+    listener._status_client.messages = client.messages
+    listener._idle_client = FakeIdleClient()
+    listener._running = True
+    await listener._watermark.load()
+
+    listener._signal_change("resync")
+    tasks = [asyncio.create_task(listener._idle_loop()), asyncio.create_task(listener._fetch_loop())]
+    try:
+        await asyncio.wait_for(listener.queue.get(), timeout=1)
+        # Quiet mailbox backs off up to the max interval.
+        await asyncio.sleep(0.1)
+        assert listener._poll_interval.value == 0.04
+
+        client.messages[2] = make_message(2)
+        entry = await asyncio.wait_for(listener.queue.get(), timeout=1)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    assert entry.msg.uid == 2
+    assert listener._poll_interval.value == 0.01
+    assert listener.arrival_metrics.get("poll").count == 1
+    assert listener.arrival_metrics.get("push").count == 0
+
+
+@pytest.mark.asyncio
+async def test_status_poll_failure_keeps_fetch_connection():
+    class BrokenStatusClient(FakeIMAPClient):
+        async def status(self, mailbox: str, names: str) -> tuple[str, list[bytes]]:
+            raise ConnectionResetError("connection lost")
+
+    listener = make_listener()
+    listener._poll_interval = AdaptivePollInterval(0.01, 0.04, 2)
+    client = FakeIMAPClient([1])
+    listener._client = client
+    listener._status_client = BrokenStatusClient([])
+
+    await listener._poll_status()
+
+    # Only STATUS connection is dropped, it's reopened on the next poll.
+    assert listener._client is client
+    assert listener._status_client is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_messages_searches_sparse_uids_once():
+    listener = make_listener(uid_page_size=3)
+    client = FakeIMAPClient([2, 3, 700, 8000, 9000, 10000, 110000])
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._fetch_messages()
+
+    uids = [2, 3, 700, 8000, 9000, 10000, 110000]
+    assert [m.uid for m in await drain_queue(listener)] == uids
+    assert client.search_calls == ["UID 1:110000"]
+    # Messages are downloaded in pages of found UIDs.
+    body_fetches = [c.split()[0] for c in client.fetch_calls if c.endswith("(UID BODY.PEEK[1])")]
+    assert body_fetches == ["2,3,700", "8000,9000,10000", "110000"]
+
+    # Range above the last message still matches it on the server.
+    assert await listener._search_new_uids(110000, 110005, None) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "options,expected",
+    [
+        ({}, [1, 2, 3, 4, 5]),
+        ({"initial_sync_max_count": 2}, [4, 5]),
+        ({"initial_sync_days": 3}, [3, 4, 5]),
+        ({"initial_sync_days": 3, "initial_sync_max_count": 1}, [5]),
+        ({"initial_sync_skip_history": True}, []),
+    ],
+)
+async def test_initial_sync_window(options: dict, expected: list[int]):
+    listener = make_listener(**options)
+    now = datetime.datetime.now(datetime.UTC)
+    client = FakeIMAPClient([])
+    client.messages = {uid: make_message(uid, date=now - datetime.timedelta(days=6 - uid)) for uid in range(1, 6)}
+    listener._client = client
+    await listener._watermark.load()
+
+    await listener._initial_sync()
+    await listener._fetch_messages()
+
+    assert [m.uid for m in await drain_queue(listener)] == expected
+    # Skipped history is persisted, so it's not processed after restart.
+    if expected != [1, 2, 3, 4, 5]:
+        assert listener._store.last_uid == (expected[0] - 1 if expected else 5)
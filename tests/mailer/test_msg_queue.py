@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import os
+import pytest
+import pytest_asyncio
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from pmea.mailer import InMemoryMessageQueue, RedisStreamQueue, SpillingMessageQueue
+from pmea.mailer.leader import Fence
+from pmea.mailer.retry import RetryTask
+from pmea.mailer.types import Contact, MessageHeaders, ParsedMessage
+
+# Scripts are also checked against a real server, database is flushed by these tests.
+TEST_REDIS_DSN = os.getenv("TEST_REDIS_DSN", "redis://localhost:6379/0")
+
+
+def make_parsed_message(uid: int) -> ParsedMessage:
+    return ParsedMessage(
+        uid=uid,
+        size=100,
+        sender=Contact("Юзер", "user@example.com"),
+        receiver=Contact("", "agent@example.com"),
+        subject=f"Message #{uid}",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0, tzinfo=datetime.timezone.utc),
+        headers=MessageHeaders(f"<{uid}@example.com>", "<0@example.com>", ["<0@example.com>"]),
+        body="Привет",
+    )
+
+
+@pytest.mark.asyncio
+async def test_in_memory_queue_reports_acks():
+    acked: list[int] = []
+
+    async def on_ack(uid: int):
+        acked.append(uid)
+
+    q = InMemoryMessageQueue(10, on_ack)
+    assert not q.durable
+    for uid in [1, 2]:
+        await q.put(make_parsed_message(uid))
+
+    entry = await q.get()
+    assert entry.msg.uid == 1
+    await q.ack(entry)
+    assert acked == [1]
+
+
+@pytest.mark.asyncio
+async def test_spilling_queue_keeps_order_within_byte_budget(tmp_path):
+    async def on_ack(uid: int):
+        pass
+
+    # Each message takes 16 bytes, 2 fit into memory. Each spilled message gets its own segment.
+    q = SpillingMessageQueue(40, on_ack, spill_dir=str(tmp_path), segment_size=1)
+    for uid in range(1, 5):
+        await q.put(make_parsed_message(uid))
+    assert q.qsize() == 4
+    assert q.metrics.memory_bytes == 32
+    assert q.metrics.spilled_count == 2
+    assert q.metrics.spill_rate == 0.5
+    spilled_dir = os.path.join(tmp_path, os.listdir(tmp_path)[0])
+    assert len(os.listdir(spilled_dir)) == 2
+
+    # Taken message stays in the budget until it's acknowledged.
+    first = await q.get()
+    assert first.msg.uid == 1
+    await q.put(make_parsed_message(5))
+    assert q.metrics.spill_depth == 3
+    second = await q.get()
+    third = await q.get()
+    assert q.metrics.memory_bytes == 48
+    get = asyncio.create_task(q.get())
+    await asyncio.sleep(0.01)
+    assert not get.done()
+
+    # Memory is freed on ack, new message was spilled after previous ones to keep the order.
+    for entry in [first, second, third]:
+        await q.ack(entry)
+    fourth = await asyncio.wait_for(get, timeout=1)
+    await q.ack(fourth)
+    fifth = await q.get()
+    await q.ack(fifth)
+    assert [e.msg.uid for e in [second, third, fourth, fifth]] == [2, 3, 4, 5]
+    assert (q.metrics.memory_bytes, q.metrics.spilled_bytes, q.metrics.spill_depth) == (0, 0, 0)
+    assert os.listdir(spilled_dir) == []
+
+    # Drained queue keeps messages in memory again.
+    await q.put(make_parsed_message(6))
+    assert q.metrics.spilled_count == 3
+    entry = await q.get()
+    assert entry.msg == make_parsed_message(6)
+
+
+@pytest.mark.asyncio
+async def test_spilling_queue_blocks_when_disk_budget_is_exhausted(tmp_path):
+    async def on_ack(uid: int):
+        pass
+
+    q = SpillingMessageQueue(0, on_ack, spill_dir=str(tmp_path), max_spill_bytes=1)
+    await q.put(make_parsed_message(1))
+    put = asyncio.create_task(q.put(make_parsed_message(2)))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+
+    entry = await q.get()
+    assert entry.msg.uid == 1
+    await asyncio.wait_for(put, timeout=1)
+    await q.ack(entry)
+    assert (await q.get()).msg.uid == 2
+
+
+class FakeStreamPipeline:
+    def __init__(self, redis: "FakeStreamRedis"):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def xack(self, key: str, group: str, entry_id: str):
+        self.redis.acked.append(entry_id)
+
+    def xdel(self, key: str, entry_id: str):
+        pass
+
+    async def execute(self):
+        pass
+
+
+class FakeStreamRedis:
+    """Records acknowledged and claimed stream entries."""
+
+    def __init__(self):
+        self.acked: list[str] = []
+        self.claimed: list[str] = []
+
+    async def xclaim(self, key: str, group: str, consumer: str, min_idle_time: int, message_ids: list[str], justid: bool):
+        assert justid
+        self.claimed += message_ids
+
+    async def xpending(self, key: str, group: str):
+        return {"pending": len(self.claimed)}
+
+    def pipeline(self, transaction: bool):
+        return FakeStreamPipeline(self)
+
+
+class RecordingDeadLetters:
+    def __init__(self):
+        self.dead: list[RetryTask] = []
+
+    async def dead_letter(self, task: RetryTask, replaces: RetryTask | None = None) -> None:
+        self.dead.append(task)
+
+
+@pytest.mark.asyncio
+async def test_redis_stream_entries_parsing():
+    redis, dead_letters = FakeStreamRedis(), RecordingDeadLetters()
+    q = RedisStreamQueue(
+        redis, stream_key="s", group="g", consumer_name="c", claim_idle=10, read_count=10, dead_letters=dead_letters,
+    )
+    msg = make_parsed_message(5)
+    added = await q._add_entries([
+        (b"1-0", {b"msg": msg.to_json().encode()}),
+        (b"2-0", {b"msg": b"{not json"}),
+        # Entry deleted before it was claimed.
+        (b"3-0", None),
+    ])
+    assert added == 1
+    entry = q._buffer.popleft()
+    assert entry.entry_id == "1-0"
+    assert entry.msg == msg
+    # Malformed entry isn't reclaimed again.
+    assert redis.acked == ["2-0"]
+    assert [(t.stage, t.payload) for t in dead_letters.dead] == [("consume", "{not json")]
+
+
+@pytest.mark.asyncio
+async def test_redis_stream_keeps_entries_in_progress_claimed():
+    redis = FakeStreamRedis()
+    q = RedisStreamQueue(redis, stream_key="s", group="g", consumer_name="c", claim_idle=10, read_count=10)
+    entries = [(f"{uid}-0".encode(), {b"msg": make_parsed_message(uid).to_json().encode()}) for uid in (1, 2)]
+    assert await q._add_entries(entries) == 2
+    await q.ack(await q.get())
+
+    await q._touch_in_progress()
+    assert redis.claimed == ["2-0"]
+    # Entry reclaimed from this consumer isn't handed over twice.
+    assert await q._add_entries(entries[1:]) == 0
+    assert len(q._buffer) == 1
+    assert await q.stats() == "pending=1 in_progress=1"
+
+
+@pytest_asyncio.fixture
+async def redis_client():
+    client = aioredis.from_url(TEST_REDIS_DSN)
+    try:
+        await client.ping()
+    except Exception as e:
+        await client.aclose()
+        pytest.skip(f"Redis is unavailable: {e}")
+    await client.flushdb()
+    yield client
+    await client.flushdb()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_fenced_stream_advances_last_uid_with_each_message(redis_client):
+    q = RedisStreamQueue(redis_client, stream_key="s", group="g", consumer_name="c", claim_idle=10, read_count=10)
+    await q.ensure_group()
+    await redis_client.set("lease", 2)
+    await redis_client.set("last_uid:agent", 3)
+    fenced = q.with_fence(Fence("lease", 2), "last_uid:agent")
+
+    await fenced.put(make_parsed_message(5))
+    assert await redis_client.get("last_uid:agent") == b"5"
+    # Last UID never moves back.
+    await fenced.put(make_parsed_message(4))
+    assert await redis_client.get("last_uid:agent") == b"5"
+
+    # Messages of a stale leader are neither queued nor advance last UID.
+    await redis_client.set("lease", 3)
+    with pytest.raises(ResponseError, match="stale"):
+        await fenced.put(make_parsed_message(6))
+    assert await redis_client.get("last_uid:agent") == b"5"
+    assert await redis_client.xlen("s") == 2
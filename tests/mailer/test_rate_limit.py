@@ -0,0 +1,54 @@
+import pytest
+from pmea.config import SendRateLimit
+from pmea.mailer.rate_limit import SendRateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_budgets_are_separate_per_kind():
+    clock = FakeClock()
+    limiter = SendRateLimiter(
+        {"reply": SendRateLimit(per_minute=2, per_day=3), "forward": SendRateLimit(per_minute=1)},
+        throttle_pause=30,
+        clock=clock,
+    )
+
+    assert [limiter.reserve("reply") for _ in range(2)] == [0, 0]
+    assert limiter.reserve("reply") == pytest.approx(30)
+    assert limiter.reserve("forward") == 0
+    assert limiter.status() == "reply: 0/2 per 60s, 1/3 per 86400s; forward: 0/1 per 60s"
+
+    # Minute budget is refilled evenly, daily budget runs out.
+    clock.now += 60
+    assert limiter.reserve("reply") == 0
+    assert limiter.reserve("reply") == pytest.approx(86400 / 3 - 60)
+
+    # Tokens of a message which wasn't sent are returned.
+    limiter.refund("reply")
+    assert limiter.reserve("reply") == 0
+
+
+def test_throttling_pauses_and_slows_down_refill():
+    clock = FakeClock()
+    limiter = SendRateLimiter({"reply": SendRateLimit(per_minute=2)}, throttle_pause=30, clock=clock)
+    assert limiter.reserve("reply") == 0
+
+    limiter.throttled()
+    assert limiter.reserve("reply") == pytest.approx(30)
+
+    # Refill rate is halved after the pause.
+    clock.now += 30
+    assert limiter.reserve("reply") == 0
+    assert limiter.reserve("reply") == pytest.approx(30)
+    assert limiter.status() == "reply: 0/2 per 60s; refill rate 50%"
+
+    # Delivered messages restore refill rate gradually.
+    for _ in range(10):
+        limiter.delivered()
+    assert limiter.status() == "reply: 0/2 per 60s"
@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+import pytest
+from pmea.config import RetryPolicy
+from pmea.mailer import Contact, InMemoryMessageQueue, MailWorkers, Message, MessageHeaders
+from pmea.mailer.retry import RetryDispatcher, RetryTask, backoff_delay
+from pmea.mailer.types import ParsedMessage
+
+
+class InMemoryDelayQueue:
+    """Delay queue stub which keeps tasks in memory."""
+
+    def __init__(self):
+        self.scheduled: dict[str, float] = {}
+        self.dead: list[RetryTask] = []
+
+    async def schedule(self, task: RetryTask, due_at: float, replaces: RetryTask | None = None) -> None:
+        if replaces:
+            self.scheduled.pop(replaces.to_json(), None)
+        self.scheduled[task.to_json()] = due_at
+
+    async def claim_due(self, stage: str, now: float, lease: float, limit: int) -> list[RetryTask]:
+        due = [m for m, t in self.scheduled.items() if t <= now][:limit]
+        for m in due:
+            self.scheduled[m] = now + lease
+        return [RetryTask.from_json(m) for m in due]
+
+    async def remove(self, task: RetryTask) -> None:
+        self.scheduled.pop(task.to_json(), None)
+
+    async def dead_letter(self, task: RetryTask, replaces: RetryTask | None = None) -> None:
+        if replaces:
+            self.scheduled.pop(replaces.to_json(), None)
+        self.dead.append(task)
+
+
+class FlakyConsumer:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.messages: list[Message] = []
+        self.rejected: list[int] = []
+        self.done = asyncio.Event()
+
+    async def consume_mail(self, m: Message) -> None:
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("429 Too Many Requests")
+        self.messages.append(m)
+        self.done.set()
+
+    async def reject_mail(self, m: Message, err: Exception) -> None:
+        self.rejected.append(m.uid)
+        self.done.set()
+
+
+def make_parsed_message(uid: int) -> ParsedMessage:
+    return ParsedMessage(
+        uid=uid,
+        size=100,
+        sender=Contact("", "user@example.com"),
+        receiver=Contact("", "agent@example.com"),
+        subject=f"Message #{uid}",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders(f"<{uid}@example.com>", None, None),
+        body=f"Body of message #{uid}",
+    )
+
+
+def make_dispatcher(delay_queue: InMemoryDelayQueue, max_attempts: int) -> RetryDispatcher:
+    policy = RetryPolicy(max_attempts=max_attempts, base_delay=0.01, max_delay=0.02)
+    return RetryDispatcher(delay_queue, "consume", policy, lease=10, poll_interval=0.005, claim_count=10)
+
+
+def test_backoff_delay():
+    policy = RetryPolicy(max_attempts=4, base_delay=10, max_delay=25)
+    for attempt, (lo, hi) in enumerate([(5, 10), (10, 20), (12.5, 25)], 1):
+        assert lo <= backoff_delay(policy, attempt) <= hi
+    assert backoff_delay(policy, 4) is None
+
+
+async def run_workers(consumer: FlakyConsumer, retries: RetryDispatcher) -> list[int]:
+    acked: list[int] = []
+
+    async def on_ack(uid: int):
+        acked.append(uid)
+
+    q = InMemoryMessageQueue(10, on_ack)
+    workers = MailWorkers(q, consumer, worker_count=1, shard_size=1, retries=retries)
+    await q.put(make_parsed_message(1))
+    task = asyncio.create_task(workers.run())
+    await asyncio.wait_for(consumer.done.wait(), timeout=1)
+    task.cancel()
+    return acked
+
+
+@pytest.mark.asyncio
+async def test_failed_message_is_retried_later():
+    delay_queue = InMemoryDelayQueue()
+    consumer = FlakyConsumer(failures=2)
+
+    acked = await run_workers(consumer, make_dispatcher(delay_queue, max_attempts=3))
+
+    # Original queue entry is released after the first failure.
+    assert acked == [1]
+    assert [m.uid for m in consumer.messages] == [1]
+    assert delay_queue.scheduled == {}
+    assert delay_queue.dead == []
+
+
+@pytest.mark.asyncio
+async def test_exhausted_message_is_dead_lettered():
+    delay_queue = InMemoryDelayQueue()
+    consumer = FlakyConsumer(failures=5)
+
+    await run_workers(consumer, make_dispatcher(delay_queue, max_attempts=2))
+
+    assert consumer.rejected == [1]
+    assert delay_queue.scheduled == {}
+    assert [(t.attempt, t.error) for t in delay_queue.dead] == [(2, "429 Too Many Requests")]
+    assert ParsedMessage.from_json(delay_queue.dead[0].payload).uid == 1
+
+
+@pytest.mark.asyncio
+async def test_enqueued_tasks_are_handled_concurrently():
+    delay_queue = InMemoryDelayQueue()
+    dispatcher = make_dispatcher(delay_queue, max_attempts=3)
+    release = asyncio.Event()
+    running: list[str] = []
+    handled: list[str] = []
+
+    async def handler(task: RetryTask):
+        running.append(task.payload)
+        await release.wait()
+        handled.append(task.payload)
+        await dispatcher.done(task)
+
+    run = asyncio.create_task(dispatcher.run(handler, concurrency=2))
+    for payload in ["a", "b", "c"]:
+        await dispatcher.enqueue(payload)
+    await asyncio.sleep(0.02)
+    assert sorted(running) == ["a", "b"]
+
+    release.set()
+    await asyncio.sleep(0.02)
+    run.cancel()
+    assert sorted(handled) == ["a", "b", "c"]
+    assert delay_queue.scheduled == {}
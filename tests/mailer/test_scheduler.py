@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from pmea.mailer.scheduler import KeyedScheduler
+
+
+@pytest.mark.asyncio
+async def test_scheduler_keeps_order_within_key():
+    handled: list[tuple[int, str, int]] = []
+    in_progress: set[str] = set()
+
+    async def handler(worker_id: int, item: tuple[str, int]):
+        key, seq = item
+        assert key not in in_progress, "same key is handled concurrently"
+        in_progress.add(key)
+        await asyncio.sleep(0.001 * (3 - seq % 3))
+        handled.append((worker_id, key, seq))
+        in_progress.discard(key)
+
+    scheduler = KeyedScheduler[tuple[str, int]](shard_count=4, shard_size=2, handler=handler)
+    tasks = scheduler.start()
+    keys = [f"<thread-{i}@example.com>" for i in range(6)]
+    for seq in range(5):
+        for key in keys:
+            await scheduler.put(key, (key, seq))
+    await scheduler.join()
+    for t in tasks:
+        t.cancel()
+
+    assert len(handled) == len(keys) * 5
+    for key in keys:
+        items = [(w, seq) for w, k, seq in handled if k == key]
+        assert [seq for _, seq in items] == list(range(5))
+        assert {w for w, _ in items} == {scheduler.shard_of(key)}
+    assert scheduler.shard_depths() == [0, 0, 0, 0]
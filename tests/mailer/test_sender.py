@@ -0,0 +1,287 @@
+import asyncio
+import datetime
+from email.message import EmailMessage
+from aiosmtplib import SMTPRecipientRefused, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+import pytest
+from pmea.config import EmailConfig, SendRateLimit
+from pmea.mailer import Contact, MailSender, Message, MessageHeaders
+from pmea.mailer.digest import DigestItem
+from pmea.mailer.retry import RetryTask
+from pmea.mailer.sender import SMTPPool, is_throttled
+
+
+class FakeSMTP:
+    """SMTP client stub which records sent messages. Connection can be dropped with `drop_error`."""
+
+    def __init__(self, server: "FakeSMTPServer"):
+        self.server = server
+        self.connected = False
+        self.drop_error: Exception | None = None
+
+    async def connect(self):
+        if self.server.connect_error:
+            raise self.server.connect_error
+        self.server.connections.append(self)
+        self.connected = True
+
+    async def noop(self):
+        self.server.noops += 1
+        if self.drop_error:
+            raise self.drop_error
+
+    async def send_message(self, msg: EmailMessage):
+        assert self.connected
+        if self.drop_error:
+            raise self.drop_error
+        self.server.active += 1
+        self.server.max_active = max(self.server.max_active, self.server.active)
+        await asyncio.sleep(0.01)
+        self.server.active -= 1
+        self.server.sent.append(msg["Subject"])
+
+    def close(self):
+        self.connected = False
+
+
+class FakeSMTPServer:
+    def __init__(self):
+        self.connections: list[FakeSMTP] = []
+        self.sent: list[str] = []
+        self.noops = 0
+        self.active = 0
+        self.max_active = 0
+        self.connect_error: Exception | None = None
+
+
+def make_message(subject: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg.set_content("Hi")
+    return msg
+
+
+def make_pool(server: FakeSMTPServer, size: int = 2, idle_timeout: float = 60, health_check_interval: float = 10) -> SMTPPool:
+    return SMTPPool(lambda: FakeSMTP(server), size, idle_timeout, health_check_interval)
+
+
+@pytest.mark.asyncio
+async def test_smtp_pool_reuses_connections_of_concurrent_senders():
+    server = FakeSMTPServer()
+    pool = make_pool(server, size=2)
+
+    await asyncio.gather(*[pool.send_message(make_message(f"#{i}")) for i in range(5)])
+    await pool.send_message(make_message("#5"))
+
+    assert sorted(server.sent) == [f"#{i}" for i in range(6)]
+    assert server.max_active == 2
+    assert len(server.connections) == 2
+
+    pool.close()
+    assert not any(c.connected for c in server.connections)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("err", [SMTPServerDisconnected("gone"), SMTPResponseException(421, "closing")])
+async def test_smtp_pool_reconnects_closed_connection(err: Exception):
+    server = FakeSMTPServer()
+    pool = make_pool(server, size=1)
+    await pool.send_message(make_message("#1"))
+
+    server.connections[0].drop_error = err
+    await pool.send_message(make_message("#2"))
+
+    assert server.sent == ["#1", "#2"]
+    assert len(server.connections) == 2
+    assert not server.connections[0].connected
+
+
+@pytest.mark.asyncio
+async def test_smtp_pool_checks_idle_connections():
+    server = FakeSMTPServer()
+    pool = make_pool(server, size=1, idle_timeout=0.05, health_check_interval=0.01)
+    await pool.send_message(make_message("#1"))
+
+    # Connection idle for a while is checked before reuse, broken one is replaced.
+    await asyncio.sleep(0.02)
+    server.connections[0].drop_error = SMTPResponseException(421, "closing")
+    await pool.send_message(make_message("#2"))
+    assert server.noops == 1
+    assert len(server.connections) == 2
+
+    # Expired connection is closed without a check.
+    await asyncio.sleep(0.06)
+    await pool.send_message(make_message("#3"))
+    assert server.noops == 1
+    assert len(server.connections) == 3
+    assert server.sent == ["#1", "#2", "#3"]
+
+
+@pytest.mark.asyncio
+async def test_smtp_pool_closes_idle_connections_in_background():
+    server = FakeSMTPServer()
+    pool = make_pool(server, size=1, idle_timeout=0.02)
+    await pool.send_message(make_message("#1"))
+
+    task = asyncio.create_task(pool.close_idle())
+    await asyncio.sleep(0.05)
+    task.cancel()
+
+    assert not server.connections[0].connected
+
+
+@pytest.mark.parametrize(
+    "err,throttled",
+    [
+        (SMTPResponseException(451, "4.7.0 Try again later"), True),
+        (SMTPResponseException(550, "5.4.5 Daily user sending quota exceeded."), True),
+        (SMTPResponseException(550, "5.1.1 The email account that you tried to reach does not exist."), False),
+        (SMTPRecipientsRefused([SMTPRecipientRefused(450, "4.2.1 Too many messages", "a@example.com")]), True),
+        (SMTPRecipientsRefused([SMTPRecipientRefused(550, "5.1.1 Unknown user", "a@example.com")]), False),
+        (SMTPServerDisconnected("gone"), False),
+    ],
+)
+def test_throttling_replies(err: Exception, throttled: bool):
+    assert is_throttled(err) == throttled
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.queued: list[str] = []
+        self.failures: list[str] = []
+        self.completed: list[str] = []
+        self.postponed: list[float] = []
+
+    async def enqueue(self, payload: str) -> None:
+        self.queued.append(payload)
+
+    async def failed(self, task: RetryTask, err: Exception) -> bool:
+        self.failures.append(str(err))
+        return True
+
+    async def postpone(self, task: RetryTask, delay: float) -> None:
+        self.postponed.append(delay)
+
+    async def done(self, task: RetryTask) -> None:
+        self.completed.append(task.payload)
+
+
+class RecordingThreadUpdater:
+    def __init__(self):
+        self.messages: list[tuple[str, str]] = []
+
+    async def add_thread_message(self, message_id: str, thread_id: str) -> None:
+        self.messages.append((message_id, thread_id))
+
+
+@pytest.mark.asyncio
+async def test_reply_is_added_to_thread_after_delivery():
+    config = EmailConfig(
+        imap_host="imap.example.com",
+        smtp_host="smtp.example.com",
+        username="agent@example.com",
+        password="",
+        throttle_pause=0,
+    ).with_defaults()
+    outbox = RecordingOutbox()
+    updater = RecordingThreadUpdater()
+    sender = MailSender(config, updater, outbox=outbox)
+    server = FakeSMTPServer()
+    sender._smtp = make_pool(server)
+    parent = Message(
+        uid=1,
+        sender=Contact("User", "user@example.com"),
+        receiver=Contact("Agent", "agent@example.com"),
+        subject="Leaking tap",
+        body="Tap is leaking",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders("<1@example.com>", None, None),
+    )
+
+    await sender.reply_in_thread("t1", parent, "Plumber is on the way")
+    assert len(outbox.queued) == 1
+    assert server.sent == [] and updater.messages == []
+
+    task = RetryTask("send", outbox.queued[0], attempt=0)
+    server.connect_error = SMTPResponseException(421, "closing")
+    await sender.deliver(task)
+    assert len(outbox.failures) == 1 and updater.messages == []
+
+    server.connect_error = None
+    await sender.deliver(task)
+    assert server.sent == ["Leaking tap"]
+    assert outbox.completed == [task.payload]
+    assert [thread_id for _, thread_id in updater.messages] == ["t1"]
+
+
+@pytest.mark.asyncio
+async def test_over_budget_message_is_postponed():
+    config = EmailConfig(
+        imap_host="imap.example.com",
+        smtp_host="smtp.example.com",
+        username="agent@example.com",
+        password="",
+        forward_rate_limit=SendRateLimit(per_minute=1),
+    ).with_defaults()
+    outbox = RecordingOutbox()
+    sender = MailSender(config, RecordingThreadUpdater(), outbox=outbox)
+    server = FakeSMTPServer()
+    sender._smtp = make_pool(server)
+    parent = Message(
+        uid=1,
+        sender=Contact("User", "user@example.com"),
+        receiver=Contact("Agent", "agent@example.com"),
+        subject="Leaking tap",
+        body="Tap is leaking",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders("<1@example.com>", None, None),
+    )
+
+    for dst in ["plumber@pmea.io", "manager@pmea.io"]:
+        await sender.forward_message(parent, dst, None)
+    # Failed attempt doesn't use up the budget.
+    server.connect_error = ConnectionRefusedError()
+    await sender.deliver(RetryTask("send", outbox.queued[0], attempt=0))
+    assert len(outbox.failures) == 1
+    server.connect_error = None
+    for payload in outbox.queued:
+        await sender.deliver(RetryTask("send", payload, attempt=0))
+
+    assert server.sent == ["FWD: Leaking tap"]
+    assert len(outbox.postponed) == 1 and 0 < outbox.postponed[0] <= 60
+    assert sender.rate_limit_status.startswith("reply: unlimited; forward: 0/1 per 60s")
+
+
+class RecordingDigest:
+    def __init__(self):
+        self.items: list[tuple[str, str]] = []
+
+    async def add(self, dst_email: str, item: DigestItem) -> None:
+        self.items.append((dst_email, item.subject))
+
+
+@pytest.mark.asyncio
+async def test_urgent_forward_bypasses_digest():
+    config = EmailConfig(
+        imap_host="imap.example.com",
+        smtp_host="smtp.example.com",
+        username="agent@example.com",
+        password="",
+    ).with_defaults()
+    outbox = RecordingOutbox()
+    digest = RecordingDigest()
+    sender = MailSender(config, RecordingThreadUpdater(), outbox=outbox, digest=digest)
+    parent = Message(
+        uid=1,
+        sender=Contact("User", "user@example.com"),
+        receiver=Contact("Agent", "agent@example.com"),
+        subject="Leaking tap",
+        body="Tap is leaking",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders("<1@example.com>", None, None),
+    )
+
+    await sender.forward_message(parent, "manager@pmea.io", None)
+    await sender.forward_message(parent, "manager@pmea.io", "Flooding", urgent=True)
+
+    assert digest.items == [("manager@pmea.io", "Leaking tap")]
+    assert len(outbox.queued) == 1
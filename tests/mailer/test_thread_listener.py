@@ -0,0 +1,80 @@
+import datetime
+import pytest
+from pmea.mailer import Contact, Message, MessageHeaders
+from pmea.mailer.thread_listener import ThreadMailConsumer
+from pmea.repository.threads import RESOLVE_THREAD_LUA, ThreadsRepository
+
+
+class FakeThreadsRedis:
+    """Emulates thread resolver script on top of dicts and counts its calls."""
+
+    def __init__(self):
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.sets: dict[str, set[str]] = {}
+        self.activity: dict[str, float] = {}
+        self.calls = 0
+
+    def register_script(self, script: str):
+        async def resolve(keys, args):
+            self.calls += 1
+            # Bucket keys and fields of the message and its parents, legacy keys are never set here.
+            slots = list(zip(keys[1::2], args[2:]))
+            tid = self.hashes.get(slots[0][0], {}).get(slots[0][1])
+            if tid:
+                return [tid.encode(), b"existing"]
+            tid = next((self.hashes[k][f] for k, f in slots[1:] if f in self.hashes.get(k, {})), None)
+            status = "found" if tid else "new"
+            tid = tid or args[0]
+            self.hashes.setdefault(slots[0][0], {})[slots[0][1]] = tid
+            self.activity[tid] = args[1]
+            return [tid.encode(), status.encode()]
+
+        async def unused(keys, args):
+            raise AssertionError("unexpected script call")
+
+        return resolve if script == RESOLVE_THREAD_LUA else unused
+
+    async def sadd(self, key: str, member: str):
+        self.sets.setdefault(key, set()).add(member)
+
+
+class RecordingThreadConsumer:
+    def __init__(self):
+        self.messages: list[tuple[str, str]] = []
+
+    async def consume_thread_message(self, thread_id: str, m: Message) -> None:
+        self.messages.append((thread_id, m.headers.msg_id))
+
+
+def make_message(msg_id: str, in_reply_to: str | None = None, references: list[str] | None = None) -> Message:
+    return Message(
+        uid=1,
+        sender=Contact("", "user@example.com"),
+        receiver=Contact("", "agent@example.com"),
+        subject="Hello",
+        body="Hello",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders(msg_id, in_reply_to, references),
+    )
+
+
+@pytest.mark.asyncio
+async def test_thread_is_resolved_by_single_script_call():
+    redis = FakeThreadsRedis()
+    consumer = RecordingThreadConsumer()
+    threads = ThreadMailConsumer(consumer, ThreadsRepository(redis))
+
+    await threads.consume_mail(make_message("<1>"))
+    thread_id = consumer.messages[0][0]
+    # Unknown in-reply-to is skipped, thread is found by references.
+    await threads.consume_mail(make_message("<3>", in_reply_to="<2>", references=["<1>", "<2>"]))
+    # Redelivered message keeps its thread.
+    await threads.consume_mail(make_message("<3>", in_reply_to="<2>", references=["<1>", "<2>"]))
+    await threads.consume_mail(make_message("<4>", in_reply_to="<unknown>"))
+
+    assert redis.calls == 4
+    assert consumer.messages[:3] == [(thread_id, "<1>"), (thread_id, "<3>"), (thread_id, "<3>")]
+    assert consumer.messages[3][0] != thread_id
+    assert redis.sets[f"thread:{thread_id}"] == {"<1>", "<3>"}
+    assert len(redis.activity) == 2
+    assert all(k.startswith("msgs:") for k in redis.hashes)
@@ -0,0 +1,55 @@
+import email
+from pmea.mailer.utils import (
+    is_server_push_exists_result,
+    iter_fetch_responses,
+    parse_message_headers,
+    thread_key_from_headers,
+    uid_from_fetch_line,
+    uidnext_from_select_response,
+    uidnext_from_status_response,
+    uids_from_search_response,
+)
+
+
+def test_thread_key_from_headers():
+    root = email.message_from_string("Message-ID: <a@example.com>\n\nhi")
+    first_reply = email.message_from_string(
+        "Message-ID: <b@example.com>\nIn-Reply-To: <a@example.com>\n\nhi"
+    )
+    reply = email.message_from_string(
+        "Message-ID: <c@example.com>\nIn-Reply-To: <b@example.com>\n"
+        "References: <a@example.com> <b@example.com>\n\nhi"
+    )
+    for msg in [root, first_reply, reply]:
+        assert thread_key_from_headers(parse_message_headers(msg)) == "<a@example.com>"
+
+
+def test_iter_fetch_responses_skips_interleaved_lines():
+    lines = [
+        b"1 FETCH (UID 10 RFC822.SIZE 120 BODY[1] {5}",
+        bytearray(b"hello"),
+        b" FLAGS (\\Seen))",
+        b"7 EXISTS",
+        b"3 FETCH (FLAGS (\\Seen))",
+        b'2 FETCH (UID 11 BODY[1] "quoted \\"body\\"")',
+        b"2 FETCH (UID 11 FLAGS (\\Seen))",
+        b"Success",
+    ]
+    responses = [(r.uid, r.size, r.get_item(b"BODY[1]")) for r in iter_fetch_responses(lines)]
+    assert responses == [
+        (10, 120, b"hello"),
+        (11, None, b'quoted "body"'),
+        (11, None, None),
+    ]
+    assert responses[0][2] is lines[1]
+
+
+def test_response_line_helpers():
+    assert uid_from_fetch_line(b"4 FETCH (UID 42)") == 42
+    assert uid_from_fetch_line(b"4 FETCH (FLAGS (\\Seen) UID 42)") == 42
+    assert uid_from_fetch_line(b"4 EXISTS") is None
+    assert uidnext_from_select_response([b"3 EXISTS", b"OK [UIDNEXT 43] Predicted next UID", b"Success"]) == 43
+    assert uidnext_from_status_response([b'STATUS "Sent Items" (MESSAGES 3 UIDNEXT 44)', b"Success"]) == 44
+    assert is_server_push_exists_result([b"5 EXISTS"])
+    assert not is_server_push_exists_result([b"5 EXPUNGE"])
+    assert uids_from_search_response([b"SEARCH 2 7 (MODSEQ 917)", b"Success"]) == [2, 7]
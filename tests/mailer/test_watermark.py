@@ -0,0 +1,55 @@
+import pytest
+from pmea.mailer.watermark import UIDWatermark
+
+
+class InMemoryUIDStore:
+    last_uid: int | None
+    writes: list[int]
+
+    def __init__(self, last_uid: int | None = None):
+        self.last_uid = last_uid
+        self.writes = []
+
+    async def get_last_uid(self, _email: str) -> int | None:
+        return self.last_uid
+
+    async def set_last_uid(self, _email: str, uid: int) -> None:
+        self.writes.append(uid)
+        self.last_uid = uid
+
+
+@pytest.mark.asyncio
+async def test_watermark_out_of_order_acks():
+    store = InMemoryUIDStore(last_uid=10)
+    wm = UIDWatermark(store, "agent@example.com", flush_count=100, flush_interval=60)
+    assert await wm.load() == 10
+
+    for uid in [12, 15, 16, 20]:
+        assert wm.track(uid)
+    assert not wm.track(15)
+    assert wm.last_tracked == 20
+
+    await wm.ack(16)
+    await wm.ack(15)
+    assert wm.watermark == 10
+
+    await wm.ack(12)
+    assert wm.watermark == 16
+    assert wm.pending_count == 1
+
+    await wm.flush()
+    await wm.flush()
+    assert store.writes == [16]
+
+
+@pytest.mark.asyncio
+async def test_watermark_flushes_after_batch():
+    store = InMemoryUIDStore()
+    wm = UIDWatermark(store, "agent@example.com", flush_count=3, flush_interval=60)
+    await wm.load()
+
+    for uid in range(1, 8):
+        wm.track(uid)
+    for uid in range(1, 8):
+        await wm.ack(uid)
+    assert store.writes == [3, 6]
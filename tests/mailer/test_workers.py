@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import logging
+import pytest
+from pmea.mailer import Contact, InMemoryMessageQueue, MailWorkers, Message, MessageHeaders
+from pmea.mailer.types import ParsedMessage
+
+
+def make_parsed_message(uid: int) -> ParsedMessage:
+    return ParsedMessage(
+        uid=uid,
+        size=100,
+        sender=Contact("", "user@example.com"),
+        receiver=Contact("", "agent@example.com"),
+        subject=f"Message #{uid}",
+        sent_at=datetime.datetime(2025, 6, 2, 10, 0),
+        headers=MessageHeaders(f"<{uid}@example.com>", None, None),
+        body=f"Body of message #{uid}",
+    )
+
+
+class FailingConsumer:
+    messages: list[Message]
+
+    def __init__(self, fail_uids: set[int]):
+        self.messages = []
+        self.rejected = []
+        self.fail_uids = fail_uids
+
+    async def consume_mail(self, m: Message) -> None:
+        if m.uid in self.fail_uids:
+            raise Exception("consumer failure")
+        self.messages.append(m)
+
+    async def reject_mail(self, m: Message, err: Exception) -> None:
+        self.rejected.append(m.uid)
+
+
+@pytest.mark.asyncio
+async def test_workers_ack_every_message():
+    acked: list[int] = []
+    all_acked = asyncio.Event()
+
+    async def on_ack(uid: int):
+        acked.append(uid)
+        if len(acked) == 4:
+            all_acked.set()
+
+    q = InMemoryMessageQueue(10, on_ack)
+    consumer = FailingConsumer({2})
+    workers = MailWorkers(q, consumer, worker_count=2, shard_size=2)
+    for uid in range(1, 5):
+        await q.put(make_parsed_message(uid))
+
+    task = asyncio.create_task(workers.run())
+    await asyncio.wait_for(all_acked.wait(), timeout=1)
+    task.cancel()
+
+    assert sorted(acked) == [1, 2, 3, 4]
+    assert sorted(m.uid for m in consumer.messages) == [1, 3, 4]
+    assert consumer.rejected == [2]
+
+
+class BlockingConsumer:
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def consume_mail(self, m: Message) -> None:
+        await self.release.wait()
+
+
+@pytest.mark.asyncio
+async def test_workers_report_queue_depths(caplog):
+    async def on_ack(uid: int):
+        pass
+
+    q = InMemoryMessageQueue(10, on_ack)
+    consumer = BlockingConsumer()
+    workers = MailWorkers(q, consumer, worker_count=1, shard_size=10, stats_interval=0.01)
+    for uid in range(1, 4):
+        await q.put(make_parsed_message(uid))
+
+    with caplog.at_level(logging.INFO, logger="pmea.mailer.workers"):
+        task = asyncio.create_task(workers.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        consumer.release.set()
+
+    # First message is being processed, the rest wait in the worker's queue.
+    assert "worker queues: depths=[2] total=2" in caplog.text
+    assert "incoming queue: size=0" in caplog.text
@@ -0,0 +1,209 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from pmea.repository.history import FRAME_JSON, FRAME_ZSTD, HistoryCodec, RedisChatHistory, migrate_legacy_history
+
+
+class FakePipeline:
+    def __init__(self, redis: "FakeRedis"):
+        self.redis = redis
+        self.commands: list[tuple] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __getattr__(self, name: str):
+        return lambda *args: self.commands.append((name, *args))
+
+    async def execute(self):
+        self.redis.round_trips += 1
+        for name, *args in self.commands:
+            getattr(self.redis, f"_{name}")(*args)
+
+
+class FakeRedis:
+    """Lists and JSON documents in memory, counts round trips."""
+
+    def __init__(self, docs: dict[str, dict] | None = None):
+        self.lists: dict[str, list[bytes]] = {}
+        self.docs = docs or {}
+        self.ttl: dict[str, int] = {}
+        self.round_trips = 0
+        self.doc_reads = 0
+        self.doc_reads_per_write: list[int] = []
+
+    def pipeline(self, transaction: bool):
+        return FakePipeline(self)
+
+    def json(self):
+        return self
+
+    async def get(self, key: str):
+        self.doc_reads += 1
+        return self.docs.get(key)
+
+    async def scan_iter(self, match: str, count: int):
+        for key in list(self.docs):
+            if key.startswith(match.rstrip("*")):
+                yield key
+
+    async def lrange(self, key: str, start: int, end: int):
+        self.round_trips += 1
+        return self.lists.get(key, [])
+
+    def _rpush(self, key: str, *values: bytes):
+        self.lists.setdefault(key, []).extend(values)
+
+    def _lpush(self, key: str, *values: bytes):
+        self.doc_reads_per_write.append(self.doc_reads)
+        for v in values:
+            self.lists.setdefault(key, []).insert(0, v)
+
+    def _expire(self, key: str, ttl: int):
+        self.ttl[key] = ttl
+
+    def _delete(self, *keys: str):
+        for key in keys:
+            self.docs.pop(key, None)
+            self.lists.pop(key, None)
+
+
+class FakeSyncPipeline(FakePipeline):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self):
+        self.redis.round_trips += 1
+        for name, *args in self.commands:
+            getattr(self.redis, f"_{name}")(*args)
+
+
+class FakeSyncRedis:
+    """Sync client over lists of `FakeRedis`."""
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+
+    def pipeline(self, transaction: bool):
+        return FakeSyncPipeline(self.redis)
+
+    def lrange(self, key: str, start: int, end: int):
+        self.redis.round_trips += 1
+        return self.redis.lists.get(key, [])
+
+    def delete(self, *keys: str):
+        self.redis._delete(*keys)
+
+
+def test_codec_compresses_only_large_messages():
+    codec = HistoryCodec("zstd", min_size=100)
+    messages = [
+        HumanMessage("Hello! " * 50),
+        AIMessage("", tool_calls=[{"name": "find_property", "args": {"address": "Main St"}, "id": "call-1"}]),
+        ToolMessage("Not found", tool_call_id="call-1"),
+    ]
+
+    frames = [codec.encode(m) for m in messages]
+
+    assert [f[:1] for f in frames] == [FRAME_ZSTD, FRAME_ZSTD, FRAME_JSON]
+    assert len(frames[0]) < len(messages[0].content)
+    # Compressed frames are readable with compression disabled.
+    assert [HistoryCodec().decode(f) for f in frames] == messages
+
+
+@pytest.mark.asyncio
+async def test_turn_is_appended_in_single_round_trip():
+    redis = FakeRedis()
+    history = RedisChatHistory(redis, "thread_1", HistoryCodec(), ttl=3600)
+
+    await history.aadd_messages([HumanMessage("Hi"), AIMessage("Hello")])
+    await history.aadd_messages([HumanMessage("Bye")])
+
+    assert redis.round_trips == 2
+    assert redis.ttl == {"history:thread_1": 3600}
+    assert [m.content for m in await history.aget_messages()] == ["Hi", "Hello", "Bye"]
+
+
+@pytest.mark.asyncio
+async def test_history_is_used_by_async_chain():
+    redis = FakeRedis()
+    seen: list[int] = []
+
+    def reply(messages):
+        seen.append(len(messages))
+        return AIMessage(f"reply {len(seen)}")
+
+    chain = RunnableWithMessageHistory(
+        RunnableLambda(reply), get_session_history=lambda session_id: RedisChatHistory(redis, session_id, HistoryCodec()),
+    )
+    cfg = {"configurable": {"session_id": "thread_1"}}
+    await chain.ainvoke([HumanMessage("Hi")], config=cfg)
+    await chain.ainvoke([HumanMessage("Bye")], config=cfg)
+
+    assert seen == [1, 3]
+    assert len(redis.lists["history:thread_1"]) == 4
+
+
+def test_history_is_used_by_sync_chain_with_sync_client():
+    redis = FakeRedis()
+    seen: list[int] = []
+
+    def reply(messages):
+        seen.append(len(messages))
+        return AIMessage(f"reply {len(seen)}")
+
+    chain = RunnableWithMessageHistory(
+        RunnableLambda(reply),
+        get_session_history=lambda session_id: RedisChatHistory(
+            redis, session_id, HistoryCodec(), ttl=60, sync_client=FakeSyncRedis(redis),
+        ),
+    )
+    cfg = {"configurable": {"session_id": "thread_1"}}
+    chain.invoke([HumanMessage("Hi")], config=cfg)
+    chain.invoke([HumanMessage("Bye")], config=cfg)
+
+    assert seen == [1, 3]
+    assert len(redis.lists["history:thread_1"]) == 4
+    assert redis.ttl == {"history:thread_1": 60}
+
+
+def test_sync_access_without_sync_client_fails():
+    history = RedisChatHistory(FakeRedis(), "thread_1", HistoryCodec())
+
+    with pytest.raises(RuntimeError, match="sync Redis client"):
+        history.add_messages([HumanMessage("Hi")])
+
+
+@pytest.mark.asyncio
+async def test_legacy_history_is_prepended_to_new_one():
+    def legacy_doc(session_id: str, msg_type: str, content: str, timestamp: float) -> dict:
+        return {
+            "type": msg_type,
+            "session_id": session_id,
+            "timestamp": timestamp,
+            "data": {"content": content, "additional_kwargs": {}, "type": msg_type},
+        }
+
+    redis = FakeRedis({
+        "chat:thread_1:02": legacy_doc("thread_1", "ai", "Hello", 2),
+        "chat:thread_1:01": legacy_doc("thread_1", "human", "Hi", 1),
+        "chat:thread_2:01": legacy_doc("thread_2", "human", "Hey", 1),
+    })
+    codec = HistoryCodec()
+    await RedisChatHistory(redis, "thread_1", codec).aadd_messages([HumanMessage("Bye")])
+
+    assert await migrate_legacy_history(redis, codec, ttl=60) == (2, 3)
+
+    history = await RedisChatHistory(redis, "thread_1", codec).aget_messages()
+    assert [(m.type, m.content) for m in history] == [("human", "Hi"), ("ai", "Hello"), ("human", "Bye")]
+    assert redis.docs == {}
+    assert redis.ttl == {"history:thread_1": 60, "history:thread_2": 60}
+    # Each session is written before messages of the next one are loaded.
+    assert redis.doc_reads_per_write == [2, 3]
@@ -0,0 +1,95 @@
+import pytest
+from pmea.repository.thread_cache import ThreadCache
+from pmea.repository.threads import ThreadsRepository
+
+
+class FakePipeline:
+    def __init__(self, redis: "FakeRedis"):
+        self.redis = redis
+        self.commands: list[tuple] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __getattr__(self, name: str):
+        return lambda *args: self.commands.append((name, *args))
+
+    async def execute(self):
+        self.redis.reads += 1
+        return [getattr(self.redis, f"_{name}")(*args) for name, *args in self.commands]
+
+
+class FakeRedis:
+    """Hashes and legacy string keys stub counting round trips."""
+
+    def __init__(self, legacy: dict[str, str]):
+        self.legacy = legacy
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.reads = 0
+
+    def register_script(self, script: str):
+        return None
+
+    def pipeline(self, transaction: bool):
+        return FakePipeline(self)
+
+    def _hget(self, key: str, field: str):
+        value = self.hashes.get(key, {}).get(field)
+        return value.encode() if value else None
+
+    def _get(self, key: str):
+        value = self.legacy.get(key)
+        return value.encode() if value else None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ThreadCache(2)
+    cache.put("<1>", "t1", ["msgs:1"], cache.generation)
+    cache.put("<2>", "t1", ["msgs:2"], cache.generation)
+    assert cache.get("<1>") == (True, "t1")
+    cache.put("<3>", "t2", ["msgs:1"], cache.generation)
+
+    assert cache.get("<2>") == (False, None)
+    assert cache.get("<3>") == (True, "t2")
+    # Invalidation of a bucket drops all messages stored in it.
+    cache.invalidate(["msgs:1", "msgs:5"])
+    assert cache.get("<3>") == (False, None)
+    assert cache.get("<1>") == (False, None)
+    assert (cache.stats.hits, cache.stats.misses) == (2, 3)
+
+
+def test_missing_mapping_is_cached_only_without_concurrent_invalidations():
+    cache = ThreadCache(10)
+    # No invalidations are received without tracking, message may be linked by another replica.
+    cache.put("<1>", None, ["msgs:1"], cache.generation)
+    assert cache.get("<1>") == (False, None)
+
+    cache._tracking = True
+    generation = cache.generation
+    cache.invalidate(["msgs:1"])
+    cache.put("<1>", None, ["msgs:1"], generation)
+    assert cache.get("<1>") == (False, None)
+
+    cache.put("<1>", None, ["msgs:1"], cache.generation)
+    assert cache.get("<1>") == (True, None)
+    cache.invalidate(None)
+    assert cache.get("<1>") == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_repository_serves_known_mappings_from_cache():
+    redis = FakeRedis({"msg:<1>": "t1", "msg:<2>": "t1"})
+    repo = ThreadsRepository(redis, ThreadCache(10), bucket_count=16)
+
+    assert await repo.get_message_thread_id("<1>") == "t1"
+    assert await repo.lookup_thread_id(["<0>", "<1>", "<2>"]) == "t1"
+    assert redis.reads == 2
+    assert await repo.get_message_thread_id("<1>") == "t1"
+    assert await repo.lookup_thread_id(["<1>", "<2>"]) == "t1"
+    assert redis.reads == 2
+    # Missing message isn't cached while tracking is off.
+    assert await repo.lookup_thread_id(["<0>"]) is None
+    assert redis.reads == 3
@@ -0,0 +1,255 @@
+import os
+import time
+import pytest
+import pytest_asyncio
+import redis.asyncio as aioredis
+from pmea.repository import threads
+from pmea.repository.keys import hash_tagged
+from pmea.repository.threads import CLAIM_MESSAGE_LUA, EXPIRE_THREAD_LUA, FORGET_INACTIVE_LUA, ThreadsRepository
+
+# Scripts are also checked against a real server, database is flushed by these tests.
+TEST_REDIS_DSN = os.getenv("TEST_REDIS_DSN", "redis://localhost:6379/0")
+
+
+class FakePipeline:
+    def __init__(self, redis: "FakeRedis"):
+        self.redis = redis
+        self.commands: list[tuple] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        return [getattr(self.redis, f"_{name}")(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeRedis:
+    """Emulates commands and scripts of `ThreadsRepository` maintenance and of its cluster resolver."""
+
+    def __init__(self, strings: dict[str, str]):
+        self.strings = strings
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.sets: dict[str, set[str]] = {}
+        self.activity: dict[str, float] = {}
+
+    def pipeline(self, transaction: bool):
+        return FakePipeline(self)
+
+    async def get(self, key: str):
+        return self.strings.get(key)
+
+    async def set(self, key: str, value, nx: bool = False):
+        if not (nx and key in self.strings):
+            self.strings[key] = str(value)
+
+    async def zscan_iter(self, key: str, count: int):
+        for member, score in list(self.activity.items()):
+            yield member.encode(), score
+
+    async def scan_iter(self, match: str, count: int):
+        for key in list(self.strings):
+            if key.startswith(match.rstrip("*")):
+                yield key
+
+    async def smembers(self, key: str):
+        return {m.encode() for m in self.sets.get(key, set())}
+
+    async def zrangebyscore(self, key: str, lo: str, hi: float, start: int, num: int):
+        return [t for t, score in self.activity.items() if score <= hi][:num]
+
+    def _get(self, key: str):
+        return self.strings.get(key)
+
+    def _hget(self, key: str, field: str):
+        value = self.hashes.get(key, {}).get(field)
+        return value.encode() if value else None
+
+    def _hdel(self, key: str, field: str):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def _hset(self, key: str, field: str, value: str):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def _hsetnx(self, key: str, field: str, value: str):
+        self.hashes.setdefault(key, {}).setdefault(field, value)
+
+    def _smembers(self, key: str):
+        return {m.encode() for m in self.sets.get(key, set())}
+
+    def _sadd(self, key: str, member: str):
+        self.sets.setdefault(key, set()).add(member)
+
+    def _zadd(self, key: str, mapping: dict[str, float], nx: bool = False):
+        for member, score in mapping.items():
+            if not (nx and member in self.activity):
+                self.activity[member] = score
+
+    def _delete(self, key: str):
+        self.strings.pop(key, None)
+        self.sets.pop(key, None)
+
+    def register_script(self, script: str):
+        async def expire_thread(keys, args):
+            tid, cutoff, *fields = args
+            if self.activity.get(tid, 0) > cutoff:
+                return 0
+            for i, field in enumerate(fields):
+                self.hashes.get(keys[2 + 2 * i], {}).pop(field, None)
+                self.strings.pop(keys[3 + 2 * i], None)
+            self.sets.pop(keys[1], None)
+            self.activity.pop(tid, None)
+            return 1
+
+        async def claim_message(keys, args):
+            field, tid = args
+            tid = self.hashes.setdefault(keys[0], {}).setdefault(field, tid)
+            return [tid.encode(), int(tid == args[1])]
+
+        async def forget_inactive(keys, args):
+            tid, cutoff = args
+            if self.activity.get(tid, 0) > cutoff:
+                return 0
+            self.activity.pop(tid, None)
+            return 1
+
+        scripts = {EXPIRE_THREAD_LUA: expire_thread, CLAIM_MESSAGE_LUA: claim_message, FORGET_INACTIVE_LUA: forget_inactive}
+        return scripts.get(script)
+
+
+@pytest.mark.asyncio
+async def test_legacy_mappings_are_moved_to_buckets():
+    redis = FakeRedis({"msg:<1>": "t1", "msg:<2>": "t1", "msg:<3>": "t2"})
+    repo = ThreadsRepository(redis, bucket_count=2)
+
+    assert await repo.migrate_legacy_keys(batch_size=2) == 3
+
+    assert redis.strings == {}
+    assert set(redis.activity) == {"t1", "t2"}
+    assert sorted(v for fields in redis.hashes.values() for v in fields.values()) == ["t1", "t1", "t2"]
+    assert all(len(field) == 16 for fields in redis.hashes.values() for field in fields)
+
+
+@pytest.mark.asyncio
+async def test_inactive_threads_are_forgotten():
+    redis = FakeRedis({})
+    repo = ThreadsRepository(redis, bucket_count=4)
+    await repo.add_thread_message("<1>", "t1")
+    await repo.add_thread_message("<2>", "t1")
+    await repo.add_thread_message("<3>", "t2")
+    redis.activity["t1"] -= 100
+
+    assert await repo.expire_inactive_threads(inactive_for=50) == 1
+
+    assert set(redis.activity) == {"t2"}
+    assert set(redis.sets) == {"thread:t2"}
+    assert [v for fields in redis.hashes.values() for v in fields.values()] == ["t2"]
+
+
+@pytest.mark.asyncio
+async def test_mappings_are_moved_to_new_bucket_count():
+    redis = FakeRedis({})
+    repo = ThreadsRepository(redis, bucket_count=2)
+    await repo.check_bucket_count()
+    for i in range(20):
+        await repo.add_thread_message(f"<{i}>", f"t{i % 3}")
+
+    with pytest.raises(Exception, match="stored in 2 buckets"):
+        await ThreadsRepository(redis, bucket_count=8).check_bucket_count()
+
+    repo = ThreadsRepository(redis, bucket_count=8)
+    assert await repo.rebucket(batch_size=2) > 0
+    await repo.check_bucket_count()
+
+    assert len([key for key, fields in redis.hashes.items() if fields]) > 2
+    assert sum(len(fields) for fields in redis.hashes.values()) == 20
+    for i in range(20):
+        key, field = repo._message_slot(f"<{i}>")
+        assert redis.hashes[key][field] == f"t{i % 3}"
+    # Nothing is left to move.
+    assert await repo.rebucket() == 0
+
+
+def test_keys_are_hash_tagged_once():
+    assert hash_tagged("leader", "pmea") == "{pmea}leader"
+    assert hash_tagged("{mail}leader", "pmea") == "{mail}leader"
+    # Empty tag is ignored by Redis Cluster, so the key gets a tag.
+    assert hash_tagged("{}leader", "pmea") == "{pmea}{}leader"
+    assert hash_tagged("leader", None) == "leader"
+
+
+@pytest.mark.asyncio
+async def test_cluster_resolver_links_message_without_multi_key_scripts(monkeypatch):
+    monkeypatch.setattr(threads, "is_cluster", lambda redis_client: True)
+    redis = FakeRedis({})
+    repo = ThreadsRepository(redis, bucket_count=4, hash_tag="pmea")
+
+    tid, status = await repo.resolve_thread_id("<1>", [])
+    assert status == "new"
+    assert await repo.resolve_thread_id("<2>", ["<unknown>", "<1>"]) == (tid, "found")
+    assert await repo.resolve_thread_id("<2>", ["<1>"]) == (tid, "existing")
+    other_tid, _ = await repo.resolve_thread_id("<3>", ["<unknown>"])
+    assert redis.sets[f"thread:{tid}"] == {"<1>", "<2>"}
+
+    redis.activity[tid] -= 100
+    assert await repo.expire_inactive_threads(inactive_for=50) == 1
+    assert set(redis.activity) == {other_tid}
+    assert await repo.get_message_thread_id("<2>") is None
+    assert await repo.get_message_thread_id("<3>") == other_tid
+
+
+@pytest_asyncio.fixture
+async def redis_client():
+    client = aioredis.from_url(TEST_REDIS_DSN)
+    try:
+        await client.ping()
+    except Exception as e:
+        await client.aclose()
+        pytest.skip(f"Redis is unavailable: {e}")
+    await client.flushdb()
+    yield client
+    await client.flushdb()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_resolver_script_links_messages_in_redis(redis_client):
+    repo = ThreadsRepository(redis_client, bucket_count=4)
+    await redis_client.set("msg:<0>", "t0")
+
+    tid, status = await repo.resolve_thread_id("<1>", [])
+    assert status == "new"
+    assert await repo.resolve_thread_id("<2>", ["<unknown>", "<1>"]) == (tid, "found")
+    assert await repo.resolve_thread_id("<2>", ["<1>"]) == (tid, "existing")
+    # Mappings stored by previous versions are found too.
+    assert await repo.resolve_thread_id("<3>", ["<0>"]) == ("t0", "found")
+
+    assert await repo.get_thread_messages(tid) == {b"<1>", b"<2>"}
+    assert await repo.get_thread_messages("t0") == {b"<3>"}
+    assert await redis_client.zscore("thread_activity", tid)
+    bucket_key, field = repo._message_slot("<2>")
+    assert await redis_client.hget(bucket_key, field) == tid.encode()
+
+
+@pytest.mark.asyncio
+async def test_expire_script_removes_thread_in_redis(redis_client):
+    repo = ThreadsRepository(redis_client, bucket_count=4)
+    tid, _ = await repo.resolve_thread_id("<1>", [])
+    await repo.resolve_thread_id("<2>", ["<1>"])
+    await redis_client.set("msg:<0>", tid)
+    await redis_client.sadd(f"thread:{tid}", "<0>")
+    other_tid, _ = await repo.resolve_thread_id("<3>", [])
+    await redis_client.zadd("thread_activity", {tid: time.time() - 100})
+
+    assert await repo.expire_inactive_threads(inactive_for=50) == 1
+
+    assert await redis_client.zrange("thread_activity", 0, -1) == [other_tid.encode()]
+    assert not await redis_client.exists(f"thread:{tid}", "msg:<0>")
+    for m in ["<1>", "<2>"]:
+        assert await redis_client.hget(*repo._message_slot(m)) is None
+    assert await repo.get_message_thread_id("<3>") == other_tid